@@ -1,421 +1,1997 @@
 import json
 import logging
 from datetime import datetime
-import schedule
 import signal
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 import discord
+from discord import app_commands
 from discord.ext import commands, tasks
 from discord.ext.commands import cooldown, BucketType
-from discord.ui import Button, View, Select
-from collections import defaultdict
+from discord.ui import Button, View, Select, Modal, TextInput
+from collections import defaultdict, OrderedDict
 import heapq
 import asyncio
+import gc
+import math
 import os
 import sys
+import threading
+from collections.abc import MutableMapping
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from aiohttp import web
 from dotenv import load_dotenv
+import re
 import time
+import zlib
+import atexit
+import queue
+from urllib.parse import urlparse
+import aiohttp
+
+try:
+    import numpy as np
+except ImportError:  # Bulk re-rating falls back to plain Python
+    np = None
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:  # The batch engine uses its own Hungarian solver instead
+    linear_sum_assignment = None
+
+# Load environment variables from .env file
+load_dotenv()
 
 # Setup logging
-log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+# logger only puts records on log_queue; log_listener's thread formats them
+# and writes bot_logs.log, so disk writes and file rotation never run on the
+# event loop. LOG_FORMAT=json writes one JSON object per line, including the
+# guild_id, track, user_id and latency_ms passed as `extra`. Warnings and
+# errors are sampled per call site: after LOG_ERROR_BURST records within
+# LOG_ERROR_WINDOW seconds the rest are dropped, and the next record kept
+# from that site says how many were. A full queue drops records too.
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()  # text or json
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_ERROR_BURST = int(os.getenv("LOG_ERROR_BURST", "10"))
+LOG_ERROR_WINDOW = float(os.getenv("LOG_ERROR_WINDOW_SECONDS", "60"))
+
+class JsonLogFormatter(logging.Formatter):
+    fields = ('guild_id', 'track', 'user_id', 'latency_ms', 'suppressed')
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'message': record.getMessage()
+        }
+        for field in self.fields:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        return json.dumps(entry, default=str)
+
+class ErrorSampler(logging.Filter):
+    def __init__(self, burst, window):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self.sites = {}  # (file, line) -> [window start, records in window]
+        self.suppressed = 0
+        self.lock = threading.Lock()  # Executor threads log too
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        site = (record.pathname, record.lineno)
+        with self.lock:
+            seen = self.sites.get(site)
+            if seen is None or record.created - seen[0] >= self.window:
+                self.sites[site] = [record.created, 1]
+                suppressed = seen[1] - self.burst if seen else 0
+                if suppressed > 0:
+                    record.suppressed = suppressed
+                    record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+                return True
+            seen[1] += 1
+            if seen[1] > self.burst:
+                self.suppressed += 1
+                return False
+            return True
+
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+if LOG_FORMAT == 'json':
+    log_formatter = JsonLogFormatter()
+else:
+    log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 log_file = 'bot_logs.log'
 log_handler = RotatingFileHandler(log_file, maxBytes=5*1024*1024, backupCount=5)
 log_handler.setFormatter(log_formatter)
 
+log_queue = queue.Queue(LOG_QUEUE_SIZE)
+error_sampler = ErrorSampler(LOG_ERROR_BURST, LOG_ERROR_WINDOW)
+log_queue_handler = DroppingQueueHandler(log_queue)
+log_queue_handler.addFilter(error_sampler)
+log_listener = QueueListener(log_queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)  # Writes out what is still queued
+
 logger = logging.getLogger('BotLogger')
 logger.setLevel(logging.INFO)
-logger.addHandler(log_handler)
-
-
-
-# Load environment variables from .env file
-load_dotenv()
+logger.addHandler(log_queue_handler)
 
 # Initialize the bot
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
-bot = commands.Bot(command_prefix="!", intents=intents , heartbeat_timeout=120)
 
+# Discord REST rate limits
+# Every REST response passes through an aiohttp trace that records the
+# X-RateLimit headers per bucket, so the outbound queue can hold a channel
+# until its bucket resets instead of sending into a 429. DISCORD_API_BASE
+# points the REST client at another server, e.g. a local mock that scripts
+# 429 responses. 429s longer than RATE_LIMIT_MAX_WAIT (at least 30 seconds)
+# are raised as discord.RateLimited instead of being slept on.
+DISCORD_API_BASE = os.getenv("DISCORD_API_BASE")
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "30"))
+
+if DISCORD_API_BASE:
+    discord.http.Route.BASE = DISCORD_API_BASE.rstrip('/')
+
+def api_path(url):
+    # Path of a request relative to the API base, e.g. /channels/123/messages
+    base_path = urlparse(discord.http.Route.BASE).path
+    path = url.path
+    return path[len(base_path):] if path.startswith(base_path) else path
+
+def message_route(channel_id):
+    return f"POST /channels/{channel_id}/messages"
+
+class RateLimitTracker:
+    def __init__(self):
+        self.route_buckets = {}  # route -> bucket key, routes can share a bucket
+        self.buckets = {}  # bucket key -> [remaining, reset_at]
+        self.global_reset_at = 0.0
+        self.hits = 0  # 429 responses seen
+
+    def observe(self, method, path, status, headers):
+        route = f"{method} {path}"
+        now = time.monotonic()
+        retry_after = float(headers.get('Retry-After') or 0)
+        if status == 429:
+            self.hits += 1
+            scope = headers.get('X-RateLimit-Scope', 'user')
+            metrics.inc('bot_discord_rate_limited_total', scope=scope)
+            if headers.get('X-RateLimit-Global') == 'true' or scope == 'global':
+                self.global_reset_at = now + retry_after
+                return
+        
+        bucket = headers.get('X-RateLimit-Bucket')
+        if bucket is None and status != 429:
+            return
+        # Buckets are shared per major parameter, e.g. per channel
+        major = "/".join(path.split("/")[1:3])
+        key = self.route_buckets[route] = f"{bucket}:{major}" if bucket else route
+        remaining = int(headers.get('X-RateLimit-Remaining') or 1)
+        reset_after = float(headers.get('X-RateLimit-Reset-After') or 0)
+        if status == 429:
+            remaining = 0
+            reset_after = max(reset_after, retry_after)
+        self.buckets[key] = [remaining, now + reset_after]
+
+    def delay(self, route):
+        # Seconds before a request on this route can be sent without a 429
+        now = time.monotonic()
+        wait = self.global_reset_at - now
+        key = self.route_buckets.get(route)
+        if key is not None:
+            remaining, reset_at = self.buckets[key]
+            if remaining <= 0:
+                wait = max(wait, reset_at - now)
+        return max(wait, 0.0)
+
+    def prune(self):
+        # Forget buckets that have reset, routes map to them again on the next response
+        now = time.monotonic()
+        expired = {key for key, (remaining, reset_at) in self.buckets.items() if reset_at <= now}
+        for key in expired:
+            del self.buckets[key]
+        self.route_buckets = {route: key for route, key in self.route_buckets.items() if key not in expired}
+        return len(expired)
+
+rate_limits = RateLimitTracker()
+
+async def on_request_end(session, trace_context, params):
+    rate_limits.observe(params.method, api_path(params.url), params.response.status, params.response.headers)
+
+rate_limit_trace = aiohttp.TraceConfig()
+rate_limit_trace.on_request_end.append(on_request_end)
+
+# Sharding
+# AUTO_SHARD=1 lets discord.py pick the shard count; SHARD_COUNT and SHARD_IDS
+# run a fixed subset of shards in this process, e.g. one process per shard
+AUTO_SHARD = os.getenv("AUTO_SHARD", "0") == "1"
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) or None
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv("SHARD_IDS", "").split(",") if shard_id.strip()] or None
+
+if SHARD_IDS and not SHARD_COUNT:
+    # discord.py needs the total to know which guilds the listed shards cover
+    logger.error("SHARD_IDS needs SHARD_COUNT, the total number of shards across all processes")
+    sys.exit(1)
+
+if AUTO_SHARD or SHARD_COUNT:
+    bot = commands.AutoShardedBot(
+        command_prefix="!", intents=intents, heartbeat_timeout=120,
+        shard_count=SHARD_COUNT, shard_ids=SHARD_IDS,
+        http_trace=rate_limit_trace, max_ratelimit_timeout=RATE_LIMIT_MAX_WAIT
+    )
+else:
+    bot = commands.Bot(
+        command_prefix="!", intents=intents , heartbeat_timeout=120,
+        http_trace=rate_limit_trace, max_ratelimit_timeout=RATE_LIMIT_MAX_WAIT
+    )
 
-# Categorized Tracks
-track_categories = {
-    "Backend Frameworks": [".net", "node.js", "laravel", "django", "spring"],
-    "Cybersecurity Specializations": ["network security", "ethical hacking", "digital forensics"],
-    "Data Science Specializations": ["machine learning", "data analysis", "data engineering", "deep learning"],
-    "Other Tracks": ["front end", "ui-ux", "flutter", "cloud", "mobile", "embedded systems", "vr", "game development"]
-}
+# Metrics registry
+# The matcher, persistence layer and command handlers record into this
+# registry; it is served as Prometheus text by the metrics endpoint and
+# summarised by !stats.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+class MetricsRegistry:
+    def __init__(self):
+        self.kinds = {}
+        self.help = {}
+        self.buckets = {}
+        self.values = defaultdict(float)  # (name, labels) -> counter or gauge value
+        self.histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+        self.last = {}  # (name, labels) -> last observed value, for !stats
+        self.collectors = []  # Callables yielding (name, labels, value) gauge samples at scrape time
+
+    def describe(self, name, kind, help_text, buckets=DEFAULT_BUCKETS):
+        self.kinds[name] = kind
+        self.help[name] = help_text
+        if kind == 'histogram':
+            self.buckets[name] = buckets
+
+    def inc(self, name, value=1, **labels):
+        self.values[(name, tuple(sorted(labels.items())))] += value
+
+    def set(self, name, value, **labels):
+        self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [[0] * len(self.buckets[name]), 0.0, 0]
+        for i, bound in enumerate(self.buckets[name]):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+        self.last[key] = value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+
+    def value(self, name, **labels):
+        return self.values.get((name, tuple(sorted(labels.items()))), 0)
+
+    def total(self, name):
+        return sum(value for (metric, labels), value in self.values.items() if metric == name)
+
+    def histogram_totals(self, name):
+        count = 0
+        total = 0.0
+        for (metric, labels), (bucket_counts, value_sum, value_count) in self.histograms.items():
+            if metric == name:
+                count += value_count
+                total += value_sum
+        return count, total
+
+    def render(self):
+        samples = defaultdict(list)
+        for (name, labels), value in self.values.items():
+            samples[name].append((labels, value))
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                samples[name].append((tuple(sorted(labels.items())), value))
+        for (name, labels), (bucket_counts, value_sum, value_count) in self.histograms.items():
+            for bound, count in zip(self.buckets[name], bucket_counts):
+                samples[name].append((labels + (('le', str(bound)),), count, '_bucket'))
+            samples[name].append((labels + (('le', '+Inf'),), value_count, '_bucket'))
+            samples[name].append((labels, value_sum, '_sum'))
+            samples[name].append((labels, value_count, '_count'))
+        
+        lines = []
+        for name in sorted(samples):
+            lines.append(f"# HELP {name} {self.help.get(name, name)}")
+            lines.append(f"# TYPE {name} {self.kinds.get(name, 'untyped')}")
+            for sample in samples[name]:
+                labels, value = sample[0], sample[1]
+                suffix = sample[2] if len(sample) > 2 else ''
+                label_text = ','.join(f'{key}="{format_label_value(val)}"' for key, val in labels)
+                lines.append(f"{name}{suffix}{{{label_text}}} {value}" if label_text else f"{name}{suffix} {value}")
+        return '\n'.join(lines) + '\n'
+
+def format_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+metrics = MetricsRegistry()
+metrics.describe('bot_queue_members', 'gauge', 'Members waiting to be matched, per guild and track')
+metrics.describe('bot_queue_leaders', 'gauge', 'Leaders waiting to be matched, per guild and track')
+metrics.describe('bot_matching_pass_seconds', 'histogram', 'Duration of a matching pass including notification delivery')
+metrics.describe('bot_matches_per_pass', 'histogram', 'Matches made per matching pass', buckets=(0, 1, 5, 10, 25, 50, 100, 250, 500, 1000))
+metrics.describe('bot_matches_total', 'counter', 'Matches made since start')
+metrics.describe('bot_matching_requests_merged_total', 'counter', 'Matching requests folded into an already scheduled pass')
+metrics.describe('bot_save_seconds', 'histogram', 'Duration of a full state save')
+metrics.describe('bot_save_bytes', 'gauge', 'Size of the last saved snapshot in bytes, per guild')
+metrics.describe('bot_journal_append_seconds', 'histogram', 'Duration of a single journal append')
+metrics.describe('bot_discord_api_seconds', 'histogram', 'Latency of Discord API calls made by the bot')
+metrics.describe('bot_discord_api_errors_total', 'counter', 'Failed Discord API calls')
+metrics.describe('bot_registration_step_seconds', 'histogram', 'Time a user spent on each registration step')
+metrics.describe('bot_registration_sessions', 'gauge', 'Registration sessions in progress')
+metrics.describe('bot_registration_session_evictions_total', 'counter', 'Registration sessions evicted since the guild was loaded, by reason')
+metrics.describe('bot_conversation_prompts', 'gauge', 'Prompts waiting for a typed reply')
+metrics.describe('bot_resolver_cache', 'gauge', 'User and DM channel resolver cache counters')
+metrics.describe('bot_startup_phase_seconds', 'gauge', 'Duration of each startup phase')
+metrics.describe('bot_guilds_loaded', 'gauge', 'Guilds whose state is currently loaded')
+metrics.describe('bot_discord_rate_limited_total', 'counter', '429 responses from the Discord API, by scope')
+metrics.describe('bot_outbound_pending', 'gauge', 'Messages waiting in the outbound queue, by priority')
+metrics.describe('bot_university_search_seconds', 'histogram', 'Duration of a university search', buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01))
+metrics.describe('bot_log_records_dropped_total', 'counter', 'Log records dropped, by reason')
+metrics.describe('bot_catalog_reloads_total', 'counter', 'Catalog reloads, by result')
+metrics.describe('bot_guild_load_seconds', 'histogram', 'Time to load a guild on its first activity')
+
+def log_samples():
+    yield 'bot_log_records_dropped_total', {'reason': 'sampled'}, error_sampler.suppressed
+    yield 'bot_log_records_dropped_total', {'reason': 'queue_full'}, log_queue_handler.dropped
+
+metrics.collectors.append(log_samples)
+
+
+# Catalog
+# Track categories, universities and their aliases, departments and the
+# tracks' topics with their difficulty scores are read from CATALOG_FILE and
+# checked by validate_catalog before anything uses them. The file can be
+# edited while the bot runs, see Catalog reload.
+CATALOG_FILE = os.getenv("CATALOG_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog.json"))
+CATALOG_OPTION_LIMIT = 25  # Categories, tracks per category, all tracks (for /register), departments and topics per track each fill one select menu
+
+def validate_catalog(catalog):
+    # Returns every problem found, an empty list means the catalog is usable
+    problems = []
+    if not isinstance(catalog, dict):
+        return ["the catalog must be a JSON object"]
+    for key, kind in (('track_categories', dict), ('universities', list), ('university_aliases', dict),
+                      ('departments', list), ('track_topics', dict)):
+        if not isinstance(catalog.get(key), kind):
+            problems.append(f"'{key}' must be a JSON {'object' if kind is dict else 'array'}")
+    if problems:
+        return problems
+
+    def check_names(where, names, limit=None):
+        if not names or not all(isinstance(name, str) and name.strip() for name in names):
+            problems.append(f"{where} must be a non-empty list of names")
+        elif len(set(names)) != len(names):
+            problems.append(f"{where} contains duplicates")
+        elif limit is not None and len(names) > limit:
+            problems.append(f"{where} has {len(names)} entries, at most {limit} fit in a select menu")
+
+    categories = catalog['track_categories']
+    check_names("track_categories", list(categories), CATALOG_OPTION_LIMIT)
+    tracks = []
+    for category, category_tracks in categories.items():
+        if not isinstance(category_tracks, list):
+            problems.append(f"tracks of category '{category}' must be a list")
+            continue
+        check_names(f"tracks of category '{category}'", category_tracks, CATALOG_OPTION_LIMIT)
+        tracks.extend(category_tracks)
+    if len(set(tracks)) != len(tracks):
+        problems.append("a track is listed in more than one category")
+    if len(tracks) > CATALOG_OPTION_LIMIT:
+        problems.append(f"there are {len(tracks)} tracks, the /register form lists at most {CATALOG_OPTION_LIMIT} in one select menu")
+
+    check_names("universities", catalog['universities'])
+    for alias, university in catalog['university_aliases'].items():
+        if university not in catalog['universities']:
+            problems.append(f"alias '{alias}' points to unknown university '{university}'")
+    check_names("departments", catalog['departments'], CATALOG_OPTION_LIMIT)
+
+    track_topics = catalog['track_topics']
+    for track in tracks:
+        if track not in track_topics:
+            problems.append(f"track '{track}' has no topics")
+    for track, topics in track_topics.items():
+        if track not in tracks:
+            problems.append(f"topics are listed for unknown track '{track}'")
+        if not isinstance(topics, list) or not all(isinstance(topic, dict) for topic in topics):
+            problems.append(f"topics of track '{track}' must be a list of objects")
+            continue
+        check_names(f"topics of track '{track}'", [topic.get('name') for topic in topics], CATALOG_OPTION_LIMIT)
+        for topic in topics:
+            score = topic.get('score')
+            if isinstance(score, bool) or not isinstance(score, int) or score < 0:
+                problems.append(f"topic '{topic.get('name')}' of track '{track}' needs a non-negative integer score")
+    return problems
+
+def read_catalog(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        catalog = json.load(f)
+    problems = validate_catalog(catalog)
+    if problems:
+        raise ValueError(f"Invalid catalog {path}: " + "; ".join(problems))
+    return catalog
+
+def apply_catalog(catalog):
+    global track_categories, universities, university_aliases, departments, track_topics
+    track_categories = catalog['track_categories']
+    universities = catalog['universities']
+    university_aliases = catalog['university_aliases']  # Other names users search for -> stored university name
+    departments = catalog['departments']
+    track_topics = catalog['track_topics']  # Track -> topics with difficulty scores
+
+def catalog_file_stamp():
+    try:
+        stat = os.stat(CATALOG_FILE)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+catalog_stamp = catalog_file_stamp()  # Modification time and size of the loaded catalog file
+apply_catalog(read_catalog(CATALOG_FILE))
+
+# Categorical codes
+# Tracks, universities, departments and topic names are interned as small
+# integers, so queued records hold ints instead of repeated strings and bucket
+# keys compare as int tuples. Values outside the catalog (e.g. from an older
+# snapshot) get a new code the first time they are seen, so converting back
+# to names is always lossless. Codes are only ever appended, never reused.
+class CodeTable:
+    def __init__(self, values=()):
+        self.codes = {}
+        self.values = []
+        for value in values:
+            self.code(value)
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def value(self, code):
+        return self.values[code]
+
+    def encode(self, values):
+        # Bulk form of code() for topic lists, with a fast path for known values
+        codes = self.codes
+        try:
+            return tuple([codes[value] for value in values])
+        except KeyError:
+            return tuple([self.code(value) for value in values])
+
+track_codes = CodeTable()
+university_codes = CodeTable()
+department_codes = CodeTable()
+topic_codes = CodeTable()
+
+def intern_catalog(catalog):
+    track_codes.encode([track for tracks in catalog['track_categories'].values() for track in tracks])
+    university_codes.encode(catalog['universities'])
+    department_codes.encode(catalog['departments'])
+    topic_codes.encode([topic['name'] for topics in catalog['track_topics'].values() for topic in topics])
+
+intern_catalog({
+    'track_categories': track_categories,
+    'universities': universities,
+    'departments': departments,
+    'track_topics': track_topics
+})
+
+# Topic score tables
+# Built from track_topics so rating a member is a dict lookup per topic
+# instead of a scan of the track's topic list. topic_tables only reads the
+# code tables once the catalog is interned, so a catalog reload can build
+# the tables on a worker thread and swap them in with set_topic_tables.
+def topic_tables(topics_by_track):
+    scores_by_name = {track: {topic['name']: topic['score'] for topic in topics} for track, topics in topics_by_track.items()}
+    bits = {
+        track: {topic_codes.code(topic['name']): 1 << bit for bit, topic in enumerate(topics)}
+        for track, topics in topics_by_track.items()
+    }
+    score_vectors = {track: [topic['score'] for topic in topics] for track, topics in topics_by_track.items()}
+    total_scores = {track: sum(scores) for track, scores in score_vectors.items()}
+    # Weighted score of every subset of a track's topics, indexed by bitmask,
+    # so the overlap between two topic sets is one AND and one list lookup
+    mask_tables = {}
+    for track, scores in score_vectors.items():
+        table = [0] * (1 << len(scores)) if len(scores) <= MASK_TABLE_MAX_TOPICS else None
+        if table is not None:
+            for mask in range(1, len(table)):
+                lowest = mask & -mask
+                table[mask] = table[mask ^ lowest] + scores[lowest.bit_length() - 1]
+        mask_tables[track] = table
+    return scores_by_name, bits, score_vectors, total_scores, mask_tables
+
+def set_topic_tables(tables):
+    global topic_scores, topic_bits, track_score_vectors, track_total_scores, mask_score_tables
+    topic_scores, topic_bits, track_score_vectors, track_total_scores, mask_score_tables = tables
+
+def build_topic_tables():
+    set_topic_tables(topic_tables(track_topics))
+
+MASK_TABLE_MAX_TOPICS = 16  # Tracks with more topics score masks bit by bit instead
+
+def mask_score(track, mask):
+    table = mask_score_tables.get(track)
+    if table is not None:
+        return table[mask]
+    scores = track_score_vectors.get(track, [])
+    return sum(score for bit, score in enumerate(scores) if mask >> bit & 1)
+
+# How much of a leader's needed topics a member covers, weighted by topic score
+def gap_coverage(track, needed_mask, member_mask):
+    return mask_score(track, needed_mask & member_mask)
+
+build_topic_tables()
+
+# Queued member and leader records
+# Slotted records replace the per-member dicts held in the bucket indexes.
+# Categorical fields are codes from the tables above; to_dict/from_dict
+# convert to and from the JSON format used by events, the snapshot and SQLite.
+class Member:
+    __slots__ = ('user_id', 'user_name', 'track', 'university', 'department', 'rating',
+                 'comment', 'topics', 'registration_time', 'topic_mask')
+
+    def __init__(self, user_id, user_name, track, university, department, rating, comment, topics, registration_time):
+        self.user_id = user_id
+        self.user_name = user_name
+        self.track = track
+        self.university = university
+        self.department = department
+        self.rating = rating
+        self.comment = comment
+        self.topics = topics  # Tuple of topic codes, in the order they were chosen
+        self.registration_time = registration_time
+        self.topic_mask = 0  # Derived, set by queue_member and bulk re-rating
+
+    # Heap order: highest rating first, then earliest registration, then user_id
+    def __lt__(self, other):
+        if self.rating != other.rating:
+            return self.rating > other.rating
+        if self.registration_time != other.registration_time:
+            return self.registration_time < other.registration_time
+        return self.user_id < other.user_id
+
+    @property
+    def track_name(self):
+        return track_codes.value(self.track)
+
+    @property
+    def university_name(self):
+        return university_codes.value(self.university)
+
+    @property
+    def department_name(self):
+        return department_codes.value(self.department)
+
+    @property
+    def selected_topics(self):
+        return [topic_codes.value(code) for code in self.topics]
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data['user_id'],
+            data['user_name'],
+            track_codes.code(data['track']),
+            university_codes.code(data['university']),
+            department_codes.code(data['department']),
+            data['rating'],
+            data['comment'],
+            topic_codes.encode(data['selected_topics']),
+            data['registration_time']
+        )
 
-universities = [
-    "Cairo University",
-    "Ain Shams University",
-    "Alexandria University",
-    "Helwan University",
-    "Mansoura University",
-    "Assiut University",
-    "Zagazig University",
-    "Tanta University",
-    "Suez Canal University",
-    "Benha University",
-    "Fayoum University",
-    "South Valley University",
-    "Menoufia University",
-    "Port Said University",
-    "Beni Suef University",
-    "Kafrelsheikh University",
-    "Damietta University",
-    "Sohag University",
-    "Modern Academy",
-    "MSA University",
-    "MTI University",
-    "Future University",
-    "October 6 University",
-    "Badr University",
-    "New Cairo Academy"
-]
-
-# Track Topics with Difficulty Scores
-track_topics = {
-    ".net": [
-        {"name": "C# Basics", "difficulty": "beginner", "score": 15},
-        {"name": ".NET Core Fundamentals", "difficulty": "beginner", "score": 15},
-        {"name": "Basic Web API", "difficulty": "intermediate", "score": 25},
-        {"name": ".NET MVC", "difficulty": "intermediate", "score": 25},
-        {"name": "Entity Framework", "difficulty": "advanced", "score": 40},
-        {"name": "Dependency Injection", "difficulty": "advanced", "score": 40},
-        {"name": "Microservices with .NET", "difficulty": "advanced", "score": 40},
-        {"name": "Advanced ORM", "difficulty": "advanced", "score": 40},
-        {"name": "Performance Optimization", "difficulty": "advanced", "score": 40}
-    ],
-    "node.js": [
-        {"name": "JavaScript Basics", "difficulty": "beginner", "score": 15},
-        {"name": "Node.js Fundamentals", "difficulty": "beginner", "score": 15},
-        {"name": "Express.js Basics", "difficulty": "intermediate", "score": 25},
-        {"name": "Async Programming", "difficulty": "intermediate", "score": 25},
-        {"name": "RESTful API Design", "difficulty": "advanced", "score": 40},
-        {"name": "Authentication", "difficulty": "advanced", "score": 40},
-        {"name": "Advanced Express", "difficulty": "advanced", "score": 40},
-        {"name": "Microservices", "difficulty": "advanced", "score": 40},
-        {"name": "Performance Tuning", "difficulty": "advanced", "score": 40}
-    ],
-    "laravel": [
-        {"name": "PHP Basics", "difficulty": "beginner", "score": 15},
-        {"name": "Laravel Installation", "difficulty": "beginner", "score": 15},
-        {"name": "Routing Fundamentals", "difficulty": "intermediate", "score": 25},
-        {"name": "Eloquent ORM", "difficulty": "intermediate", "score": 25},
-        {"name": "Authentication", "difficulty": "advanced", "score": 40},
-        {"name": "Blade Templates", "difficulty": "advanced", "score": 40},
-        {"name": "Advanced Eloquent", "difficulty": "advanced", "score": 40},
-        {"name": "Laravel Microservices", "difficulty": "advanced", "score": 40},
-        {"name": "Performance Optimization", "difficulty": "advanced", "score": 40}
-    ],
-    "django": [
-        {"name": "Python Basics", "difficulty": "beginner", "score": 15},
-        {"name": "Django Setup", "difficulty": "beginner", "score": 15},
-        {"name": "Basic Models", "difficulty": "intermediate", "score": 25},
-        {"name": "Django ORM", "difficulty": "intermediate", "score": 25},
-        {"name": "Authentication", "difficulty": "advanced", "score": 40},
-        {"name": "REST Framework", "difficulty": "advanced", "score": 40},
-        {"name": "Advanced Querying", "difficulty": "advanced", "score": 40},
-        {"name": "Microservices", "difficulty": "advanced", "score": 40},
-        {"name": "Performance Optimization", "difficulty": "advanced", "score": 40}
-    ],
-    "spring": [
-        {"name": "Java Basics", "difficulty": "beginner", "score": 15},
-        {"name": "Spring Boot Fundamentals", "difficulty": "beginner", "score": 15},
-        {"name": "Dependency Injection", "difficulty": "intermediate", "score": 25},
-        {"name": "Spring MVC", "difficulty": "intermediate", "score": 25},
-        {"name": "JPA", "difficulty": "advanced", "score": 40},
-        {"name": "Security Configuration", "difficulty": "advanced", "score": 40},
-        {"name": "Microservices", "difficulty": "advanced", "score": 40},
-        {"name": "Advanced Caching", "difficulty": "advanced", "score": 40},
-        {"name": "Performance Tuning", "difficulty": "advanced", "score": 40}
-    ],
-    "network security": [
-        {"name": "Network Basics", "difficulty": "beginner", "score": 15},
-        {"name": "TCP/IP", "difficulty": "beginner", "score": 15},
-        {"name": "Firewall Concepts", "difficulty": "intermediate", "score": 25},
-        {"name": "Intrusion Detection", "difficulty": "intermediate", "score": 25},
-        {"name": "Network Protocols", "difficulty": "advanced", "score": 40},
-        {"name": "Packet Analysis", "difficulty": "advanced", "score": 40},
-        {"name": "Advanced Threat Detection", "difficulty": "advanced", "score": 40},
-        {"name": "Network Forensics", "difficulty": "advanced", "score": 40},
-        {"name": "Secure Network Design", "difficulty": "advanced", "score": 40}
-    ],
-    "ethical hacking": [
-        {"name": "Security Fundamentals", "difficulty": "beginner", "score": 15},
-        {"name": "Basic Networking", "difficulty": "beginner", "score": 15},
-        {"name": "Linux Basics", "difficulty": "intermediate", "score": 25},
-        {"name": "Penetration Testing Basics", "difficulty": "intermediate", "score": 25},
-        {"name": "Vulnerability Assessment", "difficulty": "advanced", "score": 40},
-        {"name": "Exploit Techniques", "difficulty": "advanced", "score": 40},
-        {"name": "Advanced Penetration Testing", "difficulty": "advanced", "score": 40},
-        {"name": "Red Team Tactics", "difficulty": "advanced", "score": 40},
-        {"name": "Advanced Exploit Development", "difficulty": "advanced", "score": 40}
-    ],
-    "digital forensics": [
-        {"name": "Computer Forensics Basics", "difficulty": "beginner", "score": 15},
-        {"name": "Evidence Preservation", "difficulty": "beginner", "score": 15},
-        {"name": "Basic Tools", "difficulty": "intermediate", "score": 25},
-        {"name": "Forensic Analysis Techniques", "difficulty": "intermediate", "score": 25},
-        {"name": "Disk Forensics", "difficulty": "advanced", "score": 40},
-        {"name": "Memory Forensics", "difficulty": "advanced", "score": 40},
-        {"name": "Advanced Forensic Tools", "difficulty": "advanced", "score": 40},
-        {"name": "Malware Analysis", "difficulty": "advanced", "score": 40},
-        {"name": "Complex Investigation Techniques", "difficulty": "advanced", "score": 40}
-    ],
-    "machine learning": [
-        {"name": "Python Basics", "difficulty": "beginner", "score": 15},
-        {"name": "Statistics Fundamentals", "difficulty": "beginner", "score": 15},
-        {"name": "Basic ML Algorithms", "difficulty": "intermediate", "score": 25},
-        {"name": "Scikit-learn", "difficulty": "intermediate", "score": 25},
-        {"name": "Supervised Learning", "difficulty": "advanced", "score": 40},
-        {"name": "Feature Engineering", "difficulty": "advanced", "score": 40},
-        {"name": "Deep Learning", "difficulty": "advanced", "score": 40},
-        {"name": "Advanced ML Algorithms", "difficulty": "advanced", "score": 40},
-        {"name": "Model Deployment", "difficulty": "advanced", "score": 40}
-    ],
-    "data analysis": [
-        {"name": "Python Basics", "difficulty": "beginner", "score": 15},
-        {"name": "Excel Fundamentals", "difficulty": "beginner", "score": 15},
-        {"name": "Basic Statistics", "difficulty": "intermediate", "score": 25},
-        {"name": "Pandas", "difficulty": "intermediate", "score": 25},
-        {"name": "NumPy", "difficulty": "advanced", "score": 40},
-        {"name": "Data Visualization", "difficulty": "advanced", "score": 40},
-        {"name": "Advanced Analytics", "difficulty": "advanced", "score": 40},
-        {"name": "Predictive Modeling", "difficulty": "advanced", "score": 40},
-        {"name": "Big Data Tools", "difficulty": "advanced", "score": 40}
-    ],
-    "data engineering": [
-        {"name": "SQL Basics", "difficulty": "beginner", "score": 15},
-        {"name": "Data Warehousing Concepts", "difficulty": "beginner", "score": 15},
-        {"name": "ETL Fundamentals", "difficulty": "intermediate", "score": 25},
-        {"name": "Apache Spark", "difficulty": "intermediate", "score": 25},
-        {"name": "Big Data Technologies", "difficulty": "advanced", "score": 40},
-        {"name": "Data Pipeline Design", "difficulty": "advanced", "score": 40},
-        {"name": "Distributed Computing", "difficulty": "advanced", "score": 40},
-        {"name": "Advanced Data Modeling", "difficulty": "advanced", "score": 40},
-        {"name": "Real-time Data Processing", "difficulty": "advanced", "score": 40}
-    ],
-    "deep learning": [
-        {"name": "Neural Network Basics", "difficulty": "beginner", "score": 15},
-        {"name": "Python for AI", "difficulty": "beginner", "score": 15},
-        {"name": "Basic Deep Learning Concepts", "difficulty": "intermediate", "score": 25},
-        {"name": "TensorFlow", "difficulty": "intermediate", "score": 25},
-        {"name": "Keras", "difficulty": "advanced", "score": 40},
-        {"name": "Neural Network Architectures", "difficulty": "advanced", "score": 40},
-        {"name": "Advanced Neural Networks", "difficulty": "advanced", "score": 40},
-        {"name": "Computer Vision", "difficulty": "advanced", "score": 40},
-        {"name": "NLP Techniques", "difficulty": "advanced", "score": 40}
-    ],
-    "front end": [
-        {"name": "HTML Basics", "difficulty": "beginner", "score": 15},
-        {"name": "CSS Fundamentals", "difficulty": "beginner", "score": 15},
-        {"name": "JavaScript Basics", "difficulty": "intermediate", "score": 25},
-        {"name": "Responsive Design", "difficulty": "intermediate", "score": 25},
-        {"name": "Bootstrap", "difficulty": "advanced", "score": 40},
-        {"name": "JavaScript ES6+", "difficulty": "advanced", "score": 40},
-        {"name": "React", "difficulty": "advanced", "score": 40},
-        {"name": "Vue.js", "difficulty": "advanced", "score": 40},
-        {"name": "State Management", "difficulty": "advanced", "score": 40}
-    ],
-    "ui-ux": [
-        {"name": "Design Principles", "difficulty": "beginner", "score": 15},
-        {"name": "Color Theory", "difficulty": "beginner", "score": 15},
-        {"name": "Typography Basics", "difficulty": "intermediate", "score": 25},
-        {"name": "Wireframing", "difficulty": "intermediate", "score": 25},
-        {"name": "Prototyping", "difficulty": "advanced", "score": 40},
-        {"name": "User Research", "difficulty": "advanced", "score": 40},
-        {"name": "Figma", "difficulty": "advanced", "score": 40},
-        {"name": "Adobe XD", "difficulty": "advanced", "score": 40},
-        {"name": "Advanced UX Strategy", "difficulty": "advanced", "score": 40}
-    ],
-    "flutter": [
-        {"name": "Dart Basics", "difficulty": "beginner", "score": 15},
-        {"name": "Flutter Installation", "difficulty": "beginner", "score": 15},
-        {"name": "Basic Widgets", "difficulty": "intermediate", "score": 25},
-        {"name": "State Management", "difficulty": "intermediate", "score": 25},
-        {"name": "Navigation", "difficulty": "advanced", "score": 40},
-        {"name": "API Integration", "difficulty": "advanced", "score": 40},
-        {"name": "Custom Widgets", "difficulty": "advanced", "score": 40},
-        {"name": "Performance Optimization", "difficulty": "advanced", "score": 40},
-        {"name": "Advanced State Solutions", "difficulty": "advanced", "score": 40}
-    ],
-    "cloud": [
-        {"name": "Cloud Computing Basics", "difficulty": "beginner", "score": 15},
-        {"name": "Basic Networking", "difficulty": "beginner", "score": 15},
-        {"name": "Virtual Machines", "difficulty": "intermediate", "score": 25},
-        {"name": "AWS Basics", "difficulty": "intermediate", "score": 25},
-        {"name": "Azure Fundamentals", "difficulty": "advanced", "score": 40},
-        {"name": "Docker Basics", "difficulty": "advanced", "score": 40},
-        {"name": "Kubernetes", "difficulty": "advanced", "score": 40},
-        {"name": "Cloud Security", "difficulty": "advanced", "score": 40},
-        {"name": "Advanced Deployment Strategies", "difficulty": "advanced", "score": 40}
-    ],
-    "mobile": [
-        {"name": "Mobile Development Basics", "difficulty": "beginner", "score": 15},
-        {"name": "UI Design for Mobile", "difficulty": "beginner", "score": 15},
-        {"name": "Android Development", "difficulty": "intermediate", "score": 25},
-        {"name": "iOS Development", "difficulty": "intermediate", "score": 25},
-        {"name": "React Native Basics", "difficulty": "advanced", "score": 40},
-        {"name": "Advanced Mobile Architectures", "difficulty": "advanced", "score": 40},
-        {"name": "Performance Optimization", "difficulty": "advanced", "score": 40},
-        {"name": "Cross-Platform Development", "difficulty": "advanced", "score": 40}
-    ],
-    "embedded systems": [
-        {"name": "Electronics Basics", "difficulty": "beginner", "score": 15},
-        {"name": "Microcontroller Fundamentals", "difficulty": "beginner", "score": 15},
-        {"name": "C Programming", "difficulty": "intermediate", "score": 25},
-        {"name": "Arduino Programming", "difficulty": "intermediate", "score": 25},
-        {"name": "Raspberry Pi", "difficulty": "advanced", "score": 40},
-        {"name": "Sensor Integration", "difficulty": "advanced", "score": 40},
-        {"name": "IoT Protocols", "difficulty": "advanced", "score": 40},
-        {"name": "Advanced Embedded Programming", "difficulty":"advanced", "score": 40},
-        {"name": "Real-Time Systems", "difficulty": "advanced", "score": 40}
-    ],
-    "vr": [
-        {"name": "3D Basics", "difficulty": "beginner", "score": 15},
-        {"name": "Virtual Reality Concepts", "difficulty": "beginner", "score": 15},
-        {"name": "Basic Game Design", "difficulty": "intermediate", "score": 25},
-        {"name": "Unity Basics", "difficulty": "intermediate", "score": 25},
-        {"name": "3D Modeling", "difficulty": "advanced", "score": 40},
-        {"name": "Basic VR Interactions", "difficulty": "advanced", "score": 40},
-        {"name": "Advanced VR Development", "difficulty": "advanced", "score": 40},
-        {"name": "Unreal Engine", "difficulty": "advanced", "score": 40},
-        {"name": "VR Performance Optimization", "difficulty": "advanced", "score": 40}
-    ],
-    "game development": [
-        {"name": "Game Design Basics", "difficulty": "beginner", "score": 15},
-        {"name": "Unity Basics", "difficulty": "beginner", "score": 15},
-        {"name": "Unreal Engine Basics", "difficulty": "intermediate", "score": 25},
-        {"name": "2D Game Development", "difficulty": "intermediate", "score": 25},
-        {"name": "3D Game Development", "difficulty": "advanced", "score": 40},
-        {"name": "Game Physics", "difficulty": "advanced", "score": 40},
-        {"name": "AI in Games", "difficulty": "advanced", "score": 40},
-        {"name": "Multiplayer Game Development", "difficulty": "advanced", "score": 40},
-        {"name": "VR Game Development", "difficulty": "advanced", "score": 40}
-    ]
-}
+    def to_dict(self):
+        return {
+            'user_id': self.user_id,
+            'user_name': self.user_name,
+            'track': self.track_name,
+            'rating': self.rating,
+            'comment': self.comment,
+            'department': self.department_name,
+            'university': self.university_name,
+            'selected_topics': self.selected_topics,
+            'registration_time': self.registration_time
+        }
+
+class Leader:
+    __slots__ = ('user_id', 'user_name', 'team_name', 'track', 'university', 'department',
+                 'team_comment', 'desired', 'needed_mask')
+
+    def __init__(self, user_id, user_name, team_name, track, university, department, team_comment, desired):
+        self.user_id = user_id
+        self.user_name = user_name
+        self.team_name = team_name
+        self.track = track
+        self.university = university
+        self.department = department
+        self.team_comment = team_comment
+        self.desired = desired  # Tuple of topic codes the project needs
+        self.needed_mask = 0  # Derived, set by queue_leader
+
+    @property
+    def track_name(self):
+        return track_codes.value(self.track)
+
+    @property
+    def university_name(self):
+        return university_codes.value(self.university)
+
+    @property
+    def department_name(self):
+        return department_codes.value(self.department)
+
+    @property
+    def desired_topics(self):
+        return [topic_codes.value(code) for code in self.desired]
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data['user_id'],
+            data['user_name'],
+            data['team_name'],
+            track_codes.code(data['track']),
+            university_codes.code(data['university']),
+            department_codes.code(data['department']),
+            data['team_comment'],
+            topic_codes.encode(data.get('desired_topics', []))
+        )
+
+    def to_dict(self):
+        return {
+            'user_id': self.user_id,
+            'user_name': self.user_name,
+            'team_name': self.team_name,
+            'track': self.track_name,
+            'team_comment': self.team_comment,
+            'department': self.department_name,
+            'university': self.university_name,
+            'desired_topics': self.desired_topics
+        }
+
+# Registration session store
+# Partial registrations live here keyed by user_id, together with the current
+# step and the last activity time. Sessions are kept least recently active
+# first, so idle ones are evicted from the front without scanning, and the
+# store never holds more than max_sessions entries.
+SESSION_TTL = int(os.getenv("SESSION_TTL_SECONDS", "1800"))  # Idle seconds before a session is evicted
+SESSION_MAX = int(os.getenv("SESSION_MAX", "10000"))  # Hard upper bound on stored sessions
+
+class RegistrationSessions(MutableMapping):
+    def __init__(self, ttl, max_sessions):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()  # user_id -> [data, step, step_started, last_activity]
+        self.evictions = {'idle': 0, 'capacity': 0}
+
+    def _touch(self, user_id, entry):
+        entry[3] = time.monotonic()
+        self.sessions.move_to_end(user_id)
+
+    def _entry(self, user_id):
+        entry = self.sessions.get(user_id)
+        if entry is None:
+            now = time.monotonic()
+            entry = self.sessions[user_id] = [{}, None, now, now]
+            self.evict_idle()
+            self._enforce_capacity()
+        return entry
+
+    def _enforce_capacity(self):
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+            self.evictions['capacity'] += 1
+
+    def evict_idle(self):
+        cutoff = time.monotonic() - self.ttl
+        evicted = 0
+        while self.sessions:
+            user_id, entry = next(iter(self.sessions.items()))
+            if entry[3] >= cutoff:
+                break
+            del self.sessions[user_id]
+            evicted += 1
+        self.evictions['idle'] += evicted
+        return evicted
+
+    def __getitem__(self, user_id):
+        entry = self.sessions[user_id]
+        self._touch(user_id, entry)
+        return entry[0]
+
+    def __setitem__(self, user_id, data):
+        entry = self._entry(user_id)
+        entry[0] = data
+        self._touch(user_id, entry)
+
+    def __delitem__(self, user_id):
+        del self.sessions[user_id]
+
+    def __contains__(self, user_id):
+        return user_id in self.sessions
+
+    def __iter__(self):
+        return iter(list(self.sessions))
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def set_step(self, user_id, step):
+        # Returns the previous (step, started_at) so its duration can be recorded
+        entry = self._entry(user_id)
+        previous = (entry[1], entry[2])
+        entry[1] = step
+        entry[2] = time.monotonic()
+        self._touch(user_id, entry)
+        return previous
+
+    def step(self, user_id):
+        entry = self.sessions.get(user_id)
+        return entry[1] if entry else None
+
+    def load(self, sessions):
+        self.sessions.clear()
+        for user_id, data in sessions.items():
+            self[user_id] = data
+
+    def snapshot(self):
+        # Copies, since the snapshot is encoded on the writer thread
+        return {user_id: dict(entry[0]) for user_id, entry in self.sessions.items()}
+
+# Per-guild state
+# Every guild is its own cohort: queues, sessions, match history, persistence
+# files and matching schedule live on a GuildState, so registrations in one
+# server never meet leaders from another. States are loaded on the first
+# command in their guild (get_guild_state) and evicted by maintenance once
+# idle for GUILD_IDLE_TTL seconds, so inactive guilds cost no memory.
+DIRECT_MESSAGES = 0  # State key for commands used outside a guild
+
+class GuildState:
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.member_index = defaultdict(list)  # (track, university, department) -> heap of queued members
+        self.leader_index = defaultdict(list)  # (track, university, department) -> leaders in registration order
+        self.dirty_buckets = set()  # Buckets that changed since the last matching pass
+        self.user_data = RegistrationSessions(SESSION_TTL, SESSION_MAX)
+        self.registered_users = set()
+        self.matched_members = set()
+        self.keep_match_history = STORAGE_BACKEND != 'sqlite'  # Whether matches go into matched_members
+        self.leader_departments = {}  # user_id -> university and department locked for a leader
+        self.in_flight = {}  # leader user_id -> member popped for them while the match notification is delivered
+        self.data_file, self.journal_file, self.sqlite_path = guild_paths(guild_id)
+        self.journal_seq = 0  # Sequence number of the last journal record
+        self.journal_records = 0  # Records written since the last snapshot
+        self.sqlite_store = SQLiteStore(self.sqlite_path, PROCESS_INDEX)
+        self.feed_cursor = (0, 0, 0.0)  # Last member id, leader id and matched_at read from the feed
+        self.queue_from_feed = False  # Set once the shared queue is loaded
+        self.coordinator = MatchingCoordinator(self.run_matching)
+        self.match_interval = MATCH_INTERVAL  # Current wait between scheduled passes
+        self.next_match_at = 0.0  # Monotonic time of the next scheduled pass
+        self.last_active = time.monotonic()
+
+    async def run_matching(self):
+        return await perform_matching(self)
+
+# Member index helpers
+# Members are queued per (track, university, department) so a leader's best
+# candidate is a single heap pop instead of a scan over the whole track.
+def bucket_key(record):
+    return (record.track, record.university, record.department)
+
+# Events and the journal carry bucket names, the indexes use codes
+def bucket_names(key):
+    track, university, department = key
+    return (track_codes.value(track), university_codes.value(university), department_codes.value(department))
+
+def bucket_codes(names):
+    track, university, department = names
+    return (track_codes.code(track), university_codes.code(university), department_codes.code(department))
+
+def queue_member(state, member):
+    member.topic_mask = topic_mask(member.track_name, member.topics)
+    # Members order themselves by rating, registration time and user_id
+    heapq.heappush(state.member_index[bucket_key(member)], member)
+
+def pop_best_member(state, track, university, department):
+    key = (track, university, department)
+    member_index = state.member_index
+    heap = member_index.get(key)
+    matching_member = None
+    while heap:
+        member = heapq.heappop(heap)
+        # Entries of users who are no longer registered are dropped lazily
+        if member.user_id in state.registered_users:
+            matching_member = member
+            break
+    if key in member_index and not member_index[key]:
+        del member_index[key]
+    return matching_member
+
+def pop_best_member_for(state, key, leader):
+    # Leaders without needed topics take the top of the heap. Otherwise the
+    # bucket is ranked by coverage of the leader's needed topics, then rating
+    # and registration time; one integer AND per candidate.
+    needed_mask = leader.needed_mask
+    if not needed_mask:
+        return pop_best_member(state, *key)
+
+    heap = state.member_index.get(key)
+    if not heap:
+        return None
+    registered_users = state.registered_users
+    track = track_codes.value(key[0])
+    best_index = None
+    best_rank = None
+    for index, member in enumerate(heap):
+        if member.user_id not in registered_users:
+            continue
+        rank = (-gap_coverage(track, needed_mask, member.topic_mask), -member.rating, member.registration_time)
+        if best_rank is None or rank < best_rank:
+            best_index, best_rank = index, rank
+    if best_index is None:
+        return pop_best_member(state, *key)  # Only stale entries left, clear them out
+
+    matching_member = heap[best_index]
+    heap[best_index] = heap[-1]
+    heap.pop()
+    heapq.heapify(heap)
+    if not heap:
+        del state.member_index[key]
+    return matching_member
+
+def queue_leader(state, leader):
+    leader.needed_mask = topic_mask(leader.track_name, leader.desired)
+    state.leader_index[bucket_key(leader)].append(leader)
+
+def remove_leader(state, key, leader_id):
+    remaining = [leader for leader in state.leader_index.get(key, []) if leader.user_id != leader_id]
+    if remaining:
+        state.leader_index[key] = remaining
+    else:
+        state.leader_index.pop(key, None)
+
+# Registrations, withdrawals and failed deliveries mark their bucket dirty so
+# the matcher only revisits the buckets that can produce a new match, and
+# make the guild due on the next auto_match cycle.
+def mark_dirty(state, key):
+    state.dirty_buckets.add(key)
+    state.next_match_at = 0.0
+
+# Queue depth is computed when metrics are scraped rather than on every change
+def queue_depth_samples():
+    for state in list(guild_states.values()):
+        member_depth = defaultdict(int)
+        leader_depth = defaultdict(int)
+        for (track, university, department), heap in state.member_index.items():
+            member_depth[track] += sum(1 for member in heap if member.user_id in state.registered_users)
+        for (track, university, department), leader_list in state.leader_index.items():
+            leader_depth[track] += len(leader_list)
+        guild = str(state.guild_id)
+        for track, depth in member_depth.items():
+            yield 'bot_queue_members', {'guild': guild, 'track': track_codes.value(track)}, depth
+        for track, depth in leader_depth.items():
+            yield 'bot_queue_leaders', {'guild': guild, 'track': track_codes.value(track)}, depth
+
+def session_samples():
+    for state in list(guild_states.values()):
+        guild = str(state.guild_id)
+        yield 'bot_registration_sessions', {'guild': guild}, len(state.user_data)
+        for reason, count in state.user_data.evictions.items():
+            yield 'bot_registration_session_evictions_total', {'guild': guild, 'reason': reason}, count
+    yield 'bot_conversation_prompts', {}, len(conversations.pending)
+    yield 'bot_guilds_loaded', {}, len(guild_states)
+
+def resolver_samples():
+    for counter, value in resolver_stats.items():
+        yield 'bot_resolver_cache', {'counter': counter}, value
+
+metrics.collectors.append(queue_depth_samples)
+metrics.collectors.append(resolver_samples)
+metrics.collectors.append(session_samples)
+
+# State mutations
+# Every change that must survive a restart goes through record_event, which
+# applies it to the guild's state in memory and appends one record to that
+# guild's journal. load_data replays the same records on top of the last
+# snapshot.
+DATA_FILE = 'bot_data.json'
+JOURNAL_FILE = 'bot_journal.jsonl'
+JOURNAL_COMPACT_THRESHOLD = 1000  # Journal records before they are folded into the snapshot
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")  # "json" (snapshot + journal) or "sqlite"
+
+# Matching ownership
+# With PROCESS_COUNT > 1, several bot processes share one SQLite database and
+# every track is matched by exactly one of them, chosen by a stable hash of
+# its name. Registrations are written to the database by whichever process
+# receives them, and the owner picks them up from the registration feed at
+# the start of each matching cycle.
+PROCESS_INDEX = int(os.getenv("PROCESS_INDEX", "0"))
+PROCESS_COUNT = int(os.getenv("PROCESS_COUNT", "1"))
+SHARED_QUEUE = PROCESS_COUNT > 1
+
+if not 0 <= PROCESS_INDEX < PROCESS_COUNT:
+    logger.error(f"PROCESS_INDEX must be between 0 and PROCESS_COUNT - 1, got {PROCESS_INDEX} with PROCESS_COUNT {PROCESS_COUNT}")
+    sys.exit(1)
+
+if SHARED_QUEUE and not SHARD_IDS:
+    # Without a shard split every process receives every message, so each one
+    # would register the same user and the owner would queue them twice
+    logger.error("PROCESS_COUNT > 1 needs SHARD_COUNT and SHARD_IDS, so each process receives only its own shards")
+    sys.exit(1)
+
+if SHARED_QUEUE and STORAGE_BACKEND != 'sqlite':
+    logger.warning("PROCESS_COUNT > 1 needs the shared SQLite store, switching STORAGE_BACKEND to sqlite")
+    STORAGE_BACKEND = 'sqlite'
+
+def owns_track(track):
+    return zlib.crc32(track.encode('utf-8')) % PROCESS_COUNT == PROCESS_INDEX
+SQLITE_PATH = os.getenv("SQLITE_PATH", "bot_data.db")
+
+# Guild files
+# Each guild keeps its snapshot, journal and database in
+# GUILD_DATA_DIR/<guild_id>/. LEGACY_GUILD_ID names the guild that keeps the
+# top-level files written before state was split per guild; without it those
+# files are moved to the bot's only guild at startup (adopt_legacy_files).
+GUILD_DATA_DIR = os.getenv("GUILD_DATA_DIR", "guilds")
+LEGACY_GUILD_ID = int(os.getenv("LEGACY_GUILD_ID")) if os.getenv("LEGACY_GUILD_ID") else None
+
+def guild_paths(guild_id):
+    if guild_id == LEGACY_GUILD_ID:
+        return DATA_FILE, JOURNAL_FILE, SQLITE_PATH
+    directory = os.path.join(GUILD_DATA_DIR, str(guild_id))
+    os.makedirs(directory, exist_ok=True)
+    return (
+        os.path.join(directory, DATA_FILE),
+        os.path.join(directory, JOURNAL_FILE),
+        os.path.join(directory, os.path.basename(SQLITE_PATH))
+    )
+
+def legacy_files():
+    paths = [DATA_FILE, JOURNAL_FILE, SQLITE_PATH] + [path for seq, path in journal_segments(JOURNAL_FILE)]
+    return [path for path in paths if os.path.exists(path)]
+
+def migrate_legacy_files(guild_id):
+    data_file, journal_file, sqlite_path = guild_paths(guild_id)
+    moves = [(DATA_FILE, data_file), (JOURNAL_FILE, journal_file)]
+    moves += [(path, f"{journal_file}.{seq}") for seq, path in journal_segments(JOURNAL_FILE)]
+    moves += [(SQLITE_PATH + suffix, sqlite_path + suffix) for suffix in ('', '-wal', '-shm')]
+    moves = [(source, target) for source, target in moves if os.path.exists(source)]
+    if any(os.path.exists(target) for source, target in moves):
+        raise RuntimeError(
+            f"Cannot move the top-level data files to {os.path.dirname(data_file)}, it already has data; "
+            f"set LEGACY_GUILD_ID to the server they belong to"
+        )
+    for source, target in moves:
+        os.replace(source, target)
+    logger.info(f"Moved {', '.join(source for source, target in moves)} to {os.path.dirname(data_file)}")
+
+def stored_guild_ids():
+    # Guilds with files on disk, so their queues are restored at startup
+    guild_ids = []
+    if LEGACY_GUILD_ID is not None and legacy_files():
+        guild_ids.append(LEGACY_GUILD_ID)
+    if os.path.isdir(GUILD_DATA_DIR):
+        for name in sorted(os.listdir(GUILD_DATA_DIR)):
+            directory = os.path.join(GUILD_DATA_DIR, name)
+            if name.isdigit() and os.path.isdir(directory) and os.listdir(directory):
+                guild_ids.append(int(name))
+    return guild_ids
+
+def apply_event(state, op, fields):
+    if op == 'register_member':
+        state.registered_users.add(fields['member']['user_id'])
+        # With a shared queue the owning process queues it from the registration feed
+        if not state.queue_from_feed:
+            member = Member.from_dict(fields['member'])
+            queue_member(state, member)
+            mark_dirty(state, bucket_key(member))
+    elif op == 'register_leader':
+        if not state.queue_from_feed:
+            leader = Leader.from_dict(fields['leader'])
+            queue_leader(state, leader)
+            mark_dirty(state, bucket_key(leader))
+    elif op == 'match':
+        leader_id = fields['leader_id']
+        member_id = fields['member_id']
+        remove_leader(state, bucket_codes(fields['bucket']), leader_id)
+        state.user_data.pop(leader_id, None)
+        state.user_data.pop(member_id, None)
+        state.registered_users.discard(member_id)
+        # With SQLite the match history stays in the database instead of RAM
+        if state.keep_match_history:
+            state.matched_members.add(member_id)
+        state.leader_departments.pop(leader_id, None)
+    elif op == 'unreachable':
+        # Discord refused to deliver a match message, so the user leaves the queue
+        user_id = fields['user_id']
+        if fields['role'] == 'leader':
+            remove_leader(state, bucket_codes(fields['bucket']), user_id)
+            state.leader_departments.pop(user_id, None)
+        else:
+            state.registered_users.discard(user_id)
+        state.user_data.pop(user_id, None)
+    elif op == 'leader_lock':
+        state.leader_departments[fields['user_id']] = {
+            'department': fields['department'],
+            'university': fields['university']
+        }
+    elif op == 'session_clear':
+        state.user_data.pop(fields['user_id'], None)
+    else:
+        raise ValueError(f"Unknown journal operation: {op}")
+
+def journal_append(state, op, fields):
+    state.journal_seq += 1
+    record = {'seq': state.journal_seq, 'op': op, **fields}
+    with metrics.timer('bot_journal_append_seconds'):
+        with open(state.journal_file, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+    state.journal_records += 1
+    if state.journal_records >= JOURNAL_COMPACT_THRESHOLD:
+        save_data(state)
+
+def record_event(state, op, **fields):
+    apply_event(state, op, fields)
+    try:
+        if STORAGE_BACKEND == 'sqlite':
+            # Writes are queued on the single database thread, in event order
+            future = db_executor.submit(state.sqlite_store.write_event, op, fields)
+            future.add_done_callback(log_db_error)
+        else:
+            journal_append(state, op, fields)
+    except Exception as e:
+        logger.error(f"Error writing journal record {op}: {str(e)}")
+
+# save_data rotates the journal to <journal file>.<last seq> when it takes a
+# snapshot; the writer deletes the rotated segments once the snapshot that
+# covers them is on disk.
+def journal_segments(journal_file):
+    directory = os.path.dirname(journal_file) or '.'
+    prefix = os.path.basename(journal_file) + '.'
+    segments = []
+    for name in os.listdir(directory):
+        suffix = name[len(prefix):]
+        if name.startswith(prefix) and suffix.isdigit():
+            segments.append((int(suffix), os.path.join(directory, name)))
+    return sorted(segments)
+
+def replay_journal(state, snapshot_seq):
+    state.journal_seq = snapshot_seq
+    state.journal_records = 0
+
+    replayed = 0
+    paths = [path for last_seq, path in journal_segments(state.journal_file) if last_seq > snapshot_seq]
+    for path in paths + [state.journal_file]:
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A crash mid-append leaves at most one torn record at the tail
+                    logger.warning("Skipping unreadable journal record")
+                    continue
+                seq = record.pop('seq')
+                op = record.pop('op')
+                state.journal_records += 1
+                if seq <= snapshot_seq:
+                    continue  # Already folded into the snapshot
+                apply_event(state, op, record)
+                state.journal_seq = seq
+                replayed += 1
+    return replayed
+
+# Background snapshot writer
+# Encoding and writing snapshots happens on a dedicated thread so a large
+# state file never stalls the event loop. One thread serves every guild:
+# snapshots of the same guild submitted within SAVE_WINDOW seconds of each
+# other are merged and only the newest is written.
+SAVE_WINDOW = float(os.getenv("SAVE_WINDOW_SECONDS", "2"))
+
+class SnapshotWriter:
+    def __init__(self, window):
+        self.window = window
+        self.condition = threading.Condition()
+        self.pending = {}  # data_file -> (guild_id, journal_file, data, journal_seq) waiting to be written
+        self.writing = False
+        self.flushing = False
+        self.thread = None
+        self.submitted = 0
+        self.written = 0
+
+    def submit(self, guild_id, data_file, journal_file, data, seq):
+        with self.condition:
+            self.pending[data_file] = (guild_id, journal_file, data, seq)
+            self.submitted += 1
+            self.condition.notify_all()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="snapshot-writer", daemon=True)
+                self.thread.start()
+
+    def flush(self):
+        # Writes the pending snapshots now and waits until they are on disk
+        with self.condition:
+            self.flushing = True
+            self.condition.notify_all()
+            while self.pending or self.writing:
+                self.condition.wait()
+            self.flushing = False
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                # Give the rest of a burst time to arrive, flush cuts this short
+                deadline = time.monotonic() + self.window
+                while not self.flushing:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch = self.pending
+                self.pending = {}
+                self.writing = True
+            try:
+                for data_file, (guild_id, journal_file, data, seq) in batch.items():
+                    try:
+                        self._write(guild_id, data_file, journal_file, data, seq)
+                    except Exception as e:
+                        logger.error(f"Error saving data: {str(e)}")
+            finally:
+                with self.condition:
+                    self.writing = False
+                    self.condition.notify_all()
+
+    def _write(self, guild_id, data_file, journal_file, data, seq):
+        start_time = time.perf_counter()
+        # Write to a temporary file and rename it over the snapshot so a crash
+        # never leaves a truncated bot_data.json behind
+        tmp_file = data_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(data, f, default=str)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, data_file)
+
+        # Everything up to seq is now in the snapshot
+        for last_seq, path in journal_segments(journal_file):
+            if last_seq <= seq:
+                os.remove(path)
+        self.written += 1
+        metrics.observe('bot_save_seconds', time.perf_counter() - start_time)
+        metrics.set('bot_save_bytes', os.path.getsize(data_file), guild=str(guild_id))
+        logger.info(f"Data saved successfully to {data_file}")
 
-# Data structures to store members and leaders
-members = defaultdict(list)
-leaders = defaultdict(list)
-user_data = {}
-registered_users = set()
-user_track_registrations = {}
-matched_members = set()  # New set to track matched members
-leader_departments = {}  # New dictionary to store leaders' departments
+snapshot_writer = SnapshotWriter(SAVE_WINDOW)
 
 # Data storage functions
-def save_data():
+# save_data captures a snapshot of a guild's in-memory state and hands it to
+# the snapshot writer, so it doubles as the compaction step without blocking
+# on file I/O. flush_state waits for queued writes, e.g. before shutting down.
+def save_data(state):
+    if STORAGE_BACKEND == 'sqlite':
+        # Everything but in-progress sessions is already written per event
+        future = db_executor.submit(state.sqlite_store.save_sessions, serialize_sessions(state))
+        future.add_done_callback(log_db_error)
+        return
     try:
-        # Convert member tuples to serializable format
+        # Convert member records to serializable format
         serialized_members = {}
-        for track, member_list in members.items():
-            serialized_members[track] = []
-            for rating, reg_time, member in member_list:
-                # Store user ID and name instead of User object
-                serialized_member = {
-                    'user_id': member.get('user_id') or member['user'].id,  # Handle both new and old format
-                    'user_name': member.get('user_name') or member['user'].name,  # Handle both new and old format
-                    'track': member['track'],
-                    'rating': member['rating'],
-                    'comment': member['comment'],
-                    'department': member['department'],
-                    'university': member['university'],
-                    'selected_topics': member['selected_topics'],
-                    'registration_time': member['registration_time']
-                }
-                serialized_members[track].append((rating, reg_time, serialized_member))
-
-        # Convert leaders to serializable format
+        for member in queued_members(state):
+            serialized_members.setdefault(member.track_name, []).append(
+                (-member.rating, member.registration_time, member.to_dict())
+            )
+
+        # Convert leader records to serializable format
         serialized_leaders = {}
-        for track, leader_list in leaders.items():
-            serialized_leaders[track] = []
-            for leader in leader_list:
-                # Store user ID and name instead of User object
-                serialized_leader = {
-                    'user_id': leader.get('user_id') or leader['user'].id,  # Handle both new and old format
-                    'user_name': leader.get('user_name') or leader['user'].name,  # Handle both new and old format
-                    'team_name': leader['team_name'],
-                    'track': leader['track'],
-                    'team_comment': leader['team_comment'],
-                    'department': leader['department'],
-                    'university': leader['university']
-                }
-                serialized_leaders[track].append(serialized_leader)
+        for (track, university, department), leader_list in state.leader_index.items():
+            serialized_leaders.setdefault(track_codes.value(track), []).extend(leader.to_dict() for leader in leader_list)
 
         data = {
             'members': serialized_members,
             'leaders': serialized_leaders,
-            'user_data': user_data,
-            'registered_users': list(registered_users),
-            'matched_members': list(matched_members),
-            'leader_departments': leader_departments
+            'user_data': state.user_data.snapshot(),
+            'registered_users': list(state.registered_users),
+            'matched_members': list(state.matched_members),
+            'leader_departments': dict(state.leader_departments),
+            'journal_seq': state.journal_seq
         }
-        
-        with open('bot_data.json', 'w') as f:
-            json.dump(data, f, default=str)
-        logger.info("Data saved successfully")
+
+        # Records after this point go to a fresh journal file
+        if os.path.exists(state.journal_file) and state.journal_records:
+            os.replace(state.journal_file, f"{state.journal_file}.{state.journal_seq}")
+        state.journal_records = 0
+        snapshot_writer.submit(state.guild_id, state.data_file, state.journal_file, data, state.journal_seq)
 
     except Exception as e:
         logger.error(f"Error saving data: {str(e)}")
 
-def load_data():
+def save_all():
+    for state in list(guild_states.values()):
+        save_data(state)
+
+def flush_state():
+    if STORAGE_BACKEND == 'sqlite':
+        # The database thread runs writes in order, so a no-op waits for all of them
+        db_executor.submit(lambda: None).result()
+    else:
+        snapshot_writer.flush()
+
+def load_data(state):
     try:
-        if os.path.exists('bot_data.json'):
-            with open('bot_data.json', 'r') as f:
+        snapshot_seq = 0
+        snapshot_writer.flush()  # Read back what this process already saved
+
+        if os.path.exists(state.data_file):
+            with open(state.data_file, 'r') as f:
                 data = json.load(f)
-            
-            # Restore data structures
-            global members, leaders, user_data, registered_users, matched_members, leader_departments
-            
+
+            state.user_data.load({int(user_id): session for user_id, session in data['user_data'].items()})
+            state.registered_users = set(data['registered_users'])
+            state.matched_members = set(data['matched_members'])
+            state.leader_departments = {int(user_id): lock for user_id, lock in data['leader_departments'].items()}
+            snapshot_seq = data.get('journal_seq', 0)
+
             # Restore members
-            members = defaultdict(list)
+            state.member_index = defaultdict(list)
             for track, member_list in data['members'].items():
                 for rating, reg_time, member_dict in member_list:
-                    # Store just the raw data - we'll get the User object when needed
-                    member = {
-                        'user_id': member_dict['user_id'],
-                        'user_name': member_dict['user_name'],
-                        'track': member_dict['track'],
-                        'rating': member_dict['rating'],
-                        'comment': member_dict['comment'],
-                        'department': member_dict['department'],
-                        'university': member_dict['university'],
-                        'selected_topics': member_dict['selected_topics'],
-                        'registration_time': member_dict['registration_time']
-                    }
-                    members[track].append((rating, reg_time, member))
-            
+                    queue_member(state, Member.from_dict(member_dict))
+
             # Restore leaders
-            leaders = defaultdict(list)
+            state.leader_index = defaultdict(list)
             for track, leader_list in data['leaders'].items():
                 for leader_dict in leader_list:
-                    # Store just the raw data
-                    leader = {
-                        'user_id': leader_dict['user_id'],
-                        'user_name': leader_dict['user_name'],
-                        'team_name': leader_dict['team_name'],
-                        'track': leader_dict['track'],
-                        'team_comment': leader_dict['team_comment'],
-                        'department': leader_dict['department'],
-                        'university': leader_dict['university']
-                    }
-                    leaders[track].append(leader)
-            
-            user_data = data['user_data']
-            registered_users = set(data['registered_users'])
-            matched_members = set(data['matched_members'])
-            leader_departments = data['leader_departments']
-            
-            logger.info("Data loaded successfully")
+                    queue_leader(state, Leader.from_dict(leader_dict))
+
+        # Apply everything recorded after the snapshot was taken
+        replayed = replay_journal(state, snapshot_seq)
+
+        # Every bucket with a waiting leader gets one pass after a restart
+        state.dirty_buckets.update(state.leader_index.keys())
+
+        logger.info(f"Data loaded successfully from {state.data_file} ({replayed} journal records replayed)")
     except Exception as e:
         logger.error(f"Error loading data: {str(e)}")
 
+# Periodically fold the journal into the snapshot
+@tasks.loop(minutes=10)
+async def compact_journal():
+    for state in list(guild_states.values()):
+        if STORAGE_BACKEND == 'sqlite':
+            await run_db(state.sqlite_store.save_sessions, serialize_sessions(state))
+        elif state.journal_records:
+            save_data(state)
+
+# SQLite storage backend
+# Optional replacement for the JSON snapshot and journal. Queued members and
+# leaders are still held in the in-memory bucket indexes, but match history
+# only lives in the database, so memory tracks the active queue rather than
+# every registration ever made. All calls run on one worker thread.
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS members (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    user_name TEXT,
+    track TEXT NOT NULL,
+    university TEXT NOT NULL,
+    department TEXT NOT NULL,
+    rating INTEGER NOT NULL,
+    comment TEXT,
+    selected_topics TEXT,
+    registration_time REAL NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    matched_at REAL
+);
+CREATE INDEX IF NOT EXISTS members_user ON members (user_id, status);
+CREATE INDEX IF NOT EXISTS members_bucket ON members (track, university, department, status, rating DESC, registration_time);
+CREATE INDEX IF NOT EXISTS members_matched ON members (matched_at);
+
+CREATE TABLE IF NOT EXISTS leaders (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    user_name TEXT,
+    team_name TEXT,
+    track TEXT NOT NULL,
+    university TEXT NOT NULL,
+    department TEXT NOT NULL,
+    team_comment TEXT,
+    desired_topics TEXT,
+    status TEXT NOT NULL DEFAULT 'queued',
+    matched_at REAL
+);
+CREATE INDEX IF NOT EXISTS leaders_user ON leaders (user_id, status);
+CREATE INDEX IF NOT EXISTS leaders_bucket ON leaders (track, university, department, status, id);
+
+CREATE TABLE IF NOT EXISTS leader_departments (
+    user_id INTEGER PRIMARY KEY,
+    university TEXT,
+    department TEXT
+);
+
+CREATE TABLE IF NOT EXISTS sessions (
+    user_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL,
+    process INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+class SQLiteStore:
+    def __init__(self, path, process_index=0):
+        self.path = path
+        self.process_index = process_index  # Each process saves and loads only its own sessions
+        self.conn = None
+
+    def connect(self):
+        # Only the db_executor thread touches the connection
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SQLITE_SCHEMA)
+        # Databases created before leaders could declare needed topics
+        leader_columns = {row[1] for row in self.conn.execute("PRAGMA table_info(leaders)")}
+        if 'desired_topics' not in leader_columns:
+            self.conn.execute("ALTER TABLE leaders ADD COLUMN desired_topics TEXT")
+        # Databases created before sessions were kept per process
+        session_columns = {row[1] for row in self.conn.execute("PRAGMA table_info(sessions)")}
+        if 'process' not in session_columns:
+            self.conn.execute("ALTER TABLE sessions ADD COLUMN process INTEGER NOT NULL DEFAULT 0")
+        self.conn.commit()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def is_empty(self):
+        for table in ('members', 'leaders', 'leader_departments', 'sessions'):
+            if self.conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone():
+                return False
+        return True
+
+    def _insert_member(self, member):
+        self.conn.execute(
+            "INSERT INTO members (user_id, user_name, track, university, department, rating, comment, "
+            "selected_topics, registration_time) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (member['user_id'], member['user_name'], member['track'], member['university'],
+             member['department'], member['rating'], member['comment'],
+             json.dumps(member['selected_topics']), member['registration_time'])
+        )
+
+    def _insert_leader(self, leader):
+        self.conn.execute(
+            "INSERT INTO leaders (user_id, user_name, team_name, track, university, department, team_comment, "
+            "desired_topics) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (leader['user_id'], leader['user_name'], leader['team_name'], leader['track'],
+             leader['university'], leader['department'], leader['team_comment'],
+             json.dumps(leader.get('desired_topics', [])))
+        )
+
+    def write_event(self, op, fields):
+        with self.conn:
+            if op == 'register_member':
+                self._insert_member(fields['member'])
+            elif op == 'register_leader':
+                self._insert_leader(fields['leader'])
+            elif op == 'match':
+                track, university, department = fields['bucket']
+                now = time.time()
+                self.conn.execute(
+                    "UPDATE members SET status = 'matched', matched_at = ? WHERE user_id = ? AND status = 'queued'",
+                    (now, fields['member_id'])
+                )
+                self.conn.execute(
+                    "UPDATE leaders SET status = 'matched', matched_at = ? WHERE user_id = ? AND track = ? "
+                    "AND university = ? AND department = ? AND status = 'queued'",
+                    (now, fields['leader_id'], track, university, department)
+                )
+                self.conn.execute("DELETE FROM sessions WHERE user_id IN (?, ?)", (fields['leader_id'], fields['member_id']))
+                self.conn.execute("DELETE FROM leader_departments WHERE user_id = ?", (fields['leader_id'],))
+            elif op == 'unreachable':
+                # matched_at is when a row left the queue, the registration feed releases it from then on
+                track, university, department = fields['bucket']
+                now = time.time()
+                if fields['role'] == 'leader':
+                    self.conn.execute(
+                        "UPDATE leaders SET status = 'unreachable', matched_at = ? WHERE user_id = ? AND track = ? "
+                        "AND university = ? AND department = ? AND status = 'queued'",
+                        (now, fields['user_id'], track, university, department)
+                    )
+                    self.conn.execute("DELETE FROM leader_departments WHERE user_id = ?", (fields['user_id'],))
+                else:
+                    self.conn.execute(
+                        "UPDATE members SET status = 'unreachable', matched_at = ? WHERE user_id = ? AND status = 'queued'",
+                        (now, fields['user_id'])
+                    )
+                self.conn.execute("DELETE FROM sessions WHERE user_id = ?", (fields['user_id'],))
+            elif op == 'leader_lock':
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO leader_departments (user_id, university, department) VALUES (?, ?, ?)",
+                    (fields['user_id'], fields['university'], fields['department'])
+                )
+            elif op == 'session_clear':
+                self.conn.execute("DELETE FROM sessions WHERE user_id = ?", (fields['user_id'],))
+            else:
+                raise ValueError(f"Unknown journal operation: {op}")
+
+    def save_sessions(self, rows):
+        with metrics.timer('bot_save_seconds'), self.conn:
+            self.conn.execute("DELETE FROM sessions WHERE process = ?", (self.process_index,))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO sessions (user_id, data, process) VALUES (?, ?, ?)",
+                [(user_id, data, self.process_index) for user_id, data in rows]
+            )
+
+    MEMBER_COLUMNS = (
+        "user_id, user_name, track, rating, comment, department, university, selected_topics, registration_time"
+    )
+    LEADER_COLUMNS = "user_id, user_name, team_name, track, team_comment, department, university, desired_topics"
+
+    @staticmethod
+    def _member_dict(row):
+        return {
+            'user_id': row[0],
+            'user_name': row[1],
+            'track': row[2],
+            'rating': row[3],
+            'comment': row[4],
+            'department': row[5],
+            'university': row[6],
+            'selected_topics': json.loads(row[7] or '[]'),
+            'registration_time': row[8]
+        }
+
+    @staticmethod
+    def _leader_dict(row):
+        return {
+            'user_id': row[0],
+            'user_name': row[1],
+            'team_name': row[2],
+            'track': row[3],
+            'team_comment': row[4],
+            'department': row[5],
+            'university': row[6],
+            'desired_topics': json.loads(row[7] or '[]')
+        }
+
+    def load(self):
+        members_rows = self.conn.execute(
+            f"SELECT {self.MEMBER_COLUMNS} FROM members WHERE status = 'queued'"
+        ).fetchall()
+        leader_rows = self.conn.execute(
+            f"SELECT {self.LEADER_COLUMNS} FROM leaders WHERE status = 'queued' ORDER BY id"
+        ).fetchall()
+        lock_rows = self.conn.execute("SELECT user_id, university, department FROM leader_departments").fetchall()
+        session_rows = self.conn.execute("SELECT user_id, data FROM sessions WHERE process = ?", (self.process_index,)).fetchall()
+        
+        loaded_members = [self._member_dict(row) for row in members_rows]
+        loaded_leaders = [self._leader_dict(row) for row in leader_rows]
+        locks = {row[0]: {'department': row[2], 'university': row[1]} for row in lock_rows}
+        sessions = {row[0]: json.loads(row[1]) for row in session_rows}
+        return loaded_members, loaded_leaders, locks, sessions
+
+    def registration_feed(self, tracks, cursor):
+        # Queued members and leaders of the given tracks added since the
+        # cursor, by any process, plus users matched since the cursor and the
+        # current leader locks of the matched leaders
+        last_member_id, last_leader_id, last_matched_at = cursor
+        member_max = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM members").fetchone()[0]
+        leader_max = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM leaders").fetchone()[0]
+        track_filter = ", ".join("?" * len(tracks))
+        members_rows = self.conn.execute(
+            f"SELECT {self.MEMBER_COLUMNS} FROM members WHERE id > ? AND id <= ? AND status = 'queued' "
+            f"AND track IN ({track_filter}) ORDER BY id",
+            (last_member_id, member_max, *tracks)
+        ).fetchall()
+        leader_rows = self.conn.execute(
+            f"SELECT {self.LEADER_COLUMNS} FROM leaders WHERE id > ? AND id <= ? AND status = 'queued' "
+            f"AND track IN ({track_filter}) ORDER BY id",
+            (last_leader_id, leader_max, *tracks)
+        ).fetchall()
+        matched_rows = self.conn.execute(
+            "SELECT user_id, matched_at FROM members WHERE matched_at > ? ORDER BY matched_at",
+            (last_matched_at,)
+        ).fetchall()
+        matched_leader_rows = self.conn.execute(
+            "SELECT user_id, matched_at FROM leaders WHERE matched_at > ? ORDER BY matched_at",
+            (last_matched_at,)
+        ).fetchall()
+        # A matched leader may have registered again since, so the lock is
+        # read back rather than assumed gone
+        locks = {row[0]: None for row in matched_leader_rows}
+        if locks:
+            leader_filter = ", ".join("?" * len(locks))
+            for user_id, university, department in self.conn.execute(
+                f"SELECT user_id, university, department FROM leader_departments WHERE user_id IN ({leader_filter})",
+                tuple(locks)
+            ):
+                locks[user_id] = {'department': department, 'university': university}
+        matched_at = max([last_matched_at] + [row[1] for row in matched_rows + matched_leader_rows])
+        return (
+            [self._member_dict(row) for row in members_rows],
+            [self._leader_dict(row) for row in leader_rows],
+            [row[0] for row in matched_rows],
+            locks,
+            (member_max, leader_max, matched_at)
+        )
+
+    def import_state(self, queued_members, queued_leaders, locks, sessions, history):
+        # One-off import of the JSON snapshot and journal into an empty database
+        with self.conn:
+            for member in queued_members:
+                self._insert_member(member)
+            for leader in queued_leaders:
+                self._insert_leader(leader)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO leader_departments (user_id, university, department) VALUES (?, ?, ?)",
+                [(user_id, lock['university'], lock['department']) for user_id, lock in locks.items()]
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO sessions (user_id, data, process) VALUES (?, ?, ?)",
+                [(user_id, data, self.process_index) for user_id, data in sessions]
+            )
+            # Matched members from the JSON format only carry their id
+            self.conn.executemany(
+                "INSERT INTO members (user_id, track, university, department, rating, registration_time, status) "
+                "VALUES (?, '', '', '', 0, 0, 'matched')",
+                [(user_id,) for user_id in history]
+            )
+
+db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+def log_db_error(future):
+    if future.exception():
+        logger.error(f"SQLite write failed: {future.exception()}")
+
+async def run_db(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(db_executor, func, *args)
+
+def serialize_sessions(state):
+    # Reads through snapshot, a save is not activity and must not keep idle sessions alive
+    return [(user_id, json.dumps(session, default=str)) for user_id, session in state.user_data.snapshot().items()]
+
+def queued_members(state):
+    # Members popped for a notification still being delivered count as queued
+    # until their match is recorded, so a snapshot never loses them
+    return [
+        member
+        for members in (*state.member_index.values(), state.in_flight.values())
+        for member in members
+        if member.user_id in state.registered_users
+    ]
+
+async def load_sqlite_data(state):
+    store = state.sqlite_store
+    try:
+        await run_db(store.connect)
+
+        # First start on SQLite: import the existing JSON snapshot and journal
+        if await run_db(store.is_empty) and (os.path.exists(state.data_file) or os.path.exists(state.journal_file)):
+            # Matches in the journal tail are replayed into the imported history too
+            state.keep_match_history = True
+            load_data(state)
+            state.keep_match_history = False
+            await run_db(
+                store.import_state,
+                [member.to_dict() for member in queued_members(state)],
+                [leader.to_dict() for leader_list in state.leader_index.values() for leader in leader_list],
+                dict(state.leader_departments),
+                serialize_sessions(state),
+                list(state.matched_members)
+            )
+            state.matched_members.clear()
+            logger.info(f"Imported {state.data_file} into {state.sqlite_path}")
+            if SHARED_QUEUE:
+                await start_registration_feed(state)
+            return
+
+        loaded_members, loaded_leaders, locks, sessions = await run_db(store.load)
+        state.member_index = defaultdict(list)
+        state.leader_index = defaultdict(list)
+        state.registered_users = set()
+        for member_dict in loaded_members:
+            state.registered_users.add(member_dict['user_id'])
+            if not SHARED_QUEUE:
+                queue_member(state, Member.from_dict(member_dict))
+        if not SHARED_QUEUE:
+            for leader_dict in loaded_leaders:
+                queue_leader(state, Leader.from_dict(leader_dict))
+        state.leader_departments = locks
+        state.user_data.load(sessions)
+
+        if SHARED_QUEUE:
+            await start_registration_feed(state)
+
+        # Every bucket with a waiting leader gets one pass after a restart
+        state.dirty_buckets.update(state.leader_index.keys())
+        logger.info(f"Data loaded successfully from {state.sqlite_path}")
+    except Exception as e:
+        logger.error(f"Error loading data: {str(e)}")
+
+# Registration feed
+# With a shared queue each process only queues the tracks it owns, and it
+# reads them from the database rather than from its own commands, so
+# registrations received by any process arrive the same way. The owner polls
+# the feed at the start of every matching pass.
+def owned_tracks():
+    return [track for track in track_codes.values if owns_track(track)]
+
+async def start_registration_feed(state):
+    # Queued rows are read from the beginning, matches only from now on
+    state.member_index = defaultdict(list)
+    state.leader_index = defaultdict(list)
+    state.feed_cursor = (0, 0, time.time())
+    state.queue_from_feed = True
+    queued = await poll_registration_feed(state)
+    logger.info(
+        f"Process {PROCESS_INDEX}/{PROCESS_COUNT} owns {len(owned_tracks())} tracks in guild {state.guild_id}, "
+        f"{queued} registrations queued"
+    )
+
+async def poll_registration_feed(state):
+    members, leaders, matched, locks, state.feed_cursor = await run_db(
+        state.sqlite_store.registration_feed, owned_tracks(), state.feed_cursor
+    )
+    # Matches made by other processes free their members to register again
+    # and release the department locks of their leaders
+    for user_id in matched:
+        state.registered_users.discard(user_id)
+    for user_id, lock in locks.items():
+        if lock is None:
+            state.leader_departments.pop(user_id, None)
+        else:
+            state.leader_departments[user_id] = lock
+    for member_dict in members:
+        member = Member.from_dict(member_dict)
+        queue_member(state, member)
+        state.registered_users.add(member.user_id)
+        mark_dirty(state, bucket_key(member))
+    for leader_dict in leaders:
+        leader = Leader.from_dict(leader_dict)
+        queue_leader(state, leader)
+        mark_dirty(state, bucket_key(leader))
+    return len(members) + len(leaders)
+
+# Guild loading and eviction
+# get_guild_state is the only way commands reach a guild's state. The first
+# call in a guild loads its files; concurrent first calls share one load.
+# Every call counts as activity for the idle eviction in maintenance, except
+# for guilds on a shared queue, which stay loaded (see auto_match).
+GUILD_IDLE_TTL = int(os.getenv("GUILD_IDLE_TTL_SECONDS", "3600"))  # Idle seconds before a guild is unloaded
+PRELOAD_GUILD_IDS = [int(guild_id) for guild_id in os.getenv("PRELOAD_GUILD_IDS", "").split(",") if guild_id.strip()]
+guild_states = {}  # guild_id -> loaded GuildState
+guild_loads = {}  # guild_id -> task loading that guild
+
+async def load_guild(guild_id):
+    start_time = time.perf_counter()
+    state = GuildState(guild_id)
+    if STORAGE_BACKEND == 'sqlite':
+        await load_sqlite_data(state)
+    else:
+        # Everything loaded here is long lived, so collections while it is
+        # being built would only rescan it. load_data does not yield, so the
+        # collector is paused for this guild's load only
+        gc.disable()
+        try:
+            load_data(state)
+        finally:
+            gc.enable()
+    # Stored ratings may predate a topic score change
+    await rerate_guild(state)
+    guild_states[guild_id] = state
+    metrics.observe('bot_guild_load_seconds', time.perf_counter() - start_time)
+    return state
+
+def start_guild_load(guild_id):
+    loading = guild_loads.get(guild_id)
+    if loading is None:
+        loading = guild_loads[guild_id] = asyncio.ensure_future(load_guild(guild_id))
+        loading.add_done_callback(lambda _: guild_loads.pop(guild_id, None))
+    return loading
+
+async def get_guild_state(guild_id):
+    state = guild_states.get(guild_id)
+    if state is None:
+        state = await asyncio.shield(start_guild_load(guild_id))
+    state.last_active = time.monotonic()
+    return state
+
+def guild_key(guild):
+    return guild.id if guild is not None else DIRECT_MESSAGES
+
+async def evict_idle_guilds():
+    # Idle guilds with nothing left to match or deliver are saved and unloaded
+    cutoff = time.monotonic() - GUILD_IDLE_TTL
+    evicted = 0
+    for guild_id, state in list(guild_states.items()):
+        if state.last_active > cutoff or guild_id in guild_loads:
+            continue
+        # A shared queue is fed by registrations other processes receive, so
+        # no command here counts as its activity; it stays loaded
+        if state.queue_from_feed:
+            continue
+        if state.dirty_buckets or state.in_flight or state.coordinator.running:
+            continue
+        del guild_states[guild_id]
+        if STORAGE_BACKEND == 'sqlite':
+            await run_db(state.sqlite_store.save_sessions, serialize_sessions(state))
+            await run_db(state.sqlite_store.close)
+        else:
+            save_data(state)
+        evicted += 1
+    return evicted
+
+# University search
+# The university list can outgrow the 25 options a select menu allows, so
+# pickers search it instead: /register autocompletes the university argument
+# and the prefix flow asks for part of the name and offers the best matches.
+# The index is built once at startup from the canonical names and their
+# aliases. A query is answered from the word prefix index first (every word
+# must be the start of a word in the name) and topped up from the trigram
+# index, which catches substrings and typos; trigram scoring stops once
+# UNIVERSITY_SEARCH_BUDGET_MS is spent. Results are always canonical names,
+# which is what sessions, the queues and the database store.
+SELECT_OPTION_LIMIT = 25  # Discord caps a select menu and autocomplete results at 25
+UNIVERSITY_SEARCH_BUDGET_MS = 5  # Time a single search may spend on trigram scoring
+
+def normalize_name(text):
+    return " ".join(re.sub(r"[^\w\s]", " ", text.casefold()).split())
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class UniversityIndex:
+    def __init__(self, names, aliases):
+        self.names = list(names)  # Canonical names in catalog order, which ranks ties
+        self.rank = {name: position for position, name in enumerate(self.names)}
+        self.exact = {}  # normalized name or alias -> canonical name
+        self.prefixes = defaultdict(set)  # word prefix -> canonical names
+        self.grams = defaultdict(set)  # trigram -> canonical names
+        self.gram_counts = defaultdict(int)  # canonical name -> trigrams over all its spellings
+        spellings = [(name, name) for name in self.names] + [(alias, name) for alias, name in aliases.items() if name in self.rank]
+        for spelling, name in spellings:
+            normalized = normalize_name(spelling)
+            self.exact[normalized] = name
+            for word in normalized.split():
+                for end in range(1, len(word) + 1):
+                    self.prefixes[word[:end]].add(name)
+            name_grams = trigrams(normalized)
+            self.gram_counts[name] += len(name_grams)
+            for gram in name_grams:
+                self.grams[gram].add(name)
+
+    def resolve(self, text):
+        # Canonical name for an exact name or alias, None otherwise
+        return self.exact.get(normalize_name(text))
+
+    def search(self, query, limit=SELECT_OPTION_LIMIT):
+        start_time = time.perf_counter()
+        normalized = normalize_name(query)
+        if not normalized:
+            return self.names[:limit]
+        
+        results = []
+        exact = self.exact.get(normalized)
+        if exact:
+            results.append(exact)
+        
+        words = normalized.split()
+        matches = set.intersection(*(self.prefixes.get(word, set()) for word in words))
+        for name in sorted(matches, key=self.rank.__getitem__):
+            if name != exact:
+                results.append(name)
+        
+        if len(results) < limit:
+            # Names sharing the most trigrams with the query, within the time budget
+            deadline = start_time + UNIVERSITY_SEARCH_BUDGET_MS / 1000
+            shared = defaultdict(int)
+            for gram in trigrams(normalized):
+                for name in self.grams.get(gram, ()):
+                    shared[name] += 1
+                if time.perf_counter() > deadline:
+                    break
+            seen = set(results)
+            query_grams = len(trigrams(normalized))
+            ranked = sorted(
+                (name for name, count in shared.items() if name not in seen and count * 3 >= query_grams),
+                key=lambda name: (-shared[name] / (query_grams + self.gram_counts[name]), self.rank[name])
+            )
+            results.extend(ranked)
+        
+        metrics.observe('bot_university_search_seconds', time.perf_counter() - start_time)
+        return results[:limit]
+
+university_index = UniversityIndex([], {})
+
+def build_university_index():
+    global university_index
+    university_index = UniversityIndex(universities, university_aliases)
+
+# Startup
+# Runs once after login and before the gateway connects: the topic tables
+# and the university search index are built, every select option list is
+# prepared, top-level files from before per-guild state are adopted, and the
+# guilds with files on disk or in PRELOAD_GUILD_IDS are loaded and re-rated,
+# so their queues are restored and retried before the first command can
+# arrive. Other guilds load on first activity. Each phase is timed, logged
+# and exported as a metric.
+university_options = []
+department_options = []
+category_options = []
+track_options = {}  # category -> options for its tracks
+all_track_options = []  # Every track in one list, for the /register form
+topic_options = {}  # track -> options for its topics
+startup_timings = {}  # phase -> seconds
+startup_complete = False
+
+@contextmanager
+def startup_phase(name):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[name] = time.perf_counter() - start_time
+        metrics.set('bot_startup_phase_seconds', startup_timings[name], phase=name)
+
+def build_select_options():
+    university_options[:] = [discord.SelectOption(label=univ, value=univ) for univ in universities]
+    department_options[:] = [discord.SelectOption(label=department.upper(), value=department) for department in departments]
+    category_options[:] = [discord.SelectOption(label=category, value=category) for category in track_categories]
+    track_options.clear()
+    for category, tracks in track_categories.items():
+        track_options[category] = [discord.SelectOption(label=track, value=track) for track in tracks]
+    all_track_options[:] = [
+        discord.SelectOption(label=track, value=track, description=category)
+        for category, tracks in track_categories.items()
+        for track in tracks
+    ]
+
+def build_topic_options():
+    topic_options.clear()
+    for track, topics in track_topics.items():
+        topic_options[track] = [discord.SelectOption(label=topic['name'], value=topic['name']) for topic in topics]
+
+def index_topics():
+    build_topic_tables()
+    build_topic_options()
+
+async def connected_guild_ids():
+    if bot.is_ready():
+        return [guild.id for guild in bot.guilds]
+    return [guild.id async for guild in bot.fetch_guilds(limit=2)]
+
+async def adopt_legacy_files():
+    # Files written before state was split per guild belong to the one
+    # server the bot ran in; with several, LEGACY_GUILD_ID has to say which
+    if LEGACY_GUILD_ID is not None or not legacy_files():
+        return
+    guild_ids = await connected_guild_ids()
+    if len(guild_ids) != 1:
+        raise RuntimeError(
+            f"Found data files from before per-server state ({', '.join(legacy_files())}) and the bot is in "
+            f"{len(guild_ids)} servers; set LEGACY_GUILD_ID to the server they belong to"
+        )
+    migrate_legacy_files(guild_ids[0])
+
+async def startup():
+    global startup_complete
+    start_time = time.perf_counter()
+    with startup_phase('index_topics'):
+        index_topics()
+    with startup_phase('university_index'):
+        build_university_index()
+    with startup_phase('select_options'):
+        build_select_options()
+    with startup_phase('legacy_files'):
+        await adopt_legacy_files()
+    with startup_phase('load_guilds'):
+        for guild_id in dict.fromkeys(PRELOAD_GUILD_IDS + stored_guild_ids()):
+            await get_guild_state(guild_id)
+    startup_timings['total'] = time.perf_counter() - start_time
+    startup_complete = True
+    logger.info("Startup finished: " + ", ".join(f"{phase} {seconds * 1000:.1f}ms" for phase, seconds in startup_timings.items()))
+
+# Catalog reload
+# reload_catalog reads and validates CATALOG_FILE and builds the new topic
+# tables on a worker thread, then swaps in the catalog, the tables, the
+# select options and the university index in one step on the event loop, so
+# no command sees a mix of old and new. Codes are only ever appended, so
+# queued records of a removed track or topic keep their names. Queued members
+# are re-rated off the loop afterwards. A file that fails validation is
+# reported and the current catalog stays in place. watch_catalog reloads
+# when the file changes, !reload_catalog on demand.
+CATALOG_POLL_SECONDS = 10  # Seconds between checks for a changed catalog file
+catalog_lock = None
+catalog_lock_loop = None
+
+def catalog_reload_lock():
+    # Made inside the running loop, like notify_slots
+    global catalog_lock, catalog_lock_loop
+    loop = asyncio.get_running_loop()
+    if catalog_lock_loop is not loop:
+        catalog_lock_loop = loop
+        catalog_lock = asyncio.Lock()
+    return catalog_lock
+
+async def reload_catalog():
+    global catalog_stamp
+    async with catalog_reload_lock():
+        loop = asyncio.get_running_loop()
+        start_time = time.perf_counter()
+        stamp = catalog_file_stamp()
+        try:
+            catalog = await loop.run_in_executor(None, read_catalog, CATALOG_FILE)
+        except (OSError, ValueError) as e:
+            catalog_stamp = stamp  # Reported once, not on every poll
+            metrics.inc('bot_catalog_reloads_total', result='invalid')
+            logger.error(f"Catalog reload failed, keeping the current catalog: {str(e)}")
+            return False, str(e)
+        
+        intern_catalog(catalog)
+        tables = await loop.run_in_executor(None, topic_tables, catalog['track_topics'])
+        
+        # Nothing below yields until every derived table matches the new catalog
+        apply_catalog(catalog)
+        set_topic_tables(tables)
+        build_topic_options()
+        build_select_options()
+        build_university_index()
+        catalog_stamp = stamp
+        
+        rerated = 0
+        for state in list(guild_states.values()):
+            rerated += await rerate_guild(state)
+        metrics.inc('bot_catalog_reloads_total', result='ok')
+        summary = (
+            f"{len(track_topics)} tracks, {len(universities)} universities, "
+            f"{len(departments)} departments; {rerated} queued members re-rated"
+        )
+        logger.info(f"Catalog reloaded in {(time.perf_counter() - start_time) * 1000:.1f}ms: {summary}")
+        return True, summary
+
+@tasks.loop(seconds=CATALOG_POLL_SECONDS)
+async def watch_catalog():
+    if catalog_file_stamp() != catalog_stamp:
+        await reload_catalog()
+
 # Automatic restart function
+# Only used when RESTART_INTERVAL_MINUTES is set, see scheduled_restart
 def schedule_restart():
-    save_data()
+    save_all()
+    flush_state()
     logger.info("Initiating scheduled restart")
     
     python_executable = sys.executable  # Get Python executable path
@@ -435,9 +2011,190 @@ def error_handler(func):
             error_msg = f"Error in {func.__name__}: {str(e)}"
             logger.error(error_msg)
             if ctx:
-                await ctx.send(f"An error occurred. Please try again or contact support.\nError: {str(e)}")
+                await send_prompt(ctx, f"An error occurred. Please try again or contact support.\nError: {str(e)}")
     return wrapper
 
+# Registration step timings
+def track_step(state, user_id, step):
+    previous_step, started_at = state.user_data.set_step(user_id, step)
+    if previous_step:
+        metrics.observe('bot_registration_step_seconds', time.monotonic() - started_at, step=previous_step)
+
+def finish_steps(state, user_id):
+    track_step(state, user_id, "registered")
+
+# Conversation prompts
+# Steps that wait for a typed reply register a prompt keyed by
+# (channel_id, author_id), and on_message routes every message with one
+# dict lookup instead of running each pending wait_for check against it.
+# Timeouts come from one deadline heap served by a single loop timer.
+PROMPT_TIMEOUT = 60  # Seconds to wait for a typed reply
+
+class ConversationDispatcher:
+    def __init__(self):
+        self.pending = {}  # (channel_id, author_id) -> future of the reply
+        self.deadlines = []  # Heap of (deadline, sequence, key, future)
+        self.sequence = 0
+        self.timer = None  # Loop timer for the earliest deadline
+        self.timer_at = None
+
+    def wait(self, channel_id, author_id, timeout=PROMPT_TIMEOUT):
+        loop = asyncio.get_running_loop()
+        key = (channel_id, author_id)
+        # A new prompt for the same user and channel replaces the old one
+        previous = self.pending.pop(key, None)
+        if previous is not None and not previous.done():
+            previous.cancel()
+        
+        future = loop.create_future()
+        self.pending[key] = future
+        self.sequence += 1
+        deadline = loop.time() + timeout
+        heapq.heappush(self.deadlines, (deadline, self.sequence, key, future))
+        if self.timer_at is None or deadline < self.timer_at:
+            self._schedule(loop, deadline)
+        return future
+
+    def dispatch(self, message):
+        future = self.pending.pop((message.channel.id, message.author.id), None)
+        if future is None or future.done():
+            return False
+        future.set_result(message)
+        return True
+
+    def _schedule(self, loop, deadline):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = loop.call_at(deadline, self._expire, loop)
+        self.timer_at = deadline
+
+    def _expire(self, loop):
+        self.timer = self.timer_at = None
+        now = loop.time()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, sequence, key, future = heapq.heappop(self.deadlines)
+            # Answered or replaced prompts are only dropped from the heap here
+            if future.done():
+                continue
+            future.set_exception(asyncio.TimeoutError())
+            if self.pending.get(key) is future:
+                del self.pending[key]
+        if self.deadlines:
+            self._schedule(loop, self.deadlines[0][0])
+
+conversations = ConversationDispatcher()
+
+@bot.listen('on_message')
+async def route_replies(message):
+    conversations.dispatch(message)
+
+# Outbound message queue
+# Messages go out through one queue instead of straight to the API. Each send
+# names its channel and a priority, and registration prompts (PRIORITY_PROMPT)
+# are taken before match notifications (PRIORITY_NOTIFY). Sends to different
+# channels go out concurrently on OUTBOUND_CONCURRENCY workers while each
+# channel's sends stay in order. A channel whose bucket is used up waits for
+# its reset, and a send hitting a long 429 is put back after Retry-After, so
+# neither holds a worker that other channels could use. Interaction responses
+# bypass the queue: they have no channel bucket and must answer within three
+# seconds.
+PRIORITY_PROMPT = 0
+PRIORITY_NOTIFY = 1
+OUTBOUND_CONCURRENCY = int(os.getenv("OUTBOUND_CONCURRENCY", "10"))  # Channels sent to at the same time
+OUTBOUND_ATTEMPTS = 5  # Attempts per send when it keeps hitting 429s
+
+class OutboundQueue:
+    def __init__(self, limits, concurrency):
+        self.limits = limits
+        self.concurrency = concurrency
+        self.lanes = {}  # channel_id -> heap of [priority, sequence, send, future, attempts]
+        self.ready = None  # Channels ready to send, as (priority, sequence, channel_id)
+        self.scheduled = set()  # Channels in ready, waiting for a reset or sending
+        self.loop = None
+        self.workers = []
+        self.sequence = 0
+        self.sent = 0
+        self.requeued = 0
+
+    def submit(self, channel_id, send, priority=PRIORITY_PROMPT):
+        # send returns a new coroutine on every call, so a send can be retried
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.lanes.clear()
+            self.scheduled.clear()
+            self.ready = asyncio.PriorityQueue()
+            self.workers = [loop.create_task(self._work()) for _ in range(self.concurrency)]
+        
+        future = loop.create_future()
+        self.sequence += 1
+        heapq.heappush(self.lanes.setdefault(channel_id, []), [priority, self.sequence, send, future, 0])
+        self._schedule(channel_id)
+        return future
+
+    def pending(self):
+        counts = defaultdict(int)
+        for lane in self.lanes.values():
+            for job in lane:
+                counts[job[0]] += 1
+        return counts
+
+    def _schedule(self, channel_id):
+        # A channel has at most one entry in ready, for its most urgent send
+        if channel_id in self.scheduled:
+            return
+        lane = self.lanes.get(channel_id)
+        if not lane:
+            self.lanes.pop(channel_id, None)
+            return
+        self.scheduled.add(channel_id)
+        self.ready.put_nowait((lane[0][0], lane[0][1], channel_id))
+
+    def _release(self, channel_id):
+        self.scheduled.discard(channel_id)
+        self._schedule(channel_id)
+
+    async def _work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            priority, sequence, channel_id = await self.ready.get()
+            delay = self.limits.delay(message_route(channel_id))
+            if delay > 0:
+                loop.call_later(delay, self._release, channel_id)
+                continue
+            
+            lane = self.lanes[channel_id]
+            job = heapq.heappop(lane)
+            priority, sequence, send, future, attempts = job
+            try:
+                if not future.done():
+                    future.set_result(await send())
+                    self.sent += 1
+            except discord.RateLimited as e:
+                if attempts + 1 < OUTBOUND_ATTEMPTS:
+                    job[4] += 1
+                    heapq.heappush(lane, job)
+                    self.requeued += 1
+                    loop.call_later(e.retry_after, self._release, channel_id)
+                    continue
+                if not future.done():
+                    future.set_exception(e)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            self._release(channel_id)
+
+outbound = OutboundQueue(rate_limits, OUTBOUND_CONCURRENCY)
+
+def send_prompt(ctx, content=None, **kwargs):
+    return outbound.submit(ctx.channel.id, lambda: ctx.send(content, **kwargs), PRIORITY_PROMPT)
+
+def outbound_samples():
+    for priority, count in outbound.pending().items():
+        yield 'bot_outbound_pending', {'priority': 'prompt' if priority == PRIORITY_PROMPT else 'notify'}, count
+
+metrics.collectors.append(outbound_samples)
+
 # Use these in your command responses, for example:
 @bot.command(name="helpbot")
 async def helpbot(ctx):
@@ -447,12 +2204,13 @@ async def helpbot(ctx):
     )
     
     fields = [
-        ("🔹 Registration Process", "`!start` - Complete entire registration process", False),
+        ("🔹 Registration Process", "`!start` - Complete entire registration process\n`/register` - Register in a single form", False),
         ("🔹 Commands", 
          "`!choose_department` - Select department\n"
          "`!choose_role` - Choose Leader/Member\n"
          "`!choose_track` - Select track\n"
          "`!choose_topics` - Select topics\n"
+         "`!choose_needed_topics` - Select topics your project needs (leaders)\n"
          "`!write_comment` - Add comment", False),
         ("📌 Registration Flow",
          "1. Choose Department\n"
@@ -464,30 +2222,105 @@ async def helpbot(ctx):
     ]
     
     embed = format_embed_message(help_title, help_description, fields)
-    await ctx.send(embed=embed)
+    await send_prompt(ctx, embed=embed)
 
 # Helper function to calculate rating based on difficulty scores
-def calculate_rating(user_id):
-    track = user_data[user_id]['track']
-    selected_topics = user_data[user_id].get('selected_topics', [])
-    
-    total_score = 0
+def rating_for(track, selected_topics):
+    scores = topic_scores.get(track, {})
     # Calculate total points from selected topics
-    for topic_name in selected_topics:
-        for topic in track_topics[track]:
-            if topic['name'] == topic_name:
-                total_score += topic['score']
-    
-    # Calculate total possible points across all topics
-    total_possible_score = sum(topic['score'] for topic in track_topics[track])
+    total_score = sum(scores.get(topic_name, 0) for topic_name in selected_topics)
+    total_possible_score = track_total_scores.get(track, 0)
     
     # Calculate rating as percentage
     return 0 if total_possible_score == 0 else min(int((total_score / total_possible_score) * 100), 100)
 
+def calculate_rating(state, user_id):
+    session = state.user_data[user_id]
+    return rating_for(session['track'], session.get('selected_topics', []))
+
+# Bulk re-rating
+# Recomputes every queued member's rating and topic mask, and every leader's
+# needed topics mask, from the current topic tables in one pass per track and
+# rebuilds the bucket heaps, e.g. after a topic score change. member_ratings
+# only reads the records and the tables, so rerate_guild runs it on a worker
+# thread while the event loop keeps serving.
+def topic_mask(track, codes):
+    bits = topic_bits.get(track, {})
+    mask = 0
+    for code in codes:
+        mask |= bits.get(code, 0)
+    return mask
+
+def ratings_from_masks(track, masks):
+    scores = track_score_vectors.get(track, [])
+    total_possible_score = track_total_scores.get(track, 0)
+    if total_possible_score == 0:
+        return [0] * len(masks)
+    
+    if np is not None:
+        mask_array = np.array(masks, dtype=np.int64)
+        topic_hits = (mask_array[:, None] >> np.arange(len(scores), dtype=np.int64)) & 1
+        totals = topic_hits @ np.array(scores, dtype=np.int64)
+        return np.minimum((totals / total_possible_score * 100).astype(np.int64), 100).tolist()
+    
+    ratings = []
+    for mask in masks:
+        total_score = sum(score for bit, score in enumerate(scores) if mask >> bit & 1)
+        ratings.append(min(int((total_score / total_possible_score) * 100), 100))
+    return ratings
+
+def members_by_track(state):
+    by_track = defaultdict(list)
+    for (track, university, department), heap in state.member_index.items():
+        by_track[track].extend(heap)
+    return by_track
+
+def member_ratings(by_track):
+    results = []
+    for track, track_members in by_track.items():
+        track_name = track_codes.value(track)
+        masks = [topic_mask(track_name, member.topics) for member in track_members]
+        results.append((track_members, masks, ratings_from_masks(track_name, masks)))
+    return results
+
+def apply_ratings(state, results):
+    rerated = 0
+    for track_members, masks, ratings in results:
+        for member, mask, rating in zip(track_members, masks, ratings):
+            member.topic_mask = mask
+            member.rating = rating
+        rerated += len(track_members)
+    for leader_list in state.leader_index.values():
+        for leader in leader_list:
+            leader.needed_mask = topic_mask(leader.track_name, leader.desired)
+    
+    # Ratings changed under the heaps, so restore the heap order in O(n)
+    for heap in state.member_index.values():
+        heapq.heapify(heap)
+    return rerated
+
+async def rerate_guild(state):
+    start_time = time.perf_counter()
+    results = await asyncio.get_running_loop().run_in_executor(None, member_ratings, members_by_track(state))
+    rerated = apply_ratings(state, results)
+    # New scores or needed topics can change the best member for a leader
+    for key in state.leader_index:
+        mark_dirty(state, key)
+    latency_ms = round((time.perf_counter() - start_time) * 1000, 1)
+    logger.info(
+        f"Re-rated {rerated} members of guild {state.guild_id} in {latency_ms}ms",
+        extra={'guild_id': state.guild_id, 'latency_ms': latency_ms}
+    )
+    return rerated
+
 # Update the departments in choose_department command
 @bot.command(name="choose_department")
 async def choose_department(ctx):
+    state = await get_guild_state(guild_key(ctx.guild))
+    user_data = state.user_data
+    leader_departments = state.leader_departments
     user_id = ctx.author.id
+    track_step(state, user_id, "choose_department")
     role = user_data.get(user_id, {}).get('role')
     university = user_data.get(user_id, {}).get('university')
 
@@ -498,28 +2331,21 @@ async def choose_department(ctx):
         
         # If university doesn't match previous registration
         if university != stored_univ:
-            await ctx.send(f"You must register with your original university: {stored_univ}")
+            await send_prompt(ctx, f"You must register with your original university: {stored_univ}")
             user_data[user_id]["university"] = stored_univ
             await ctx.invoke(bot.get_command("choose_department"))
             return
             
         # Use the stored department and prevent changes
         user_data[user_id]["department"] = stored_dept
-        await ctx.send(f"Your department is already set to {stored_dept.upper()} and cannot be changed.")
+        await send_prompt(ctx, f"Your department is already set to {stored_dept.upper()} and cannot be changed.")
         await ctx.invoke(bot.get_command("choose_role"))
         return
 
     # If the leader doesn't have a department yet or is a member, allow them to choose
     select = Select(
         placeholder="Choose your department",
-        options=[
-            discord.SelectOption(label="CS", value="cs"),
-            discord.SelectOption(label="IT", value="it"),
-            discord.SelectOption(label="IS", value="is"),
-            discord.SelectOption(label="AI", value="ai"),
-            discord.SelectOption(label="SW", value="sw"),
-            discord.SelectOption(label="BIO", value="bio")
-        ]
+        options=department_options
     )
 
     async def callback(interaction):
@@ -527,10 +2353,13 @@ async def choose_department(ctx):
         
         # If the user is a leader, store their department and university permanently
         if role == "leader":
-            leader_departments[user_id] = {
-                'department': select.values[0],
-                'university': user_data[user_id].get('university')
-            }
+            record_event(
+                state,
+                'leader_lock',
+                user_id=user_id,
+                university=user_data[user_id].get('university'),
+                department=select.values[0]
+            )
         
         await interaction.response.send_message(f"You have chosen {select.values[0].upper()} department.")
         await ctx.invoke(bot.get_command("choose_role"))
@@ -538,27 +2367,47 @@ async def choose_department(ctx):
     select.callback = callback
     view = View()
     view.add_item(select)
-    await ctx.send("Please choose your department:", view=view)
+    await send_prompt(ctx, "Please choose your department:", view=view)
 
 
 # Add new command for university selection
 @bot.command(name="choose_university")
 async def choose_university(ctx):
+    state = await get_guild_state(guild_key(ctx.guild))
+    user_data = state.user_data
+    leader_departments = state.leader_departments
     user_id = ctx.author.id
+    track_step(state, user_id, "choose_university")
     role = user_data.get(user_id, {}).get('role')
 
     # Check if leader already registered
     if role == "leader" and user_id in leader_departments:
         stored_univ = leader_departments[user_id]['university']
         user_data[user_id]["university"] = stored_univ
-        await ctx.send(f"Your university is already set to {stored_univ} and cannot be changed.")
+        await send_prompt(ctx, f"Your university is already set to {stored_univ} and cannot be changed.")
         await ctx.invoke(bot.get_command("choose_department"))
         return
 
+    # Up to 25 universities fit in one menu, beyond that the user searches first
+    options = university_options
+    if len(university_options) > SELECT_OPTION_LIMIT:
+        await send_prompt(ctx, "Type part of your university's name:")
+        try:
+            msg = await conversations.wait(ctx.channel.id, ctx.author.id)
+        except asyncio.TimeoutError:
+            await send_prompt(ctx, "University search timed out. Please try again.")
+            return
+        matches = university_index.search(msg.content)
+        if not matches:
+            await send_prompt(ctx, "No university matches that name. Please try again.")
+            await ctx.invoke(bot.get_command("choose_university"))
+            return
+        options = [discord.SelectOption(label=name, value=name) for name in matches]
+
     # Create select menu with universities
     select = Select(
         placeholder="Choose your university",
-        options=[discord.SelectOption(label=univ, value=univ) for univ in universities]
+        options=options
     )
 
     async def callback(interaction):
@@ -569,12 +2418,16 @@ async def choose_university(ctx):
     select.callback = callback
     view = View()
     view.add_item(select)
-    await ctx.send("Please choose your university:", view=view)
+    await send_prompt(ctx, "Please choose your university:", view=view)
 
 # Role Selection Command
 @bot.command(name="choose_role")
 async def choose_role(ctx):
+    state = await get_guild_state(guild_key(ctx.guild))
+    user_data = state.user_data
+    leader_departments = state.leader_departments
     user_id = ctx.author.id
+    track_step(state, user_id, "choose_role")
     
     select = Select(
         placeholder="Choose your role",
@@ -606,27 +2459,27 @@ async def choose_role(ctx):
         
         if selected_role == "leader":
             await interaction.response.send_message("You have chosen to be a Leader.")
-            await ctx.send("Please enter your team name:")
-            
-            def check(m):
-                return m.author == ctx.author and m.channel == ctx.channel
+            await send_prompt(ctx, "Please enter your team name:")
             
             try:
-                msg = await bot.wait_for("message", check=check, timeout=60)
-                team_name = msg.content
+                msg = await conversations.wait(ctx.channel.id, ctx.author.id)
+                team_name = clip(msg.content, 100)  # Same limit as the team name field of /register
                 user_data[user_id]["team_name"] = team_name
-                await ctx.send(f"Your team name is {team_name}.")
+                await send_prompt(ctx, f"Your team name is {team_name}.")
                 
                 # Store leader's information if this is their first registration
                 if user_id not in leader_departments:
-                    leader_departments[user_id] = {
-                        'university': user_data[user_id]['university'],
-                        'department': user_data[user_id]['department']
-                    }
+                    record_event(
+                        state,
+                        'leader_lock',
+                        user_id=user_id,
+                        university=user_data[user_id]['university'],
+                        department=user_data[user_id]['department']
+                    )
                 
                 await ctx.invoke(bot.get_command("choose_track"))
             except asyncio.TimeoutError:
-                await ctx.send("Team name selection timed out. Please try again.")
+                await send_prompt(ctx, "Team name selection timed out. Please try again.")
         
         else:  # Member
             await interaction.response.send_message("You have chosen to be a Member.")
@@ -635,28 +2488,26 @@ async def choose_role(ctx):
     select.callback = callback
     view = View()
     view.add_item(select)
-    await ctx.send("Choose your role:", view=view)
+    await send_prompt(ctx, "Choose your role:", view=view)
 
 # Track Selection Command
 @bot.command(name="choose_track")
 async def choose_track(ctx):
+    state = await get_guild_state(guild_key(ctx.guild))
+    user_data = state.user_data
+    track_step(state, ctx.author.id, "choose_track")
     role = user_data.get(ctx.author.id, {}).get('role')
     
     select = Select(
         placeholder="Choose track category",
-        options=[discord.SelectOption(label=category, value=category) for category in track_categories.keys()]
+        options=category_options
     )
 
     async def category_callback(interaction):
         category = select.values[0]
-        track_options = [
-            discord.SelectOption(label=track, value=track) 
-            for track in track_categories[category]
-        ]
-        
         track_select = Select(
             placeholder=f"Choose track in {category}",
-            options=track_options
+            options=track_options[category]
         )
 
         async def track_callback(track_interaction):
@@ -668,7 +2519,7 @@ async def choose_track(ctx):
             
             # Different flow for leader and member
             if role == "leader":
-                await ctx.invoke(bot.get_command("write_comment"))
+                await ctx.invoke(bot.get_command("choose_needed_topics"))
             else:
                 await ctx.invoke(bot.get_command("choose_topics"))
 
@@ -680,24 +2531,26 @@ async def choose_track(ctx):
     select.callback = category_callback
     view = View()
     view.add_item(select)
-    await ctx.send("Choose a track category:", view=view)
+    await send_prompt(ctx, "Choose a track category:", view=view)
 
 # Topic Selection Command
 @bot.command(name="choose_topics")
 async def choose_topics(ctx):
+    state = await get_guild_state(guild_key(ctx.guild))
+    user_data = state.user_data
+    track_step(state, ctx.author.id, "choose_topics")
     track = user_data[ctx.author.id]["track"]
-    topics = [topic['name'] for topic in track_topics[track]]
     
     select = Select(
         placeholder="Choose topics you've studied",
-        options=[discord.SelectOption(label=topic, value=topic) for topic in topics],
-        max_values=len(topics)
+        options=topic_options[track],
+        max_values=len(topic_options[track])
     )
 
     async def callback(interaction):
         selected_topics = select.values
         user_data[ctx.author.id]["selected_topics"] = selected_topics
-        rating = calculate_rating(ctx.author.id)
+        rating = calculate_rating(state, ctx.author.id)
         user_data[ctx.author.id]["rating"] = rating
         
         await interaction.response.send_message(f"You have selected: {', '.join(selected_topics)}. Your rating is {rating}%.")
@@ -706,15 +2559,87 @@ async def choose_topics(ctx):
     select.callback = callback
     view = View()
     view.add_item(select)
-    await ctx.send("Please select topics you've studied:", view=view)
+    await send_prompt(ctx, "Please select topics you've studied:", view=view)
+
+# Needed Topics Command for leaders
+@bot.command(name="choose_needed_topics")
+async def choose_needed_topics(ctx):
+    state = await get_guild_state(guild_key(ctx.guild))
+    user_data = state.user_data
+    track_step(state, ctx.author.id, "choose_needed_topics")
+    track = user_data[ctx.author.id]["track"]
+    
+    select = Select(
+        placeholder="Choose topics your project needs (optional)",
+        options=topic_options[track],
+        min_values=0,
+        max_values=len(topic_options[track])
+    )
+
+    async def callback(interaction):
+        desired_topics = select.values
+        user_data[ctx.author.id]["desired_topics"] = desired_topics
+        
+        if desired_topics:
+            await interaction.response.send_message(f"Your project needs: {', '.join(desired_topics)}. Members covering these topics will be preferred.")
+        else:
+            await interaction.response.send_message("No specific topics selected. You will be matched with the highest rated members.")
+        await ctx.invoke(bot.get_command("write_comment"))
+
+    select.callback = callback
+    view = View()
+    view.add_item(select)
+    await send_prompt(ctx, "Please select the topics your project needs:", view=view)
+
+# Registration completion
+# Shared by write_comment and the /register modal: queues the finished
+# session as a member or a leader
+def complete_registration(state, user_id, user_name, comment):
+    session = state.user_data[user_id]
+    session["comment"] = comment
+    registration_time = time.time()
+    
+    if session["role"] == "member":
+        member = {
+            "user_id": user_id,  # Store ID instead of User object
+            "user_name": user_name,  # Store name separately
+            "track": session["track"],
+            "rating": session["rating"],
+            "comment": comment,
+            "department": session["department"],
+            "university": session["university"],
+            "selected_topics": session.get("selected_topics", []),
+            "registration_time": registration_time
+        }
+        record_event(state, 'register_member', member=member)
+    else:
+        # The prefix flow locks the leader's department when the team is named
+        if user_id not in state.leader_departments:
+            record_event(state, 'leader_lock', user_id=user_id, university=session['university'], department=session['department'])
+        leader = {
+            "user_id": user_id,  # Store ID instead of User object
+            "user_name": user_name,  # Store name separately
+            "team_name": session["team_name"],
+            "track": session["track"],
+            "team_comment": comment,
+            "department": session["department"],
+            "university": session["university"],
+            "desired_topics": session.get("desired_topics", [])
+        }
+        record_event(state, 'register_leader', leader=leader)
+    
+    finish_steps(state, user_id)
 
 # Write Comment Command
 @bot.command(name="write_comment")
 async def write_comment(ctx):
+    state = await get_guild_state(guild_key(ctx.guild))
+    user_data = state.user_data
+    track_step(state, ctx.author.id, "write_comment")
     role = user_data[ctx.author.id]["role"]
     
-    if role == "member" and ctx.author.id in registered_users:
-        await ctx.send("You have already registered. Wait for matching.")
+    if role == "member" and ctx.author.id in state.registered_users:
+        await send_prompt(ctx, "You have already registered. Wait for matching.")
         return
 
     comment_prompt = (
@@ -723,52 +2648,16 @@ async def write_comment(ctx):
         "Write A Comment About Yourself Like What You Have Studied And What You Will Study In The Future.."
     )
     
-    await ctx.send(comment_prompt)
-
-    def check(m):
-        return m.author == ctx.author and m.channel == ctx.channel
+    await send_prompt(ctx, comment_prompt)
 
     try:
-        msg = await bot.wait_for("message", check=check, timeout=60)
-        comment = msg.content
-        user_data[ctx.author.id]["comment"] = comment
-        registration_time = time.time()
-        
-        track = user_data[ctx.author.id]["track"]
-        department = user_data[ctx.author.id]["department"]
-        university = user_data[ctx.author.id]["university"]
-        
-        if role == "member":
-            member = {
-                "user_id": ctx.author.id,  # Store ID instead of User object
-                "user_name": ctx.author.name,  # Store name separately
-                "track": track,
-                "rating": user_data[ctx.author.id]["rating"],
-                "comment": comment,
-                "department": department,
-                "university": university,
-                "selected_topics": user_data[ctx.author.id].get("selected_topics", []),
-                "registration_time": registration_time
-            }
-            heapq.heappush(members[track], (-member["rating"], registration_time, member))
-            registered_users.add(ctx.author.id)
-        else:
-            leader = {
-                "user_id": ctx.author.id,  # Store ID instead of User object
-                "user_name": ctx.author.name,  # Store name separately
-                "team_name": user_data[ctx.author.id]["team_name"],
-                "track": track,
-                "team_comment": comment,
-                "department": department,
-                "university": university
-            }
-            leaders[track].append(leader)
-        
-        await ctx.send("Your registration is complete. You've been added to the matching queue.")
+        msg = await conversations.wait(ctx.channel.id, ctx.author.id)
+        complete_registration(state, ctx.author.id, ctx.author.name, msg.content)
+        await send_prompt(ctx, "Your registration is complete. You've been added to the matching queue.")
         await ctx.invoke(bot.get_command("match"))
         
     except asyncio.TimeoutError:
-        await ctx.send("Comment submission timed out. Please try again.")
+        await send_prompt(ctx, "Comment submission timed out. Please try again.")
 
 # Update the start command to begin with university selection
 # Add error handling to existing commands
@@ -776,12 +2665,15 @@ async def write_comment(ctx):
 @error_handler
 @commands.cooldown(1, 15, BucketType.user)
 async def start(ctx):
+    state = await get_guild_state(guild_key(ctx.guild))
+    user_data = state.user_data
+    leader_departments = state.leader_departments
     user_id = ctx.author.id
     
     # If user is already registered as a leader, verify their status
     if user_id in leader_departments:
         stored_data = leader_departments[user_id]
-        await ctx.send(
+        await send_prompt(ctx, 
             f"⚠️ You have previously registered as a leader for:\n"
             f"University: {stored_data['university']}\n"
             f"Department: {stored_data['department'].upper()}\n\n"
@@ -789,177 +2681,622 @@ async def start(ctx):
         )
     
     # Check if the member is already registered and not matched
-    if user_id in registered_users:
-        await ctx.send("You have already registered. Wait for matching.")
+    if user_id in state.registered_users:
+        await send_prompt(ctx, "You have already registered. Wait for matching.")
         return
 
     # Clear any existing data for the user
     if user_id in user_data:
-        del user_data[user_id]
+        record_event(state, 'session_clear', user_id=user_id)
+    track_step(state, user_id, "start")
     
     await ctx.invoke(bot.get_command("choose_university"))
-    save_data()
+
+# Slash command registration
+# /register collects a whole registration in one form and one modal instead
+# of a chain of prompts: the university is an autocompleted argument of the
+# command, department, track and topics are combined selects on a single
+# ephemeral message, the role is chosen with the submit button, and the team
+# name and comment are entered in a modal.
+# Select changes are only acknowledged, so the only messages sent are the
+# form, the modal and the confirmation.
+REGISTRATION_FORM_TIMEOUT = 600  # Seconds the /register form stays usable
+
+class RegistrationForm(View):
+    def __init__(self, state, user_id, university):
+        super().__init__(timeout=REGISTRATION_FORM_TIMEOUT)
+        self.state = state
+        self.user_id = user_id
+        self.university = university  # Canonical name resolved from the command argument
+        self.department_select = Select(placeholder="Choose your department", options=department_options, row=0)
+        self.track_select = Select(placeholder="Choose your track", options=all_track_options, row=1)
+        self.topics_select = None  # Added once a track is chosen
+        self.department_select.callback = self.acknowledge
+        self.track_select.callback = self.track_chosen
+        for select in (self.department_select, self.track_select):
+            self.add_item(select)
+        
+        member_button = Button(label="Register as Member", style=discord.ButtonStyle.primary, row=4)
+        leader_button = Button(label="Register as Leader", style=discord.ButtonStyle.secondary, row=4)
+        
+        async def register_member(interaction):
+            await self.submit(interaction, "member")
+        
+        async def register_leader(interaction):
+            await self.submit(interaction, "leader")
+        
+        member_button.callback = register_member
+        leader_button.callback = register_leader
+        self.add_item(member_button)
+        self.add_item(leader_button)
+
+    async def acknowledge(self, interaction):
+        await interaction.response.defer()
+
+    def keep_selection(self, select):
+        # Re-sending the view resets menus on the client unless the chosen
+        # options are marked as defaults
+        chosen = set(select.values)
+        select.options = [
+            discord.SelectOption(label=option.label, value=option.value, description=option.description, default=option.value in chosen)
+            for option in select.options
+        ]
+
+    async def track_chosen(self, interaction):
+        track = self.track_select.values[0]
+        if self.topics_select is not None:
+            self.remove_item(self.topics_select)
+        self.topics_select = Select(
+            placeholder="Topics you've studied, or topics your project needs",
+            options=topic_options[track],
+            min_values=0,
+            max_values=len(topic_options[track]),
+            row=2
+        )
+        self.topics_select.callback = self.acknowledge
+        self.add_item(self.topics_select)
+        for select in (self.department_select, self.track_select):
+            self.keep_selection(select)
+        await interaction.response.edit_message(view=self)
+
+    async def submit(self, interaction, role):
+        state = self.state
+        user_id = self.user_id
+        leader_departments = state.leader_departments
+        missing = [
+            name for name, select in (
+                ("department", self.department_select),
+                ("track", self.track_select)
+            ) if not select.values
+        ]
+        if missing:
+            await interaction.response.send_message(f"Please choose your {', '.join(missing)} first.", ephemeral=True)
+            return
+        
+        university = self.university
+        department = self.department_select.values[0]
+        track = self.track_select.values[0]
+        topics = list(self.topics_select.values) if self.topics_select is not None else []
+        
+        if role == "member":
+            if user_id in state.registered_users:
+                await interaction.response.send_message("You have already registered. Wait for matching.", ephemeral=True)
+                return
+            if not topics:
+                await interaction.response.send_message("Please select at least one topic you've studied.", ephemeral=True)
+                return
+        elif user_id in leader_departments:
+            stored_univ = leader_departments[user_id]['university']
+            stored_dept = leader_departments[user_id]['department']
+            if university != stored_univ or department != stored_dept:
+                await interaction.response.send_message(
+                    f"⚠️ You must register with your original university ({stored_univ}) "
+                    f"and department ({stored_dept.upper()}).",
+                    ephemeral=True
+                )
+                return
+        
+        session = {"university": university, "department": department, "track": track, "role": role}
+        if role == "member":
+            session["selected_topics"] = topics
+            session["rating"] = rating_for(track, topics)
+        else:
+            session["desired_topics"] = topics
+        state.user_data[user_id] = session
+        track_step(state, user_id, "register_details")
+        await interaction.response.send_modal(RegistrationModal(state, user_id, role))
+
+class RegistrationModal(Modal):
+    def __init__(self, state, user_id, role):
+        super().__init__(title="Your Team" if role == "leader" else "About You", timeout=REGISTRATION_FORM_TIMEOUT)
+        self.state = state
+        self.user_id = user_id
+        self.team_name = None
+        if role == "leader":
+            self.team_name = TextInput(label="Team name", max_length=100)
+            self.add_item(self.team_name)
+        self.comment = TextInput(
+            label="Your team and project idea" if role == "leader" else "What you have studied and will study",
+            style=discord.TextStyle.paragraph,
+            max_length=1000
+        )
+        self.add_item(self.comment)
+
+    async def on_submit(self, interaction):
+        session = self.state.user_data.get(self.user_id)
+        if not session or "role" not in session:
+            await interaction.response.send_message("Your registration expired. Please run /register again.", ephemeral=True)
+            return
+        if self.team_name is not None:
+            session["team_name"] = self.team_name.value
+        complete_registration(self.state, self.user_id, interaction.user.name, self.comment.value)
+        await interaction.response.send_message(
+            "Your registration is complete. You've been added to the matching queue.", ephemeral=True
+        )
+        self.state.coordinator.request()
+
+@bot.tree.command(name="register", description="Register for team matching in a single form")
+@app_commands.describe(university="Start typing your university's name")
+async def register(interaction: discord.Interaction, university: str):
+    state = await get_guild_state(guild_key(interaction.guild))
+    user_id = interaction.user.id
+    if user_id in state.registered_users:
+        await interaction.response.send_message("You have already registered. Wait for matching.", ephemeral=True)
+        return
+    
+    # Autocomplete suggests canonical names, but the argument accepts any text
+    canonical_university = university_index.resolve(university)
+    if canonical_university is None:
+        suggestions = ", ".join(university_index.search(university, limit=3))
+        await interaction.response.send_message(
+            f"Unknown university: {university}. Did you mean: {suggestions or 'none'}?", ephemeral=True
+        )
+        return
+    
+    track_step(state, user_id, "register")
+    prompt = f"University: {canonical_university}\nChoose your department, track and topics, then register as a member or a leader."
+    if user_id in state.leader_departments:
+        stored_data = state.leader_departments[user_id]
+        prompt += (
+            f"\n⚠️ As a leader you must use your original university ({stored_data['university']}) "
+            f"and department ({stored_data['department'].upper()})."
+        )
+    await interaction.response.send_message(prompt, view=RegistrationForm(state, user_id, canonical_university), ephemeral=True)
+
+@register.autocomplete('university')
+async def university_autocomplete(interaction: discord.Interaction, current: str):
+    return [app_commands.Choice(name=name, value=name) for name in university_index.search(current)]
+
+@bot.tree.error
+async def on_app_command_error(interaction, error):
+    logger.error(f"Slash command error: {str(error)}")
+    message = "An error occurred. Please try again later."
+    if interaction.response.is_done():
+        await interaction.followup.send(message, ephemeral=True)
+    else:
+        await interaction.response.send_message(message, ephemeral=True)
+
+# Match notification delivery
+# Every match is rendered as a single embed per user and the pairs found in a
+# pass are delivered concurrently. A failed send is retried for that pair only;
+# the member goes back into the queue once all attempts are used up. A send
+# Discord refuses outright (DMs closed, a 400 or 403) is not retried: that
+# user is dropped from the queue, since every later pass would fail the same
+# way. Once either side has been told about the match it is recorded, so the
+# other side is never paired and notified again.
+NOTIFY_CONCURRENCY = 10  # Pairs being delivered at the same time
+NOTIFY_ATTEMPTS = 3  # Delivery attempts per pair before the member is requeued
+NOTIFY_RETRY_DELAY = 2  # Seconds before the first retry, doubled on each attempt
+notify_semaphore = None
+notify_loop = None
+
+def notify_slots():
+    # Made inside the running loop: on Python 3.8 and 3.9 a semaphore created
+    # at import is bound to another loop than the one the bot runs on
+    global notify_semaphore, notify_loop
+    loop = asyncio.get_running_loop()
+    if notify_loop is not loop:
+        notify_loop = loop
+        notify_semaphore = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+    return notify_semaphore
+
+def is_permanent_failure(error):
+    return isinstance(error, discord.Forbidden) or (
+        isinstance(error, discord.HTTPException) and error.status in (400, 403)
+    )
+
+def clip(text, limit):
+    text = str(text)
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+def build_match_embed(leader, member, for_leader):
+    if for_leader:
+        match_details = (
+            f"```yml\n"
+            f"Member Name   : {member.user_name}\n"
+            f"University    : {member.university_name}\n"
+            f"Department    : {member.department_name.upper()}\n"
+            f"Track         : {member.track_name}\n"
+            f"Team          : {clip(leader.team_name, 100)}\n"
+            f"```"
+        )
+    else:
+        match_details = (
+            f"```yml\n"
+            f"Team Leader   : {leader.user_name}\n"
+            f"University    : {leader.university_name}\n"
+            f"Department    : {leader.department_name.upper()}\n"
+            f"Track         : {leader.track_name}\n"
+            f"Team          : {clip(leader.team_name, 100)}\n"
+            f"```"
+        )
+
+    needed_str = ", ".join(leader.desired_topics) or "Any"
+    team_info = (
+        f"```ansi\n"
+        f"\u001b[1;34m── Team Leader's Message ──\u001b[0m\n"
+        f"{clip(leader.team_comment, 700)}\n\n"
+        f"\u001b[1;34m── Topics Needed ──\u001b[0m\n"
+        f"{clip(needed_str, 200)}\n"
+        f"```"
+    )
+
+    topics_str = ", ".join(member.selected_topics)
+    member_profile = (
+        f"```ansi\n"
+        f"\u001b[1;33m── Technical Background ──\u001b[0m\n"
+        f"• Track: {member.track_name}\n"
+        f"• Rating: {member.rating}%\n\n"
+        f"\u001b[1;33m── Topics Studied ──\u001b[0m\n"
+        f"{clip(topics_str, 700)}\n"
+        f"```"
+    )
+
+    personal_note = (
+        f"```ansi\n"
+        f"\u001b[1;33m── Personal Note ──\u001b[0m\n"
+        f"{clip(member.comment, 900)}\n"
+        f"```"
+    )
+
+    contact_info = (
+        f"```ansi\n"
+        f"\u001b[1;35mYou can now communicate directly through Discord!\u001b[0m\n"
+        f"Feel free to discuss project details and next steps.\n"
+        f"```"
+    )
+
+    fields = [
+        ("📋 Match Details", match_details, False),
+        ("🏢 Team Information", team_info, False),
+        ("👤 Member Profile", member_profile, False),
+        ("📝 Member's Note", personal_note, False),
+        ("📱 Next Steps", contact_info, False)
+    ]
+    return format_embed_message("🎉 MATCHING SUCCESS! 🎉", f"**Team:** {clip(leader.team_name, 100)}", fields, color=0x2ecc71)
+
+# Discord user and DM channel resolution
+# Users come from the gateway cache when possible (intents.members keeps it
+# warm) and DM channels are kept in a bounded LRU with a TTL, so REST calls
+# are only made on a cache miss.
+DM_CACHE_SIZE = 5000  # Most DM channels kept at once
+DM_CACHE_TTL = 3600  # Seconds before a cached DM channel is resolved again
+dm_channel_cache = OrderedDict()  # user_id -> (channel, expires_at), least recently used first
+resolver_stats = {
+    'user_cache_hits': 0,
+    'user_cache_misses': 0,
+    'dm_cache_hits': 0,
+    'dm_cache_misses': 0,
+    'dm_cache_evictions': 0
+}
+
+async def discord_api_call(call, coro):
+    start_time = time.perf_counter()
+    try:
+        return await coro
+    except Exception:
+        metrics.inc('bot_discord_api_errors_total', call=call)
+        raise
+    finally:
+        metrics.observe('bot_discord_api_seconds', time.perf_counter() - start_time, call=call)
+
+async def resolve_user(user_id):
+    user = bot.get_user(user_id)
+    if user is None:
+        for guild in bot.guilds:
+            user = guild.get_member(user_id)
+            if user is not None:
+                break
+    if user is not None:
+        resolver_stats['user_cache_hits'] += 1
+        return user
+    resolver_stats['user_cache_misses'] += 1
+    return await discord_api_call('fetch_user', bot.fetch_user(user_id))
+
+async def resolve_dm_channel(user_id):
+    now = time.monotonic()
+    cached = dm_channel_cache.get(user_id)
+    if cached and cached[1] > now:
+        dm_channel_cache.move_to_end(user_id)
+        resolver_stats['dm_cache_hits'] += 1
+        return cached[0]
+    
+    resolver_stats['dm_cache_misses'] += 1
+    user = await resolve_user(user_id)
+    channel = user.dm_channel or await discord_api_call('create_dm', user.create_dm())
+    dm_channel_cache[user_id] = (channel, now + DM_CACHE_TTL)
+    dm_channel_cache.move_to_end(user_id)
+    while len(dm_channel_cache) > DM_CACHE_SIZE:
+        dm_channel_cache.popitem(last=False)
+        resolver_stats['dm_cache_evictions'] += 1
+    return channel
+
+async def send_dm(user_id, embed):
+    channel = await resolve_dm_channel(user_id)
+    try:
+        await outbound.submit(
+            channel.id, lambda: discord_api_call('send_dm', channel.send(embed=embed)), PRIORITY_NOTIFY
+        )
+    except discord.HTTPException:
+        # The channel may be gone or closed, resolve it again on the next attempt
+        dm_channel_cache.pop(user_id, None)
+        raise
+
+async def deliver_match(state, key, leader, member):
+    leader_id = leader.user_id
+    member_id = member.user_id
+    track = track_codes.value(key[0])
+    start_time = time.perf_counter()
+    
+    try:
+        pending = {
+            leader_id: build_match_embed(leader, member, for_leader=True),
+            member_id: build_match_embed(leader, member, for_leader=False)
+        }
+        
+        unreachable = set()  # Users Discord refused to deliver to
+        for attempt in range(NOTIFY_ATTEMPTS):
+            if not pending:
+                break
+            if attempt:
+                await asyncio.sleep(NOTIFY_RETRY_DELAY * 2 ** (attempt - 1))
+            
+            # Only users who have not received their notification yet are retried
+            async with notify_slots():
+                recipients = list(pending.items())
+                results = await asyncio.gather(
+                    *(send_dm(user_id, embed) for user_id, embed in recipients),
+                    return_exceptions=True
+                )
+            
+            for (user_id, embed), result in zip(recipients, results):
+                if isinstance(result, Exception):
+                    logger.error(
+                        f"Failed to send match message to {user_id} (attempt {attempt + 1}): {result}",
+                        extra={'guild_id': state.guild_id, 'track': track, 'user_id': user_id}
+                    )
+                    if is_permanent_failure(result):
+                        unreachable.add(user_id)
+                        del pending[user_id]
+                else:
+                    del pending[user_id]
+        
+        notified = {leader_id, member_id} - unreachable - set(pending)
+        if notified:
+            # A side that missed its message is not paired again, the other
+            # side already has their details
+            record_event(state, 'match', bucket=bucket_names(key), leader_id=leader_id, member_id=member_id)
+            latency_ms = round((time.perf_counter() - start_time) * 1000, 1)
+            missed = sorted(unreachable | set(pending))
+            logger.info(
+                f"Successful match in guild {state.guild_id}, track {track}: "
+                f"Leader {leader_id} with Member {member_id} in {latency_ms}ms"
+                + (f", not delivered to {', '.join(map(str, missed))}" if missed else ""),
+                extra={'guild_id': state.guild_id, 'track': track, 'user_id': leader_id, 'latency_ms': latency_ms}
+            )
+            return True
+        
+        # Nobody was told, so the pair is undone: users Discord refused are
+        # dropped, a member who only failed for now goes back into the queue
+        logger.error(
+            f"Giving up on match notification for Leader {leader_id} with Member {member_id}",
+            extra={'guild_id': state.guild_id, 'track': track, 'user_id': leader_id}
+        )
+        for user_id in sorted(unreachable):
+            role = 'leader' if user_id == leader_id else 'member'
+            record_event(state, 'unreachable', bucket=bucket_names(key), user_id=user_id, role=role)
+        if member_id not in unreachable:
+            queue_member(state, member)
+        mark_dirty(state, key)
+        return False
+    finally:
+        state.in_flight.pop(leader_id, None)
+
+# Batch assignment engine
+# Alternative to the greedy matcher (MATCHING_ENGINE=batch). A track's
+# leader x member compatibility matrix is block diagonal, since a leader can
+# only take members from their own university and department, so each dirty
+# bucket is solved on its own as a maximum-weight bipartite assignment.
+MATCHING_ENGINE = os.getenv("MATCHING_ENGINE", "greedy")  # "greedy" or "batch"
+TOPIC_COVERAGE_WEIGHT = 0.5  # Weight of topic coverage (0-100) next to the rating (0-100)
+
+if MATCHING_ENGINE == 'batch' and np is None:
+    logger.warning("MATCHING_ENGINE=batch needs numpy, falling back to the greedy matcher")
+
+GAP_COVERAGE_WEIGHT = 1.0  # Weight of covering the leader's needed topics (0-100)
+
+def pair_weights(track, bucket_leaders, candidates):
+    # Weight of every (leader, member) pair: rating, topic coverage and coverage
+    # of the leader's needed topics, with a tiny bonus for earlier registration
+    # so ties keep the queue order
+    topic_count = len(track_score_vectors.get(track, [])) or 1
+    member_masks = np.array([member.topic_mask for member in candidates], dtype=np.int64)
+    member_weights = np.array([
+        member.rating
+        + TOPIC_COVERAGE_WEIGHT * 100 * bin(member.topic_mask).count('1') / topic_count
+        - rank * 1e-9
+        for rank, member in enumerate(candidates)
+    ])
+    weights = np.broadcast_to(member_weights, (len(bucket_leaders), len(candidates)))
+    
+    needed_masks = np.array([leader.needed_mask for leader in bucket_leaders], dtype=np.int64)
+    if not needed_masks.any():
+        return weights
+    table = mask_score_tables.get(track)
+    if table is not None:
+        scores = np.array(table, dtype=float)
+        needed_totals = scores[needed_masks]
+        overlap = scores[needed_masks[:, None] & member_masks[None, :]]
+    else:
+        # Too many topics for a subset table: add up the scores bit by bit,
+        # like mask_score, so both engines rank these tracks the same way
+        scores = np.array(track_score_vectors.get(track, []), dtype=float)
+        bits = np.left_shift(1, np.arange(len(scores), dtype=np.int64))
+        needed_bits = (needed_masks[:, None] & bits) != 0
+        member_bits = (member_masks[:, None] & bits) != 0
+        needed_totals = needed_bits @ scores
+        overlap = (needed_bits * scores) @ member_bits.T
+    coverage = np.divide(overlap * 100, needed_totals[:, None], out=np.zeros_like(overlap), where=needed_totals[:, None] > 0)
+    return weights + GAP_COVERAGE_WEIGHT * coverage
+
+def hungarian(cost):
+    # Shortest augmenting path Hungarian algorithm, minimizing cost; rows <= columns.
+    # The scan over columns is vectorized, so a row costs O(m) NumPy work per step.
+    n, m = cost.shape
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    owner = np.zeros(m + 1, dtype=np.int64)  # owner[j]: row (1-based) assigned to column j
+    way = np.zeros(m + 1, dtype=np.int64)
+    for i in range(1, n + 1):
+        owner[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = owner[j0]
+            reduced = cost[i0 - 1] - u[i0] - v[1:]
+            free = ~used[1:]
+            better = free & (reduced < minv[1:])
+            minv[1:][better] = reduced[better]
+            way[1:][better] = j0
+            candidates = np.where(free, minv[1:], np.inf)
+            j1 = int(np.argmin(candidates)) + 1
+            delta = candidates[j1 - 1]
+            u[owner[used]] += delta
+            v[used] -= delta
+            minv[~used] -= delta
+            j0 = j1
+            if owner[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            owner[j0] = owner[j1]
+            j0 = j1
+    rows = owner[1:] - 1
+    assigned = np.nonzero(owner[1:])[0]
+    return rows[assigned], assigned
+
+def solve_assignment(weights):
+    # Returns (row, column) pairs maximizing the total weight
+    if linear_sum_assignment is not None:
+        rows, cols = linear_sum_assignment(weights, maximize=True)
+        return list(zip(rows.tolist(), cols.tolist()))
+    if weights.shape[0] <= weights.shape[1]:
+        rows, cols = hungarian(-weights)
+        return list(zip(rows.tolist(), cols.tolist()))
+    cols, rows = hungarian(-weights.T)
+    return list(zip(rows.tolist(), cols.tolist()))
+
+def assign_bucket(state, key):
+    bucket_leaders = [leader for leader in state.leader_index.get(key, []) if leader.user_id not in state.in_flight]
+    heap = state.member_index.get(key, [])
+    candidates = sorted(member for member in heap if member.user_id in state.registered_users)
+    if not bucket_leaders or not candidates:
+        return []
+    
+    # Only a leader's top len(bucket_leaders) members can be part of an optimal
+    # assignment, so the matrix is pruned to the union of those shortlists
+    track = track_codes.value(key[0])
+    weights = pair_weights(track, bucket_leaders, candidates)
+    shortlist_size = len(bucket_leaders)
+    if len(candidates) > shortlist_size:
+        top = np.argpartition(-weights, shortlist_size - 1, axis=1)[:, :shortlist_size]
+        keep = np.unique(top)
+        candidates = [candidates[i] for i in keep]
+        weights = weights[:, keep]
+    
+    pairs = []
+    chosen = set()
+    for row, col in solve_assignment(np.ascontiguousarray(weights, dtype=float)):
+        leader = bucket_leaders[row]
+        member = candidates[col]
+        state.in_flight[leader.user_id] = member
+        chosen.add(member.user_id)
+        pairs.append((key, leader, member))
+    
+    # Take the assigned members out of the bucket heap
+    remaining = [member for member in heap if member.user_id not in chosen]
+    if remaining:
+        heapq.heapify(remaining)
+        state.member_index[key] = remaining
+    else:
+        state.member_index.pop(key, None)
+    return pairs
 
 #Perform_Matching Process Function
-async def perform_matching():
+async def perform_matching(state):
+    start_time = time.perf_counter()
     try:
-        matching_track_count = 0
+        pairs = []
+        
+        # Registrations received by other processes for the tracks this one owns
+        if state.queue_from_feed:
+            await poll_registration_feed(state)
         
-        for category, tracks in track_categories.items():
-            for track in tracks:
-                track_leaders = leaders.get(track, []).copy()
-                track_members = members.get(track, [])
+        # Only buckets touched since the last pass can produce a new match
+        buckets = list(state.dirty_buckets)
+        state.dirty_buckets.clear()
+        
+        member_index = state.member_index
+        in_flight = state.in_flight
+        use_batch_engine = MATCHING_ENGINE == 'batch' and np is not None
+        for key in buckets:
+            if use_batch_engine:
+                pairs.extend(assign_bucket(state, key))
+                continue
+            
+            for leader in state.leader_index.get(key, []):
+                if not member_index.get(key):
+                    break
+                if leader.user_id in in_flight:
+                    continue
                 
-                while track_leaders and track_members:
-                    try:
-                        leader = track_leaders[0]  # Don't pop yet, wait until match is confirmed
-                        matching_member = None
-                        temp_members = []
-                        
-                        while track_members:
-                            rating, reg_time, member = heapq.heappop(track_members)
-                            
-                            # Check if member is still in registered_users
-                            if (member['user_id'] in registered_users and 
-                                leader["university"] == member["university"] and 
-                                leader["department"] == member["department"]):
-                                matching_member = member
-                                break
-                            else:
-                                temp_members.append((rating, reg_time, member))
-                        
-                        # Restore unmatched members back to the heap
-                        for m in temp_members:
-                            heapq.heappush(track_members, m)
-                        
-                        if not matching_member:
-                            track_leaders.pop(0)  # Remove leader if no match found
-                            continue
-
-                        # Get the actual Discord User objects
-                        try:
-                            leader_user = await bot.fetch_user(leader['user_id'])
-                            member_user = await bot.fetch_user(matching_member['user_id'])
-                            
-                            if not leader_user or not member_user:
-                                logger.error("Could not fetch user objects")
-                                continue
-                                
-                            leader_channel = await leader_user.create_dm()
-                            member_channel = await member_user.create_dm()
-                        except discord.HTTPException as e:
-                            logger.error(f"Failed to create DM channels: {e}")
-                            continue
-
-                        # Format messages
-                        success_header = "```ansi\n\u001b[1;32m🎉 MATCHING SUCCESS! 🎉\u001b[0m\n```"
-                        
-                        leader_match_info = (
-                            f"{success_header}\n"
-                            f"**📋 Match Details**\n"
-                            f"```yml\n"
-                            f"Member Name   : {member_user.name}\n"
-                            f"University    : {matching_member['university']}\n"
-                            f"Department    : {matching_member['department'].upper()}\n"
-                            f"Track         : {matching_member['track']}\n"
-                            f"Team          : {leader['team_name']}\n"
-                            f"```\n"
-                        )
-
-                        member_match_info = (
-                            f"{success_header}\n"
-                            f"**📋 Match Details**\n"
-                            f"```yml\n"
-                            f"Team Leader   : {leader_user.name}\n"
-                            f"University    : {leader['university']}\n"
-                            f"Department    : {leader['department'].upper()}\n"
-                            f"Track         : {leader['track']}\n"
-                            f"Team          : {leader['team_name']}\n"
-                            f"```\n"
-                        )
-
-                        team_info = (
-                            f"**🏢 Team Information**\n"
-                            f"```ansi\n"
-                            f"\u001b[1;34m── Team Leader's Message ──\u001b[0m\n"
-                            f"{leader['team_comment']}\n"
-                            f"```"
-                        )
-
-                        topics_str = ", ".join(matching_member["selected_topics"])
-                        member_profile = (
-                            f"**👤 Member Profile**\n"
-                            f"```ansi\n"
-                            f"\u001b[1;33m── Technical Background ──\u001b[0m\n"
-                            f"• Track: {matching_member['track']}\n"
-                            f"• Rating: {matching_member['rating']}%\n\n"
-                            f"\u001b[1;33m── Topics Studied ──\u001b[0m\n"
-                            f"{topics_str}\n\n"
-                            f"\u001b[1;33m── Personal Note ──\u001b[0m\n"
-                            f"{matching_member['comment']}\n"
-                            f"```"
-                        )
-
-                        contact_info = (
-                            f"**📱 Next Steps**\n"
-                            f"```ansi\n"
-                            f"\u001b[1;35mYou can now communicate directly through Discord!\u001b[0m\n"
-                            f"Feel free to discuss project details and next steps.\n"
-                            f"```"
-                        )
-
-                        # Send all messages with error handling
-                        try:
-                            await leader_channel.send(leader_match_info)
-                            await leader_channel.send(team_info)
-                            await leader_channel.send(member_profile)
-                            await leader_channel.send(contact_info)
-                            
-                            await member_channel.send(member_match_info)
-                            await member_channel.send(team_info)
-                            await member_channel.send(member_profile)
-                            await member_channel.send(contact_info)
-                            
-                            # Only proceed with cleanup if messages were sent successfully
-                            # Clean up after successful match
-                            leader_id = leader['user_id']
-                            member_id = matching_member['user_id']
-                            
-                            track_leaders.pop(0)  # Now safe to remove the leader
-                            leaders[track] = [l for l in leaders[track] if l['user_id'] != leader_id]
-                            
-                            if leader_id in user_data:
-                                del user_data[leader_id]
-                            if member_id in user_data:
-                                del user_data[member_id]
-                            
-                            registered_users.discard(member_id)
-                            matched_members.add(member_id)
-                            
-                            if leader_id in leader_departments:
-                                del leader_departments[leader_id]
-                            
-                            matching_track_count += 1
-                            logger.info(f"Successful match in track {track}: Leader {leader_id} with Member {member_id}")
-                            
-                        except discord.HTTPException as e:
-                            logger.error(f"Failed to send match messages: {e}")
-                            continue
-                        except Exception as e:
-                            logger.error(f"Error during match cleanup: {e}")
-                            continue
-                        
-                    except Exception as e:
-                        logger.error(f"Error in matching process for track {track}: {str(e)}")
-                        continue
+                # Best compatible member comes from the leader's (track, university, department) bucket
+                matching_member = pop_best_member_for(state, key, leader)
+                if not matching_member:
+                    break
+                
+                in_flight[leader.user_id] = matching_member
+                pairs.append((key, leader, matching_member))
         
-        # Save data after all matches are complete
-        try:
-            save_data()
-        except Exception as e:
-            logger.error(f"Error saving data after matching: {str(e)}")
+        # Deliver every pair concurrently, one slow or failing DM no longer holds up the rest
+        results = await asyncio.gather(
+            *(deliver_match(state, key, leader, member) for key, leader, member in pairs),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f"Error in matching process: {str(result)}")
+        if pairs:
+            logger.info(f"Resolver cache stats: {resolver_stats}")
         
-        return matching_track_count
+        # Matches are journaled as they happen, compact_journal folds them into the snapshot
+        matches = sum(1 for result in results if result is True)
+        metrics.observe('bot_matching_pass_seconds', time.perf_counter() - start_time)
+        metrics.observe('bot_matches_per_pass', matches)
+        metrics.inc('bot_matches_total', matches)
+        return matches
         
     except Exception as e:
         logger.error(f"Error in perform_matching: {str(e)}")
@@ -999,47 +3336,307 @@ def format_info_message(message):
 def format_warning_message(message):
     return f"```ansi\n\u001b[1;33m⚠️ {message}\u001b[0m\n```"
 
+# Metrics endpoint
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 disables the endpoint
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+async def metrics_handler(request):
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+async def start_metrics_server():
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info(f"Metrics endpoint listening on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+# Stats Command for admins
+@bot.command(name="stats")
+@commands.has_permissions(administrator=True)
+async def stats(ctx):
+    state = await get_guild_state(guild_key(ctx.guild))
+    user_data = state.user_data
+    guild = str(state.guild_id)
+    member_depth = defaultdict(int)
+    leader_depth = defaultdict(int)
+    for name, labels, value in queue_depth_samples():
+        if labels['guild'] == guild:
+            (member_depth if name == 'bot_queue_members' else leader_depth)[labels['track']] = value
+    busiest = sorted(member_depth.items(), key=lambda item: item[1], reverse=True)[:5]
+    
+    passes, pass_seconds = metrics.histogram_totals('bot_matching_pass_seconds')
+    saves, save_seconds = metrics.histogram_totals('bot_save_seconds')
+    api_calls, api_seconds = metrics.histogram_totals('bot_discord_api_seconds')
+    
+    fields = [
+        ("📥 Queues",
+         f"Members: {sum(member_depth.values())}\n"
+         f"Leaders: {sum(leader_depth.values())}\n"
+         f"Sessions: {len(user_data)} (evicted {user_data.evictions['idle']} idle, {user_data.evictions['capacity']} over limit)\n"
+         f"Busiest: {', '.join(f'{track} ({depth})' for track, depth in busiest) or 'none'}", False),
+        ("🤝 Matching",
+         f"Passes: {passes}\n"
+         f"Average pass: {pass_seconds / passes if passes else 0:.2f}s\n"
+         f"Matches: {int(metrics.total('bot_matches_total'))}\n"
+         f"Merged requests: {state.coordinator.merged_requests}\n"
+         f"Loaded guilds: {len(guild_states)}", True),
+        ("💾 Persistence",
+         f"Saves: {saves}\n"
+         f"Average save: {save_seconds / saves * 1000 if saves else 0:.1f}ms\n"
+         f"Snapshot: {int(metrics.value('bot_save_bytes', guild=guild)) // 1024} KB", True),
+        ("🌐 Discord API",
+         f"Calls: {api_calls}\n"
+         f"Average latency: {api_seconds / api_calls * 1000 if api_calls else 0:.0f}ms\n"
+         f"Errors: {int(metrics.total('bot_discord_api_errors_total'))}\n"
+         f"Rate limited: {rate_limits.hits} (requeued {outbound.requeued})", True)
+    ]
+    await send_prompt(ctx, embed=format_embed_message("📊 Bot Statistics", "Current queue and performance summary", fields))
+
+# Catalog reload command for admins
+@bot.command(name="reload_catalog")
+@commands.has_permissions(administrator=True)
+async def reload_catalog_command(ctx):
+    reloaded, summary = await reload_catalog()
+    if reloaded:
+        await send_prompt(ctx, embed=format_embed_message("📚 Catalog Reloaded", summary))
+    else:
+        await send_prompt(ctx, format_error_message(f"Catalog not reloaded: {clip(summary, 1800)}"))
+
+# Single-flight matching coordinator
+# At most one perform_matching runs at a time. Requests that arrive during a
+# pass are merged into a single follow-up pass; every caller gets a future
+# with the result of the pass that covers its request.
+class MatchingCoordinator:
+    def __init__(self, run_pass):
+        self.run_pass = run_pass
+        self.running = False
+        self.pending = None  # Future of the follow-up pass, if one was requested
+        self.task = None
+        self.passes = 0
+        self.requests = 0
+        self.merged_requests = 0
+
+    def request(self):
+        self.requests += 1
+        loop = asyncio.get_running_loop()
+        if self.running:
+            if self.pending is None:
+                self.pending = loop.create_future()
+            else:
+                self.merged_requests += 1
+                metrics.inc('bot_matching_requests_merged_total')
+            return self.pending
+        
+        self.running = True
+        future = loop.create_future()
+        self.task = loop.create_task(self._run(future))
+        return future
+
+    async def _run(self, future):
+        try:
+            while future is not None:
+                try:
+                    future.set_result(await self.run_pass())
+                except Exception as e:
+                    future.set_exception(e)
+                self.passes += 1
+                future, self.pending = self.pending, None
+        finally:
+            self.running = False
+
 # Match Command with Enhanced Matching and Communication
 @bot.command(name="match")
 async def match(ctx):
-    bot.loop.create_task(perform_matching())
-    await ctx.send("Matching process started in the background.")
+    state = await get_guild_state(guild_key(ctx.guild))
+    state.coordinator.request()
+    await send_prompt(ctx, "Matching process started in the background.")
 
 
 # Automatic Matching Task
-@tasks.loop(seconds=30)
+# Each loaded guild has its own schedule: a guild with pending work gets a
+# pass every MATCH_INTERVAL seconds, an unchanged one backs off towards
+# MATCH_IDLE_INTERVAL, and mark_dirty makes it due again right away. Passes
+# of different guilds run concurrently through their own coordinators, and
+# auto_match only starts them, so no guild waits for another's pass.
+MATCH_INTERVAL = 30  # Seconds between passes while there is pending work
+MATCH_IDLE_INTERVAL = 600  # Longest wait between passes when nothing changes
+GUILD_SCAN_INTERVAL = 300  # Seconds between scans for guilds another process has registered users in
+next_guild_scan_at = 0.0  # Monotonic time of the next scan
+
+def load_stored_guilds():
+    # With a shared queue this process owns tracks in every guild, including
+    # ones whose commands only ever reach another process
+    for guild_id in stored_guild_ids():
+        if guild_id not in guild_states:
+            start_guild_load(guild_id)
+
+def log_pass_error(future):
+    if not future.cancelled() and future.exception():
+        logger.error(f"Matching pass failed: {future.exception()}")
+
+@tasks.loop(seconds=MATCH_INTERVAL)
 async def auto_match():
-    await perform_matching()
+    global next_guild_scan_at
+    now = time.monotonic()
+    if SHARED_QUEUE and now >= next_guild_scan_at:
+        next_guild_scan_at = now + GUILD_SCAN_INTERVAL
+        load_stored_guilds()
+    for state in list(guild_states.values()):
+        if now < state.next_match_at:
+            continue
+        # A shared queue can only see new registrations by polling, so every cycle runs a pass
+        if state.dirty_buckets or state.queue_from_feed:
+            state.match_interval = MATCH_INTERVAL
+            # Not awaited: a slow guild, waiting on notification retries or a
+            # rate limit, must not hold up the schedule of the others
+            state.coordinator.request().add_done_callback(log_pass_error)
+        else:
+            # Nothing changed since the last pass, back off towards the idle interval
+            state.match_interval = min(state.match_interval * 2, MATCH_IDLE_INTERVAL)
+        state.next_match_at = now + state.match_interval
+
+# In-process maintenance
+# Replaces the old 45 minute os.execv restart: compacts persisted state, drops
+# stale queue entries and finished sessions, unloads idle guilds, expires
+# cached DM channels and nudges the gateway if heartbeats stopped, then logs
+# what it reclaimed.
+MAINTENANCE_INTERVAL = 45  # Minutes between maintenance runs
+RESTART_INTERVAL_MINUTES = int(os.getenv("RESTART_INTERVAL_MINUTES", "0"))  # 0 disables scheduled restarts
+
+def prune_queues(state):
+    member_index = state.member_index
+    leader_index = state.leader_index
+    stale_entries = 0
+    for key in list(member_index.keys()):
+        heap = member_index[key]
+        live = [member for member in heap if member.user_id in state.registered_users]
+        stale_entries += len(heap) - len(live)
+        if live:
+            if len(live) != len(heap):
+                heapq.heapify(live)
+                member_index[key] = live
+        else:
+            del member_index[key]
+    
+    empty_buckets = 0
+    for key in list(leader_index.keys()):
+        if not leader_index[key]:
+            del leader_index[key]
+            empty_buckets += 1
+    return stale_entries, empty_buckets
+
+def evict_finished_sessions(state):
+    # Members who completed registration no longer need their partial session
+    finished = [user_id for user_id in state.user_data if user_id in state.registered_users]
+    for user_id in finished:
+        record_event(state, 'session_clear', user_id=user_id)
+    return len(finished)
+
+def expire_dm_channels():
+    now = time.monotonic()
+    expired = [user_id for user_id, (channel, expires_at) in dm_channel_cache.items() if expires_at <= now]
+    for user_id in expired:
+        del dm_channel_cache[user_id]
+    return len(expired)
+
+async def check_gateway():
+    # discord.py reconnects by itself once the socket closes; a socket that
+    # stopped heartbeating is closed so that reconnect can happen. A sharded
+    # bot has no single socket (bot.ws is None), each shard is checked instead
+    if isinstance(bot, commands.AutoShardedBot):
+        stalled = [
+            shard for shard in bot.shards.values()
+            if not shard.is_closed() and not math.isfinite(shard.latency)
+        ]
+        for shard in stalled:
+            logger.warning(f"Gateway heartbeat lost on shard {shard.id}, forcing a reconnect")
+            await shard.reconnect()
+        return bool(stalled)
+    if bot.ws is not None and not math.isfinite(bot.latency):
+        logger.warning("Gateway heartbeat lost, forcing a reconnect")
+        await bot.ws.close(code=4000)
+        return True
+    return False
+
+@tasks.loop(minutes=MAINTENANCE_INTERVAL)
+async def maintenance():
+    if maintenance.current_loop == 0:
+        return  # Nothing to reclaim right after startup
+    
+    start_time = time.perf_counter()
+    stale_entries = empty_buckets = sessions = 0
+    for state in list(guild_states.values()):
+        stale, empty = prune_queues(state)
+        stale_entries += stale
+        empty_buckets += empty
+        sessions += evict_finished_sessions(state) + state.user_data.evict_idle()
+        if STORAGE_BACKEND == 'sqlite':
+            await run_db(state.sqlite_store.save_sessions, serialize_sessions(state))
+        else:
+            save_data(state)
+    guilds = await evict_idle_guilds()
+    dm_channels = expire_dm_channels()
+    rate_limits.prune()
+    collected = gc.collect()
+    reconnected = await check_gateway()
+    
+    logger.info(
+        f"Maintenance reclaimed {stale_entries} stale queue entries, {empty_buckets} empty buckets, "
+        f"{sessions} finished or idle sessions, {guilds} idle guilds, {dm_channels} expired DM channels and {collected} objects "
+        f"(gateway reconnect: {reconnected}) in {(time.perf_counter() - start_time) * 1000:.1f}ms"
+    )
+
+@tasks.loop(minutes=45)
+async def scheduled_restart():
+    if scheduled_restart.current_loop == 0:
+        return  # The first iteration runs immediately on start
+    schedule_restart()
 
 # Start the auto-match task when the bot is ready
 # Update the bot's event handlers
+# Publishes the slash commands once per process, after login and before the
+# gateway connects
+@bot.event
+async def setup_hook():
+    try:
+        synced = await bot.tree.sync()
+        logger.info(f"Synced {len(synced)} slash commands")
+    except discord.HTTPException as e:
+        logger.error(f"Failed to sync slash commands: {str(e)}")
+
+# on_ready fires again after every reconnect, so it only starts what is not
+# running yet; state was already loaded by startup() before bot.start
 @bot.event
 async def on_ready():
     print(f'Logged in as {bot.user}')
     logger.info(f'Bot logged in as {bot.user}')
-    load_data()  # Load saved data
-    auto_match.start()
-    
-    # Schedule restart every hour
-    schedule.every(45).minutes.do(schedule_restart)
+    if not startup_complete:
+        await startup()
+    for task in (auto_match, compact_journal, maintenance, watch_catalog):
+        if not task.is_running():
+            task.start()
     
-    # Start schedule checker
-    while True:
-        schedule.run_pending()
-        await asyncio.sleep(30)
+    # Process restarts are opt-in, maintenance keeps a long-running process healthy
+    if RESTART_INTERVAL_MINUTES > 0 and not scheduled_restart.is_running():
+        scheduled_restart.change_interval(minutes=RESTART_INTERVAL_MINUTES)
+        scheduled_restart.start()
 
 @bot.event
 async def on_command_error(ctx, error):
     if isinstance(error, commands.CommandNotFound):
-        await ctx.send("```❌ Invalid command. Use `!helpbot` for a list of commands.```")
+        await send_prompt(ctx, "```❌ Invalid command. Use `!helpbot` for a list of commands.```")
     elif isinstance(error, commands.MissingRequiredArgument):
-        await ctx.send("```❌ Missing required argument. Please check the command usage.```")
+        await send_prompt(ctx, "```❌ Missing required argument. Please check the command usage.```")
+    elif isinstance(error, commands.MissingPermissions):
+        await send_prompt(ctx, "```❌ You don't have permission to use this command.```")
     elif isinstance(error, commands.CommandOnCooldown):
-        await ctx.send(f"```⏳ Please wait {error.retry_after:.2f}s before using this command again.```")
+        await send_prompt(ctx, f"```⏳ Please wait {error.retry_after:.2f}s before using this command again.```")
     else:
         error_msg = f"Command error: {str(error)}"
         logger.error(error_msg)
-        await ctx.send(f"```❌ An error occurred. Please try again later.\nError: {str(error)}```")
+        await send_prompt(ctx, f"```❌ An error occurred. Please try again later.\nError: {str(error)}```")
     
 
 # Run the bot
@@ -1051,14 +3648,22 @@ async def main():
         # Handle shutdown gracefully
         def signal_handler(sig, frame):
             logger.info("Shutdown signal received")
-            save_data()
+            save_all()
+            flush_state()
             sys.exit(0)
         
         signal.signal(signal.SIGINT, signal_handler)
         signal.signal(signal.SIGTERM, signal_handler)
         
         async with bot:
-            await bot.start(os.getenv("DISCORD_BOT_TOKEN"))
+            # Logged in first so startup can ask Discord which servers the bot is in
+            await bot.login(os.getenv("DISCORD_BOT_TOKEN"))
+            await startup()
+            
+            if METRICS_PORT:
+                await start_metrics_server()
+            
+            await bot.connect()
     except Exception as e:
         logger.error(f"Main function error: {str(e)}")
         sys.exit(1)
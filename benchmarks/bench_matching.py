@@ -0,0 +1,427 @@
+"""Benchmarks for the matching engine and persistence layer.
+
+Generates a synthetic cohort spread over one or more guilds, runs the bot's
+rating, registration, persistence and matching code against an in-process
+fake of the discord.py User/DMChannel API, and writes throughput, p50/p99
+latency and peak memory per stage to a JSON file so runs from different
+commits can be compared.
+
+    python benchmarks/bench_matching.py --members 20000 --leaders 4000 --latency-ms 40
+    python benchmarks/bench_matching.py --members 20000 --leaders 4000 --guilds 8
+    python benchmarks/bench_matching.py --compare benchmarks/results/old.json benchmarks/results/new.json
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_RESULTS_DIR = os.path.join(REPO_ROOT, "benchmarks", "results")
+DEPARTMENTS = ["cs", "it", "is", "ai", "sw", "bio"]
+
+
+# Fake Discord client
+class FakeDMChannel:
+    def __init__(self, client, user):
+        self.client = client
+        self.user = user
+        self.id = user.id
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        await self.client.api_call()
+        self.sent += 1
+
+
+class FakeUser:
+    def __init__(self, client, user_id):
+        self.client = client
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.dm_channel = None
+
+    async def create_dm(self):
+        await self.client.api_call()
+        self.dm_channel = FakeDMChannel(self.client, self)
+        return self.dm_channel
+
+
+class FakeDiscordClient:
+    # Stands in for the REST side of discord.py: every call sleeps for the
+    # configured latency and fails with the configured probability.
+    def __init__(self, latency, jitter, failure_rate, rng):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.rng = rng
+        self.users = {}
+        self.calls = 0
+        self.failures = 0
+
+    async def api_call(self):
+        self.calls += 1
+        delay = self.latency + self.rng.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if self.failure_rate and self.rng.random() < self.failure_rate:
+            self.failures += 1
+            raise RuntimeError("simulated Discord API failure")
+
+    def get_user(self, user_id):
+        return None  # Cold gateway cache, every lookup goes to fetch_user
+
+    async def fetch_user(self, user_id):
+        await self.api_call()
+        return self.users.setdefault(user_id, FakeUser(self, user_id))
+
+
+# Synthetic cohort
+def skewed_choice(rng, items, skew):
+    # Zipf-like: item i is picked with weight 1 / (i + 1) ** skew, skew 0 is uniform
+    weights = [1 / (i + 1) ** skew for i in range(len(items))]
+    return rng.choices(items, weights=weights, k=1)[0]
+
+
+def generate_cohort(bot_module, member_count, leader_count, skew, rng):
+    tracks = [track for tracks in bot_module.track_categories.values() for track in tracks]
+    cohort_members = []
+    cohort_leaders = []
+    next_id = 10 ** 17  # Discord-sized snowflakes
+
+    for i in range(member_count):
+        track = skewed_choice(rng, tracks, skew)
+        topics = [topic['name'] for topic in bot_module.track_topics[track] if rng.random() < 0.5]
+        cohort_members.append({
+            'user_id': next_id + i,
+            'user_name': f"member{i}",
+            'track': track,
+            'rating': 0,
+            'comment': "Synthetic member " * rng.randint(1, 20),
+            'department': skewed_choice(rng, DEPARTMENTS, skew),
+            'university': skewed_choice(rng, bot_module.universities, skew),
+            'selected_topics': topics,
+            'registration_time': 1_700_000_000 + i
+        })
+    next_id += member_count
+
+    for i in range(leader_count):
+        cohort_leaders.append({
+            'user_id': next_id + i,
+            'user_name': f"leader{i}",
+            'team_name': f"Team {i}",
+            'track': skewed_choice(rng, tracks, skew),
+            'team_comment': "Synthetic project idea " * rng.randint(1, 20),
+            'department': skewed_choice(rng, DEPARTMENTS, skew),
+            'university': skewed_choice(rng, bot_module.universities, skew)
+        })
+    return cohort_members, cohort_leaders
+
+
+# Measurement helpers
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(name, items, elapsed, latencies, peak_bytes, **extra):
+    result = {
+        'stage': name,
+        'items': items,
+        'seconds': round(elapsed, 6),
+        'throughput_per_s': round(items / elapsed, 2) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 4),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 4),
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 4) if latencies else 0.0,
+        'peak_memory_kb': round(peak_bytes / 1024, 1)
+    }
+    result.update(extra)
+    return result
+
+
+class Stage:
+    # Context manager timing a stage and tracking its peak traced memory
+    def __enter__(self):
+        tracemalloc.reset_peak()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+        self.peak = tracemalloc.get_traced_memory()[1]
+
+
+def reset_state(bot_module, guild_count):
+    # Every guild keeps its files in its own directory under GUILD_DATA_DIR
+    bot_module.guild_states.clear()
+    bot_module.dm_channel_cache.clear()
+    for guild_id in range(guild_count):
+        bot_module.guild_states[guild_id] = bot_module.GuildState(guild_id)
+    return list(bot_module.guild_states.values())
+
+
+def guild_for(states, index):
+    return states[index % len(states)]
+
+
+def queued_count(states):
+    return sum(len(heap) for state in states for heap in state.member_index.values())
+
+
+# Stages
+def bench_rating(bot_module, states, cohort_members):
+    latencies = []
+    with Stage() as stage:
+        for index, member in enumerate(cohort_members):
+            state = guild_for(states, index)
+            user_id = member['user_id']
+            state.user_data[user_id] = {'track': member['track'], 'selected_topics': member['selected_topics']}
+            start = time.perf_counter()
+            member['rating'] = bot_module.calculate_rating(state, user_id)
+            latencies.append(time.perf_counter() - start)
+    for state in states:
+        state.user_data.clear()
+    return summarize('calculate_rating', len(cohort_members), stage.elapsed, latencies, stage.peak)
+
+
+def bench_rerate(bot_module, states):
+    async def rerate_states():
+        return sum([await bot_module.rerate_guild(state) for state in states])
+
+    with Stage() as stage:
+        rerated = asyncio.run(rerate_states())
+    return summarize('rerate_guild', rerated, stage.elapsed, [stage.elapsed], stage.peak,
+                     numpy=bot_module.np is not None)
+
+
+def bench_register(bot_module, states, cohort_members, cohort_leaders):
+    latencies = []
+    with Stage() as stage:
+        for index, member in enumerate(cohort_members):
+            start = time.perf_counter()
+            bot_module.record_event(guild_for(states, index), 'register_member', member=dict(member))
+            latencies.append(time.perf_counter() - start)
+        for index, leader in enumerate(cohort_leaders):
+            start = time.perf_counter()
+            bot_module.record_event(guild_for(states, index), 'register_leader', leader=dict(leader))
+            latencies.append(time.perf_counter() - start)
+    return summarize('record_event', len(latencies), stage.elapsed, latencies, stage.peak)
+
+
+def bench_save(bot_module, states, repeat):
+    # Latency covers the full write of every guild; blocking_ms is the part spent on the caller
+    latencies = []
+    blocking = []
+    with Stage() as stage:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for state in states:
+                bot_module.save_data(state)
+            blocking.append(time.perf_counter() - start)
+            bot_module.flush_state()
+            latencies.append(time.perf_counter() - start)
+    return summarize('save_data', repeat, stage.elapsed, latencies, stage.peak,
+                     bytes=sum(os.path.getsize(state.data_file) for state in states),
+                     blocking_ms=round(statistics.median(blocking) * 1000, 3))
+
+
+def bench_load(bot_module, states, repeat):
+    latencies = []
+    with Stage() as stage:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for state in states:
+                bot_module.load_data(state)
+            latencies.append(time.perf_counter() - start)
+    queued = queued_count(states)
+    return summarize('load_data', repeat, stage.elapsed, latencies, stage.peak, queued_members=queued)
+
+
+def bench_startup(bot_module, guild_count):
+    # Restart-to-ready on the snapshots written by bench_save, phase by phase,
+    # with every guild preloaded; load_guild_ms is the first-activity load of one guild
+    bot_module.guild_states.clear()
+    bot_module.PRELOAD_GUILD_IDS = list(range(guild_count))
+    with Stage() as stage:
+        asyncio.run(bot_module.startup())
+    states = list(bot_module.guild_states.values())
+    phases_ms = {phase: round(seconds * 1000, 3) for phase, seconds in bot_module.startup_timings.items()}
+    return states, summarize('startup', queued_count(states), stage.elapsed, [stage.elapsed], stage.peak,
+                             phases_ms=phases_ms, load_guild_ms=round(phases_ms['load_guilds'] / guild_count, 3))
+
+
+def bench_matching(bot_module, states, client):
+    latencies = []
+    original_deliver = bot_module.deliver_match
+
+    async def timed_deliver(state, key, leader, member):
+        start = time.perf_counter()
+        try:
+            return await original_deliver(state, key, leader, member)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    async def run_passes():
+        passes = 0
+        matches = 0
+        # Keep matching until nothing is left to do, like consecutive auto_match
+        # cycles; the guilds' passes run concurrently
+        while any(state.dirty_buckets for state in states):
+            results = await asyncio.gather(*(
+                state.coordinator.request() for state in states if state.dirty_buckets
+            ))
+            matches += sum(results)
+            passes += len(results)
+        return passes, matches
+
+    bot_module.deliver_match = timed_deliver
+    try:
+        with Stage() as stage:
+            passes, matches = asyncio.run(run_passes())
+    finally:
+        bot_module.deliver_match = original_deliver
+    return summarize('perform_matching', matches, stage.elapsed, latencies, stage.peak,
+                     passes=passes, api_calls=client.calls, api_failures=client.failures,
+                     resolver_stats=dict(bot_module.resolver_stats))
+
+
+# Entry points
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def load_bot_module(workdir):
+    # The bot writes its log and data files relative to the working directory
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+    return importlib.import_module("Graduation_Team_Matching_Discord_Bot")
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="bench_matching_")
+    bot_module = load_bot_module(workdir)
+    client = FakeDiscordClient(args.latency_ms / 1000, args.jitter_ms / 1000, args.failure_rate, rng)
+    bot_module.bot.get_user = client.get_user
+    bot_module.bot.fetch_user = client.fetch_user
+    bot_module.NOTIFY_RETRY_DELAY = args.retry_delay_ms / 1000
+    bot_module.MATCHING_ENGINE = args.engine
+    bot_module.JOURNAL_COMPACT_THRESHOLD = float("inf")  # Measure save_data on its own
+    states = reset_state(bot_module, args.guilds)
+
+    cohort_members, cohort_leaders = generate_cohort(bot_module, args.members, args.leaders, args.skew, rng)
+
+    tracemalloc.start()
+    stages = [
+        bench_rating(bot_module, states, cohort_members),
+        bench_register(bot_module, states, cohort_members, cohort_leaders),
+        bench_rerate(bot_module, states),
+        bench_save(bot_module, states, args.repeat),
+        bench_load(bot_module, states, args.repeat)
+    ]
+    states, startup_stage = bench_startup(bot_module, args.guilds)
+    stages.append(startup_stage)
+    stages.append(bench_matching(bot_module, states, client))
+    tracemalloc.stop()
+
+    return {
+        'label': args.label or git_revision(),
+        'revision': git_revision(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {
+            'members': args.members,
+            'leaders': args.leaders,
+            'guilds': args.guilds,
+            'skew': args.skew,
+            'latency_ms': args.latency_ms,
+            'jitter_ms': args.jitter_ms,
+            'failure_rate': args.failure_rate,
+            'engine': args.engine,
+            'seed': args.seed,
+            'repeat': args.repeat
+        },
+        'stages': stages
+    }
+
+
+def print_report(report):
+    print(f"{report['label']} ({report['revision']}) {report['config']}")
+    print(f"{'stage':<18}{'items':>9}{'seconds':>11}{'per s':>13}{'p50 ms':>11}{'p99 ms':>11}{'peak KB':>12}")
+    for stage in report['stages']:
+        print(
+            f"{stage['stage']:<18}{stage['items']:>9}{stage['seconds']:>11.3f}"
+            f"{stage['throughput_per_s'] or 0:>13.1f}{stage['p50_ms']:>11.3f}{stage['p99_ms']:>11.3f}"
+            f"{stage['peak_memory_kb']:>12.1f}"
+        )
+
+
+def compare(baseline_path, candidate_path):
+    with open(baseline_path) as f:
+        baseline = {stage['stage']: stage for stage in json.load(f)['stages']}
+    with open(candidate_path) as f:
+        candidate = json.load(f)
+    print(f"{'stage':<18}{'metric':<18}{'baseline':>12}{'candidate':>12}{'change':>10}")
+    for stage in candidate['stages']:
+        before = baseline.get(stage['stage'])
+        if not before:
+            continue
+        for metric in ('throughput_per_s', 'p50_ms', 'p99_ms', 'peak_memory_kb'):
+            old, new = before.get(metric) or 0, stage.get(metric) or 0
+            change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+            print(f"{stage['stage']:<18}{metric:<18}{old:>12.3f}{new:>12.3f}{change:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--members", type=int, default=10000, help="queued members in the cohort")
+    parser.add_argument("--leaders", type=int, default=2000, help="leaders in the cohort")
+    parser.add_argument("--guilds", type=int, default=1, help="guilds the cohort is spread over")
+    parser.add_argument("--skew", type=float, default=1.0, help="Zipf exponent across tracks, universities and departments")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="fake Discord API latency per call")
+    parser.add_argument("--jitter-ms", type=float, default=10.0, help="extra random latency per call")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="probability a fake API call fails")
+    parser.add_argument("--retry-delay-ms", type=float, default=10.0, help="NOTIFY_RETRY_DELAY used during the run")
+    parser.add_argument("--engine", choices=("greedy", "batch"), default="greedy", help="MATCHING_ENGINE used during the run")
+    parser.add_argument("--repeat", type=int, default=3, help="repetitions of the save and load stages")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--label", help="name of this run, defaults to the git revision")
+    parser.add_argument("--output", help="result file, defaults to benchmarks/results/<label>.json")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CANDIDATE"), help="compare two result files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    # run() switches to a scratch directory, so resolve the output path first
+    output = os.path.abspath(args.output) if args.output else None
+    report = run(args)
+    output = output or os.path.join(DEFAULT_RESULTS_DIR, f"{report['label']}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print_report(report)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
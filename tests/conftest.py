@@ -0,0 +1,27 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+
+@pytest.fixture(scope="session")
+def bot_module(tmp_path_factory):
+    # The bot writes its log and data files relative to the working directory
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("bot"))
+    try:
+        yield importlib.import_module("Graduation_Team_Matching_Discord_Bot")
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture
+def workdir(bot_module, tmp_path, monkeypatch):
+    # A fresh directory per test, so guild files never leak between tests
+    monkeypatch.chdir(tmp_path)
+    bot_module.guild_states.clear()
+    return tmp_path
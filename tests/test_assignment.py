@@ -0,0 +1,47 @@
+import itertools
+import random
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+
+def brute_force_best(weights):
+    rows, cols = weights.shape
+    if rows <= cols:
+        return max(
+            sum(weights[row, col] for row, col in enumerate(chosen))
+            for chosen in itertools.permutations(range(cols), rows)
+        )
+    return max(
+        sum(weights[row, col] for col, row in enumerate(chosen))
+        for chosen in itertools.permutations(range(rows), cols)
+    )
+
+
+@pytest.mark.parametrize("shape", [(1, 1), (1, 4), (2, 5), (3, 3), (4, 6), (5, 5), (4, 1), (5, 2), (6, 4)])
+def test_solve_assignment_matches_brute_force(bot_module, monkeypatch, shape):
+    # scipy is optional, the built-in Hungarian solver is the path under test
+    monkeypatch.setattr(bot_module, 'linear_sum_assignment', None)
+    rng = random.Random(f"{shape}")
+    rows, cols = shape
+    for _ in range(40):
+        # Small integer weights make ties common, which is where solvers slip
+        weights = np.array([[rng.randint(0, 9) for _ in range(cols)] for _ in range(rows)], dtype=float)
+        pairs = bot_module.solve_assignment(weights)
+
+        assert len(pairs) == min(rows, cols)
+        assert len({row for row, col in pairs}) == len(pairs)
+        assert len({col for row, col in pairs}) == len(pairs)
+        assert all(0 <= row < rows and 0 <= col < cols for row, col in pairs)
+        assert sum(weights[row, col] for row, col in pairs) == pytest.approx(brute_force_best(weights))
+
+
+def test_solve_assignment_handles_negative_and_fractional_weights(bot_module, monkeypatch):
+    monkeypatch.setattr(bot_module, 'linear_sum_assignment', None)
+    rng = random.Random(7)
+    for rows, cols in [(3, 5), (5, 3), (4, 4)]:
+        for _ in range(40):
+            weights = np.array([[rng.uniform(-50, 150) for _ in range(cols)] for _ in range(rows)])
+            pairs = bot_module.solve_assignment(weights)
+            assert sum(weights[row, col] for row, col in pairs) == pytest.approx(brute_force_best(weights))
@@ -0,0 +1,127 @@
+import asyncio
+
+import discord
+import pytest
+
+TRACK = ".net"
+UNIVERSITY = "Cairo University"
+
+
+def make_pair(bot, team_name="Team", member_id=1, leader_id=2):
+    member = bot.Member.from_dict({
+        'user_id': member_id, 'user_name': f"member{member_id}", 'track': TRACK, 'rating': 50, 'comment': "comment",
+        'department': "cs", 'university': UNIVERSITY, 'selected_topics': ["C# Basics"], 'registration_time': 1
+    })
+    leader = bot.Leader.from_dict({
+        'user_id': leader_id, 'user_name': f"leader{leader_id}", 'team_name': team_name, 'track': TRACK,
+        'team_comment': "idea", 'department': "cs", 'university': UNIVERSITY, 'desired_topics': []
+    })
+    return leader, member
+
+
+def test_match_embed_stays_within_discord_limits_for_long_team_names(bot_module):
+    leader, member = make_pair(bot_module, team_name="x" * 5000)
+    for for_leader in (True, False):
+        embed = bot_module.build_match_embed(leader, member, for_leader)
+        assert all(len(field.value) <= 1024 for field in embed.fields)
+        assert len(embed.description) <= 4096
+        assert len(embed) <= 6000
+
+
+class Response:
+    def __init__(self, status):
+        self.status = status
+        self.reason = "error"
+
+
+def dm_closed():
+    return discord.Forbidden(Response(403), {'message': "Cannot send messages to this user", 'code': 50007})
+
+
+def server_error():
+    return discord.HTTPException(Response(503), "unavailable")
+
+
+@pytest.fixture
+def matching(bot_module, workdir, monkeypatch):
+    bot = bot_module
+    monkeypatch.setattr(bot, 'STORAGE_BACKEND', 'json')
+    monkeypatch.setattr(bot, 'SHARED_QUEUE', False)
+    monkeypatch.setattr(bot, 'MATCHING_ENGINE', 'greedy')
+    monkeypatch.setattr(bot, 'NOTIFY_RETRY_DELAY', 0)
+    state = bot.GuildState(77)
+    failures = {}  # user_id -> exception every send to them raises
+    sent = []  # user_ids of every attempted send
+
+    async def send_dm(user_id, embed):
+        sent.append(user_id)
+        if user_id in failures:
+            raise failures[user_id]
+
+    monkeypatch.setattr(bot, 'send_dm', send_dm)
+    return state, failures, sent
+
+
+def register(bot, state, leader, *members):
+    bot.record_event(state, 'register_leader', leader=leader.to_dict())
+    for member in members:
+        bot.record_event(state, 'register_member', member=member.to_dict())
+
+
+def queued_ids(bot, state):
+    return sorted(member.user_id for member in bot.queued_members(state))
+
+
+def test_closed_dms_are_not_retried_or_requeued(bot_module, matching):
+    bot = bot_module
+    state, failures, sent = matching
+    leader, member = make_pair(bot)
+    register(bot, state, leader, member)
+    failures[1] = dm_closed()
+
+    assert asyncio.run(bot.perform_matching(state)) == 1
+    # The leader has the member's details, so the match stands and the member is not retried
+    assert sorted(sent) == [1, 2]
+    assert queued_ids(bot, state) == []
+    assert not state.leader_index
+
+
+def test_unreachable_member_is_dropped_when_nobody_was_notified(bot_module, matching):
+    bot = bot_module
+    state, failures, sent = matching
+    leader, member = make_pair(bot)
+    register(bot, state, leader, member)
+    failures[1] = dm_closed()
+    failures[2] = server_error()
+
+    assert asyncio.run(bot.perform_matching(state)) == 0
+    assert sent.count(1) == 1
+    assert sent.count(2) == bot.NOTIFY_ATTEMPTS
+    assert queued_ids(bot, state) == []
+    assert [l.user_id for leaders in state.leader_index.values() for l in leaders] == [2]
+
+    # Dropped for good, also after a restart
+    restored = bot.GuildState(77)
+    bot.load_data(restored)
+    assert queued_ids(bot, restored) == []
+    assert 1 not in restored.registered_users
+
+    # The leader is matched with the next member once they can be reached
+    del failures[2]
+    _, other = make_pair(bot, member_id=3)
+    bot.record_event(state, 'register_member', member=other.to_dict())
+    assert asyncio.run(bot.perform_matching(state)) == 1
+
+
+def test_leader_is_not_notified_twice_when_the_member_misses_the_message(bot_module, matching):
+    bot = bot_module
+    state, failures, sent = matching
+    leader, member = make_pair(bot)
+    _, other = make_pair(bot, member_id=3)
+    register(bot, state, leader, member, other)
+    failures[1] = server_error()
+
+    asyncio.run(bot.perform_matching(state))
+    asyncio.run(bot.perform_matching(state))
+    assert sent.count(2) == 1
+    assert 3 in queued_ids(bot, state)
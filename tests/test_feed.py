@@ -0,0 +1,117 @@
+import asyncio
+import time
+import zlib
+
+import pytest
+
+GUILD_ID = 555
+UNIVERSITY = "Cairo University"
+
+
+@pytest.fixture
+def shared_queue(bot_module, workdir, monkeypatch):
+    # Two processes over one SQLite database; PROCESS_INDEX is switched to
+    # act as one process or the other
+    monkeypatch.setattr(bot_module, 'STORAGE_BACKEND', 'sqlite')
+    monkeypatch.setattr(bot_module, 'SHARED_QUEUE', True)
+    monkeypatch.setattr(bot_module, 'PROCESS_COUNT', 2)
+    monkeypatch.setattr(bot_module, 'PROCESS_INDEX', 0)
+    sent = []
+
+    async def send_dm(user_id, embed):
+        sent.append(user_id)
+
+    monkeypatch.setattr(bot_module, 'send_dm', send_dm)
+    return sent
+
+
+def track_owned_by(bot, process_index):
+    return next(track for track in bot.track_topics if zlib.crc32(track.encode('utf-8')) % 2 == process_index)
+
+
+def member(user_id, track):
+    return {
+        'user_id': user_id, 'user_name': f"member{user_id}", 'track': track, 'rating': 50, 'comment': "comment",
+        'department': "cs", 'university': UNIVERSITY, 'selected_topics': [], 'registration_time': time.time()
+    }
+
+
+def leader(user_id, track):
+    return {
+        'user_id': user_id, 'user_name': f"leader{user_id}", 'team_name': "Team", 'track': track,
+        'team_comment': "idea", 'department': "cs", 'university': UNIVERSITY, 'desired_topics': []
+    }
+
+
+async def load_as(bot, monkeypatch, process_index):
+    monkeypatch.setattr(bot, 'PROCESS_INDEX', process_index)
+    state = bot.GuildState(GUILD_ID)
+    await bot.load_sqlite_data(state)
+    return state
+
+
+async def close(bot, *states):
+    for state in states:
+        await bot.run_db(state.sqlite_store.close)
+
+
+def test_registrations_are_matched_by_the_owning_process(bot_module, shared_queue, monkeypatch):
+    bot = bot_module
+    track = track_owned_by(bot, 1)
+
+    async def scenario():
+        receiver = await load_as(bot, monkeypatch, 0)
+        owner = await load_as(bot, monkeypatch, 1)
+
+        # Process 0 receives both registrations for a track process 1 owns
+        monkeypatch.setattr(bot, 'PROCESS_INDEX', 0)
+        bot.record_event(receiver, 'leader_lock', user_id=2, university=UNIVERSITY, department="cs")
+        bot.record_event(receiver, 'register_leader', leader=leader(2, track))
+        bot.record_event(receiver, 'register_member', member=member(1, track))
+        await bot.run_db(lambda: None)  # Writes are queued on the database thread
+        assert not receiver.member_index and not receiver.leader_index
+        assert await bot.perform_matching(receiver) == 0
+
+        monkeypatch.setattr(bot, 'PROCESS_INDEX', 1)
+        matches = await bot.perform_matching(owner)
+        await bot.run_db(lambda: None)
+
+        # The match releases the member and the leader's lock on process 0
+        monkeypatch.setattr(bot, 'PROCESS_INDEX', 0)
+        assert 1 in receiver.registered_users and 2 in receiver.leader_departments
+        await bot.poll_registration_feed(receiver)
+        released = 1 not in receiver.registered_users and 2 not in receiver.leader_departments
+        await close(bot, receiver, owner)
+        return matches, released
+
+    matches, released = asyncio.run(scenario())
+    assert matches == 1
+    assert sorted(shared_queue) == [1, 2]
+    assert released
+
+
+def test_shared_queue_guilds_are_not_evicted_and_are_rescanned(bot_module, shared_queue, monkeypatch):
+    bot = bot_module
+    track = track_owned_by(bot, 1)
+    monkeypatch.setattr(bot, 'GUILD_IDLE_TTL', 0)
+    monkeypatch.setattr(bot, 'next_guild_scan_at', 0.0)
+
+    async def scenario():
+        # Process 0 writes the guild's database; process 1 has not loaded it yet
+        receiver = await load_as(bot, monkeypatch, 0)
+        bot.record_event(receiver, 'register_leader', leader=leader(2, track))
+        bot.record_event(receiver, 'register_member', member=member(1, track))
+        await bot.run_db(lambda: None)
+        await close(bot, receiver)
+
+        monkeypatch.setattr(bot, 'PROCESS_INDEX', 1)
+        await bot.auto_match()
+        await asyncio.gather(*bot.guild_loads.values())
+        owner = bot.guild_states[GUILD_ID]
+        assert await bot.evict_idle_guilds() == 0
+        matches = await owner.coordinator.request()
+        await close(bot, owner)
+        return matches
+
+    assert asyncio.run(scenario()) == 1
+    assert sorted(shared_queue) == [1, 2]
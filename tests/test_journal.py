@@ -0,0 +1,144 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+TRACK = ".net"
+UNIVERSITY = "Cairo University"
+
+
+@pytest.fixture
+def json_backend(bot_module, workdir, monkeypatch):
+    monkeypatch.setattr(bot_module, 'STORAGE_BACKEND', 'json')
+    return bot_module
+
+
+def member(user_id, topics=("C# Basics",), department="cs"):
+    return {
+        'user_id': user_id, 'user_name': f"member{user_id}", 'track': TRACK, 'rating': 10 * user_id,
+        'comment': "comment", 'department': department, 'university': UNIVERSITY,
+        'selected_topics': list(topics), 'registration_time': 1_700_000_000 + user_id
+    }
+
+
+def leader(user_id, department="cs"):
+    return {
+        'user_id': user_id, 'user_name': f"leader{user_id}", 'team_name': f"Team {user_id}", 'track': TRACK,
+        'team_comment': "idea", 'department': department, 'university': UNIVERSITY, 'desired_topics': []
+    }
+
+
+def summary(bot, state):
+    # Everything a restart has to bring back
+    return {
+        'members': sorted((m.user_id, m.rating, m.track_name, m.topics) for m in bot.queued_members(state)),
+        'leaders': sorted(
+            (l.user_id, l.track_name) for leaders in state.leader_index.values() for l in leaders
+        ),
+        'registered_users': sorted(state.registered_users),
+        'matched_members': sorted(state.matched_members),
+        'leader_departments': state.leader_departments,
+        'sessions': state.user_data.snapshot(),
+        'journal_seq': state.journal_seq
+    }
+
+
+def reload(bot, guild_id):
+    state = bot.GuildState(guild_id)
+    bot.load_data(state)
+    return state
+
+
+def record_cohort(bot, state, first_id):
+    bot.record_event(state, 'leader_lock', user_id=first_id + 50, university=UNIVERSITY, department="cs")
+    bot.record_event(state, 'register_leader', leader=leader(first_id + 50))
+    bot.record_event(state, 'leader_lock', user_id=first_id + 60, university=UNIVERSITY, department="it")
+    bot.record_event(state, 'register_leader', leader=leader(first_id + 60, department="it"))
+    for user_id in range(first_id, first_id + 3):
+        bot.record_event(state, 'register_member', member=member(user_id))
+    bot.record_event(state, 'register_member', member=member(first_id + 3, department="it"))
+    bot.record_event(
+        state, 'match', bucket=[TRACK, UNIVERSITY, "cs"], leader_id=first_id + 50, member_id=first_id
+    )
+
+
+def test_snapshot_and_journal_round_trip(json_backend):
+    bot = json_backend
+    state = bot.GuildState(42)
+    record_cohort(bot, state, 1)
+    state.user_data[99] = {'role': 'member', 'track': TRACK}
+
+    # Snapshot, then keep writing to the fresh journal
+    bot.save_data(state)
+    bot.flush_state()
+    record_cohort(bot, state, 101)
+    bot.record_event(state, 'session_clear', user_id=99)
+
+    restored = reload(bot, 42)
+    assert summary(bot, restored) == summary(bot, state)
+    assert 1 not in restored.registered_users and 101 not in restored.registered_users
+    assert sorted(restored.leader_departments) == [61, 161]
+    assert 99 not in restored.user_data
+
+
+def test_snapshot_removes_the_journal_segments_it_covers(json_backend):
+    bot = json_backend
+    state = bot.GuildState(43)
+    record_cohort(bot, state, 1)
+    bot.save_data(state)
+    bot.flush_state()
+    assert bot.journal_segments(state.journal_file) == []
+    assert not os.path.exists(state.journal_file)
+
+    record_cohort(bot, state, 101)
+    with open(state.data_file) as f:
+        snapshot_seq = json.load(f)['journal_seq']
+    assert snapshot_seq < state.journal_seq
+    assert summary(bot, reload(bot, 43)) == summary(bot, state)
+
+
+def test_rotated_segment_without_snapshot_is_replayed(json_backend):
+    # A crash after the journal was rotated but before the snapshot was
+    # written leaves only the segment behind
+    bot = json_backend
+    state = bot.GuildState(44)
+    record_cohort(bot, state, 1)
+    os.replace(state.journal_file, f"{state.journal_file}.{state.journal_seq}")
+    record_cohort(bot, state, 101)
+
+    assert summary(bot, reload(bot, 44)) == summary(bot, state)
+
+
+def test_torn_last_record_is_skipped(json_backend):
+    bot = json_backend
+    state = bot.GuildState(45)
+    record_cohort(bot, state, 1)
+    expected = summary(bot, state)
+    with open(state.journal_file, 'a') as f:
+        f.write('{"seq": 999, "op": "register_mem')
+
+    assert summary(bot, reload(bot, 45)) == expected
+
+
+def test_sqlite_import_keeps_matches_from_the_journal_tail(json_backend, monkeypatch):
+    bot = json_backend
+    state = bot.GuildState(46)
+    record_cohort(bot, state, 1)
+    bot.save_data(state)
+    bot.flush_state()
+    record_cohort(bot, state, 101)  # Only in the journal
+
+    monkeypatch.setattr(bot, 'STORAGE_BACKEND', 'sqlite')
+    imported = bot.GuildState(46)
+
+    async def matched_rows():
+        await bot.load_sqlite_data(imported)
+        rows = await bot.run_db(
+            lambda: imported.sqlite_store.conn.execute("SELECT user_id FROM members WHERE status = 'matched'").fetchall()
+        )
+        await bot.run_db(imported.sqlite_store.close)
+        return sorted(row[0] for row in rows)
+
+    assert asyncio.run(matched_rows()) == [1, 101]
+    assert not imported.matched_members
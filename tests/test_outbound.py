@@ -0,0 +1,161 @@
+import asyncio
+import json
+import time
+
+import discord
+import pytest
+from aiohttp import web
+
+BOT_USER = {"id": "1", "username": "bot", "discriminator": "0", "avatar": None}
+
+
+def json_response(payload, status=200, headers=None):
+    # discord.py only trusts an exact application/json content type
+    headers = dict(headers or {})
+    headers['Content-Type'] = 'application/json'
+    return web.Response(body=json.dumps(payload).encode(), status=status, headers=headers)
+
+
+def message_payload(channel_id, content):
+    return {
+        "id": "99", "channel_id": channel_id, "type": 0, "content": content, "author": BOT_USER,
+        "attachments": [], "embeds": [], "mentions": [], "mention_roles": [], "pinned": False,
+        "mention_everyone": False, "tts": False, "timestamp": "2024-01-01T00:00:00+00:00",
+        "edited_timestamp": None, "flags": 0, "components": []
+    }
+
+
+class MockDiscordAPI:
+    # Local stand-in for the Discord REST API. Each channel answers with the
+    # next status from its script (200 once the script runs out), and every
+    # message is recorded with the time it arrived.
+    def __init__(self, scripts, reset_after):
+        self.scripts = scripts
+        self.reset_after = reset_after  # channel_id -> seconds its bucket stays exhausted after a send
+        self.received = []  # (seconds since start, channel_id, content)
+        self.start = time.monotonic()
+
+    async def send_message(self, request):
+        channel_id = request.match_info['channel_id']
+        content = (await request.json()).get('content')
+        self.received.append((time.monotonic() - self.start, channel_id, content))
+        script = self.scripts.get(channel_id)
+        status = script.pop(0) if script else 200
+
+        headers = {'X-RateLimit-Bucket': f"bucket-{channel_id}", 'X-RateLimit-Limit': '5', 'Via': '1.1 mock'}
+        reset_after = self.reset_after.get(channel_id)
+        if reset_after:
+            headers.update({'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset-After': str(reset_after)})
+        else:
+            headers.update({'X-RateLimit-Remaining': '4', 'X-RateLimit-Reset-After': '1'})
+        if status == 429:
+            headers.update({'Retry-After': '0.3', 'X-RateLimit-Scope': 'user', 'X-RateLimit-Remaining': '0'})
+            return json_response({"message": "rate limited", "retry_after": 0.3, "global": False}, 429, headers)
+        return json_response(message_payload(channel_id, content), headers=headers)
+
+    async def me(self, request):
+        return json_response(BOT_USER)
+
+
+@pytest.fixture(autouse=True)
+def fresh_rate_limits(bot_module):
+    bot_module.rate_limits.buckets.clear()
+    bot_module.rate_limits.route_buckets.clear()
+
+
+async def start_mock(bot_module, api, monkeypatch):
+    app = web.Application()
+    app.router.add_get('/api/v10/users/@me', api.me)
+    app.router.add_post('/api/v10/channels/{channel_id}/messages', api.send_message)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    monkeypatch.setattr(discord.http.Route, 'BASE', f"http://127.0.0.1:{port}/api/v10")
+
+    # Closing the client closes its connector too, so every test gets a new one
+    monkeypatch.setattr(bot_module.bot.http, 'connector', discord.utils.MISSING)
+    await bot_module.bot.http.static_login('test-token')
+    # Scripted 429s are longer than this, so they surface as RateLimited
+    monkeypatch.setattr(bot_module.bot.http, 'max_ratelimit_timeout', 0.1)
+    return runner
+
+
+async def stop_mock(bot_module, runner):
+    await bot_module.bot.http.close()
+    await runner.cleanup()
+
+
+def test_retry_after_requeues_the_send(bot_module, monkeypatch):
+    api = MockDiscordAPI(scripts={'20': [429, 200]}, reset_after={})
+    outbound = bot_module.outbound
+
+    async def scenario():
+        runner = await start_mock(bot_module, api, monkeypatch)
+        try:
+            channel = bot_module.bot.get_partial_messageable(20)
+            requeued = outbound.requeued
+            message = await asyncio.wait_for(
+                outbound.submit(20, lambda: channel.send("hello"), bot_module.PRIORITY_PROMPT), 5
+            )
+            return message, outbound.requeued - requeued
+        finally:
+            await stop_mock(bot_module, runner)
+
+    message, requeued = asyncio.run(scenario())
+    assert message.content == "hello"
+    assert requeued == 1
+    first, second = api.received
+    assert second[0] - first[0] >= 0.25  # Sent again only after Retry-After
+
+
+def test_prompts_go_before_waiting_notifications(bot_module, monkeypatch):
+    api = MockDiscordAPI(scripts={}, reset_after={'10': 0.4})
+    outbound = bot_module.outbound
+
+    async def scenario():
+        runner = await start_mock(bot_module, api, monkeypatch)
+        try:
+            channel = bot_module.bot.get_partial_messageable(10)
+
+            def send(content):
+                return lambda: channel.send(content)
+
+            # The first send leaves the channel's bucket exhausted, so the
+            # rest wait in the lane until it resets
+            await outbound.submit(10, send("notify 0"), bot_module.PRIORITY_NOTIFY)
+            waiting = [
+                outbound.submit(10, send("notify 1"), bot_module.PRIORITY_NOTIFY),
+                outbound.submit(10, send("notify 2"), bot_module.PRIORITY_NOTIFY),
+                outbound.submit(10, send("prompt"), bot_module.PRIORITY_PROMPT)
+            ]
+            await asyncio.wait_for(asyncio.gather(*waiting), 10)
+        finally:
+            await stop_mock(bot_module, runner)
+
+    asyncio.run(scenario())
+    assert [content for _, _, content in api.received] == ["notify 0", "prompt", "notify 1", "notify 2"]
+    assert api.received[1][0] - api.received[0][0] >= 0.3  # Held until the bucket reset
+
+
+def test_cancelled_caller_on_last_attempt_keeps_the_lane_working(bot_module, monkeypatch):
+    monkeypatch.setattr(bot_module, 'OUTBOUND_ATTEMPTS', 1)
+    outbound = bot_module.outbound
+
+    async def scenario():
+        futures = []
+
+        async def rate_limited():
+            futures[0].cancel()
+            raise discord.RateLimited(0.01)
+
+        async def ok():
+            return "sent"
+
+        futures.append(outbound.submit(30, rate_limited))
+        await asyncio.sleep(0.05)
+        return await asyncio.wait_for(outbound.submit(30, ok), 2)
+
+    assert asyncio.run(scenario()) == "sent"
+
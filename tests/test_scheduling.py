@@ -0,0 +1,69 @@
+import asyncio
+
+import discord
+from discord.ext import commands
+
+
+def test_a_slow_guild_does_not_hold_up_the_others(bot_module, workdir, monkeypatch):
+    bot = bot_module
+    monkeypatch.setattr(bot, 'SHARED_QUEUE', False)
+
+    async def scenario():
+        release = asyncio.Event()
+        passes = []
+
+        async def slow_pass():
+            passes.append('slow')
+            await release.wait()  # Stuck behind notification retries or a rate limit
+            return 0
+
+        async def fast_pass():
+            passes.append('fast')
+            return 0
+
+        slow, fast = bot.GuildState(1), bot.GuildState(2)
+        slow.coordinator = bot.MatchingCoordinator(slow_pass)
+        fast.coordinator = bot.MatchingCoordinator(fast_pass)
+        for state in (slow, fast):
+            state.dirty_buckets.add((0, 0, 0))
+            bot.guild_states[state.guild_id] = state
+
+        await asyncio.wait_for(bot.auto_match(), 1)
+        await asyncio.sleep(0)
+        # The fast guild finished and is due again while the slow pass still runs
+        fast.next_match_at = 0.0
+        await asyncio.wait_for(bot.auto_match(), 1)
+        await asyncio.sleep(0)
+        still_running = slow.coordinator.running
+        release.set()
+        await slow.coordinator.task
+        return passes, still_running
+
+    passes, still_running = asyncio.run(scenario())
+    assert passes == ['slow', 'fast', 'fast']
+    assert still_running
+
+
+class FakeShard:
+    def __init__(self, shard_id, latency, closed=False):
+        self.id = shard_id
+        self.latency = latency
+        self.closed = closed
+        self.reconnects = 0
+
+    def is_closed(self):
+        return self.closed
+
+    async def reconnect(self):
+        self.reconnects += 1
+
+
+def test_gateway_check_reconnects_stalled_shards(bot_module, monkeypatch):
+    shards = {0: FakeShard(0, 0.05), 1: FakeShard(1, float('inf')), 2: FakeShard(2, float('nan'), closed=True)}
+    sharded = commands.AutoShardedBot(command_prefix="!", intents=discord.Intents.none(), shard_count=3)
+    monkeypatch.setattr(commands.AutoShardedBot, 'shards', property(lambda self: shards))
+    monkeypatch.setattr(bot_module, 'bot', sharded)
+
+    assert asyncio.run(bot_module.check_gateway())
+    # A closed shard is already being reconnected by discord.py
+    assert [shard.reconnects for shard in shards.values()] == [0, 1, 0]